@@ -0,0 +1,217 @@
+'''
+bulkimport.py - Importing a local directory tree into the DFS
+
+walk() lists the files under a directory with the DFS paths they get.
+BulkImport hands them to the peer's hashing processes (hashing.py), which
+stream each one into its version file block by block, hashing the blocks
+as they go, so nothing is read twice or held in memory whole. No process
+is forked for an import: by then the peer has sockets open, and a child
+would keep them open. Back in the peer, the
+results are recorded BATCH_SIZE files per DB transaction, and announced
+to the tracker as NewFileAvailable messages, which the notification
+batcher sends together. With the tracker offline they're journalled
+instead, like any other write.
+
+Files that are already in the DFS go through LocalPeer.replace(), which
+copies each one into a temporary file and puts it in place of the version
+file once it's complete, so readers and replicas see a single new version
+and the tracker is told about it once.
+'''
+
+import logging
+import os
+import socket
+import threading
+import time
+
+import checksum
+import filesystem
+import journal
+import merkle
+import messages
+from messages import FileModel
+
+BATCH_SIZE = 64
+PROGRESS_INTERVAL = 2.0
+
+
+def walk(src_root, dest_root=""):
+    '''returns [(source path, DFS path, size)] for the files under src_root'''
+    files = []
+    for dir_path, dir_names, file_names in os.walk(src_root):
+        dir_names.sort()
+        for name in sorted(file_names):
+            src_path = os.path.join(dir_path, name)
+            if not os.path.isfile(src_path):
+                continue
+            rel_path = os.path.relpath(src_path, src_root).replace(os.sep, "/")
+            dest_path = dest_root.rstrip("/") + "/" + rel_path if dest_root else rel_path
+            files.append((src_path, dest_path, os.path.getsize(src_path)))
+    return files
+
+def import_file(task):
+    '''
+    copies src_path to local_path, hashing each checksum.BLOCK_SIZE block.
+    Runs in a worker process. returns (dest path, size, block hashes, error)
+    '''
+    src_path, dest_path, local_path = task
+    # not filesystem.write_blocks(): its lock may have been held by one of
+    # the peer's threads when this process was forked
+    out = None
+    try:
+        hashes = []
+        size = 0
+        out = filesystem.temp_file(local_path)
+        try:
+            for data in filesystem.read_blocks(src_path, checksum.BLOCK_SIZE):
+                hashes.append(checksum.calc_checksum(data))
+                size += len(data)
+                out.write(data)
+        finally:
+            out.close()
+        os.rename(out.name, local_path)
+        return dest_path, size, hashes, None
+    except (IOError, OSError), e:
+        if out is not None and os.path.exists(out.name):
+            os.remove(out.name)
+        return dest_path, None, None, "%s: %s" % (src_path, e)
+
+
+class BulkImport(object):
+    def __init__(self, peer, parallel=True, batch_size=BATCH_SIZE, progress=None):
+        '''
+        parallel=False imports in this process, as does a peer without
+        running hashing processes. progress(bulk_import) is called every
+        PROGRESS_INTERVAL seconds and at the end
+        '''
+        self._peer = peer
+        self.parallel = parallel
+        self.batch_size = batch_size
+        self._progress = progress
+        self._lock = threading.Lock()
+
+        self.started = None
+        self.finished = None
+        self.total_files = 0
+        self.total_bytes = 0
+        self.files = 0
+        self.bytes = 0
+        self.updated = 0 # files that were already in the DFS
+        self.failed = 0
+        self.errors = []
+
+    def run(self, files):
+        '''imports files, a list of (source path, DFS path, size) as returned by walk()'''
+        self.started = time.time()
+        self.total_files = len(files)
+        self.total_bytes = sum(size for src_path, dest_path, size in files)
+
+        new_files = []
+        for src_path, dest_path, size in files:
+            if self._peer.db.get_file(dest_path) is not None:
+                self._update(src_path, dest_path, size)
+            else:
+                local_path = filesystem.get_local_path(self._peer, dest_path, 1)
+                new_files.append((src_path, dest_path, local_path))
+
+        try:
+            self._import_new(new_files)
+        finally:
+            self.finished = time.time()
+            logging.info(self.report())
+            self._report_progress()
+        return self
+
+    def _update(self, src_path, dest_path, size):
+        try:
+            self._peer.replace(dest_path, src_path)
+        except Exception, e:
+            self._failed("%s: %s" % (src_path, e))
+            return
+        with self._lock:
+            self.files += 1
+            self.updated += 1
+            self.bytes += size
+
+    def _failed(self, error):
+        logging.error("Couldn't import %s" % error)
+        with self._lock:
+            self.failed += 1
+            self.errors.append(error)
+
+    def _import_new(self, tasks):
+        if not tasks:
+            return
+        results = None
+        hasher = getattr(self._peer, "hasher", None)
+        if self.parallel and hasher is not None:
+            results = hasher.imap_unordered(import_file, tasks, chunksize=4)
+        if results is None:
+            results = (import_file(task) for task in tasks)
+
+        batch = []
+        last_progress = time.time()
+        for result in results:
+            dest_path, size, hashes, error = result
+            if error is not None:
+                self._failed(error)
+                continue
+            batch.append(result)
+            if len(batch) >= self.batch_size:
+                self._register(batch)
+                batch = []
+            if time.time() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.time()
+                logging.info(self.report())
+                self._report_progress()
+        self._register(batch)
+        try:
+            self._peer.notifications.flush()
+        except (socket.error, RuntimeError), e:
+            logging.warning("Couldn't send the last notifications of the import: %s" % e)
+
+    def _register(self, batch):
+        if not batch:
+            return
+        peer = self._peer
+        file_models = []
+        with peer.db.transaction():
+            for dest_path, size, hashes, error in batch:
+                f = FileModel(dest_path, False, merkle.root(hashes), size, latest_version=1)
+                peer.db.add_or_update_file(f)
+                peer._version_stored(dest_path, 1, hashes)
+                file_models.append(f)
+
+        for f in file_models:
+            self._announce(f)
+        with self._lock:
+            self.files += len(batch)
+            self.bytes += sum(size for dest_path, size, hashes, error in batch)
+
+    def _announce(self, f):
+        peer = self._peer
+        op = journal.Op(journal.WRITE, f.path, version=1, is_new=True)
+        if not peer.is_tracker_online():
+            peer.journal.append(op)
+            return
+        try:
+            peer.notifications.send(messages.NewFileAvailable(f, peer.port))
+        except (socket.error, RuntimeError), e:
+            logging.warning("Couldn't tell the tracker about %s: %s" % (f.path, e))
+            peer.journal.append(op)
+
+    def _report_progress(self):
+        if self._progress is not None:
+            self._progress(self)
+
+    def report(self):
+        with self._lock:
+            if self.started is None:
+                return "import: not started"
+            elapsed = (self.finished or time.time()) - self.started
+            state = "done" if self.finished is not None else "running"
+            return ("import %s: %d/%d files (%d updated), %.1f/%.1f MB, %d failed, "
+                    "%.1fs, %.1f MB/s" %
+                    (state, self.files, self.total_files, self.updated,
+                     self.bytes / 2.0 ** 20, self.total_bytes / 2.0 ** 20, self.failed,
+                     elapsed, self.bytes / 2.0 ** 20 / max(elapsed, 1e-6)))
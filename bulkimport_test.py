@@ -0,0 +1,180 @@
+"""
+bulkimport_test.py - Test file for bulkimport.py
+"""
+
+from contextlib import contextmanager
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+
+import bulkimport
+import checksum
+import filesystem
+import journal
+import merkle
+from messages import FileModel
+
+def make_tree(root):
+    files = {"a.txt": "hello", "sub/b.bin": os.urandom(checksum.BLOCK_SIZE * 2 + 5),
+             "sub/deeper/c": "", "z": os.urandom(300)}
+    for rel_path, data in files.items():
+        path = os.path.join(root, *rel_path.split("/"))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+    return files
+
+def test_walk():
+    print "Testing walk"
+    root = tempfile.mkdtemp()
+    try:
+        files = make_tree(root)
+        listed = bulkimport.walk(root)
+        assert [dest for src, dest, size in listed] == ["a.txt", "z", "sub/b.bin", "sub/deeper/c"]
+        for src, dest, size in listed:
+            assert size == len(files[dest])
+        listed = bulkimport.walk(root, "imported/")
+        assert listed[0][1] == "imported/a.txt"
+    finally:
+        shutil.rmtree(root)
+
+def test_import_file():
+    print "Testing import_file"
+    root = tempfile.mkdtemp()
+    try:
+        files = make_tree(os.path.join(root, "src"))
+        tasks = [(src, dest, os.path.join(root, "dfs", dest) + ".1")
+                 for src, dest, size in bulkimport.walk(os.path.join(root, "src"))]
+        tasks.append((os.path.join(root, "missing"), "missing", os.path.join(root, "dfs", "missing.1")))
+
+        pool = multiprocessing.Pool(2)
+        try:
+            results = pool.map(bulkimport.import_file, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for (src, dest, local_path), (dest_path, size, hashes, error) in zip(tasks, results):
+            assert dest_path == dest
+            if dest == "missing":
+                assert error is not None and not os.path.exists(local_path)
+                continue
+            assert error is None and size == len(files[dest])
+            assert open(local_path, "rb").read() == files[dest]
+            assert merkle.root(hashes) == checksum.calc_file_checksum(local_path)
+        # no temporary files are left behind
+        assert sorted(os.listdir(os.path.join(root, "dfs"))) == ["a.txt.1", "sub", "z.1"]
+    finally:
+        shutil.rmtree(root)
+
+class FakeDb(object):
+    def __init__(self, files):
+        self.files = dict((f.path, f) for f in files)
+        self.transactions = 0
+        self.depth = 0
+
+    def get_file(self, file_path):
+        return self.files.get(file_path)
+
+    def add_or_update_file(self, f):
+        assert self.depth > 0
+        self.files[f.path] = f
+
+    @contextmanager
+    def transaction(self):
+        self.transactions += 1
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+
+class FakeNotifications(object):
+    def __init__(self, fail_on=()):
+        self.sent = []
+        self.fail_on = fail_on
+
+    def send(self, msg):
+        if msg.file_model.path in self.fail_on:
+            raise socket.error("tracker went away")
+        self.sent.append(msg)
+
+    def flush(self):
+        pass
+
+class FakeJournal(object):
+    def __init__(self):
+        self.ops = []
+
+    def append(self, op):
+        self.ops.append(op)
+
+class FakePeer(object):
+    port = 12345
+    hasher = None
+
+    def __init__(self, root_path, existing=(), online=True, fail_on=()):
+        self.root_path = root_path
+        self.db = FakeDb(existing)
+        self.notifications = FakeNotifications(fail_on)
+        self.journal = FakeJournal()
+        self.online = online
+        self.stored = []
+        self.replaced = []
+
+    def is_tracker_online(self):
+        return self.online
+
+    def _version_stored(self, file_path, version, leaves=None):
+        self.stored.append((file_path, version, leaves))
+
+    def replace(self, file_path, src_path):
+        self.replaced.append((file_path, filesystem.read_file(src_path)))
+
+def test_run():
+    print "Testing run"
+    root = tempfile.mkdtemp()
+    try:
+        files = make_tree(os.path.join(root, "src"))
+        listed = bulkimport.walk(os.path.join(root, "src"))
+        existing = [FileModel(u"sub/b.bin", False, "old", 10, 1),
+                    FileModel(u"sub/deeper/c", False, "old", 10, 1)]
+        peer = FakePeer(os.path.join(root, "dfs"), existing, fail_on=["z"])
+        bulk_import = bulkimport.BulkImport(peer, batch_size=1).run(listed)
+
+        # new files are recorded a batch per transaction and announced
+        assert peer.db.transactions == 2
+        assert sorted(f.path for f in peer.db.files.values() if f.checksum != "old") == ["a.txt", "z"]
+        assert [msg.file_model.path for msg in peer.notifications.sent] == ["a.txt"]
+        assert [f for f, v, leaves in peer.stored] == ["a.txt", "z"]
+        assert filesystem.read_file(os.path.join(root, "dfs", "z.1")) == files["z"]
+        # the tracker couldn't be told about z
+        assert [(op.kind, op.path, op.is_new) for op in peer.journal.ops] == [(journal.WRITE, "z", True)]
+
+        # files already in the DFS are replaced whole, once each
+        assert peer.replaced == [("sub/b.bin", files["sub/b.bin"]),
+                                 ("sub/deeper/c", files["sub/deeper/c"])]
+        assert (bulk_import.files, bulk_import.updated, bulk_import.failed) == (4, 2, 0)
+        assert bulk_import.bytes == sum(len(data) for data in files.values())
+
+        # with the tracker offline everything new is journalled
+        peer = FakePeer(os.path.join(root, "dfs2"), online=False)
+        bulkimport.BulkImport(peer, batch_size=3).run(listed)
+        assert peer.db.transactions == 2
+        assert peer.notifications.sent == []
+        assert sorted(op.path for op in peer.journal.ops) == ["a.txt", "sub/b.bin", "sub/deeper/c", "z"]
+    finally:
+        shutil.rmtree(root)
+
+def run():
+    test_walk()
+    test_import_file()
+    test_run()
+    print "bulkimport tests passed"
+
+if __name__ == "__main__":
+    run()
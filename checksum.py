@@ -1,17 +1,52 @@
 import hashlib
+import os
+import threading
+
+import filesystem
+import merkle
+
+# a file's checksum is the root of a Merkle tree over the md5s of its
+# BLOCK_SIZE blocks, so a write only has to rehash the blocks it touched
+# (see BlockHashes) and a block can be checked on its own (see merkle.py)
+BLOCK_SIZE = 2 ** 20
 
 def calc_checksum(file_data):    
     return hashlib.md5(file_data).digest()
     
-def calc_file_checksum(filePath, block_size=65536):
-    f = file(filePath, 'r')
-    md5 = hashlib.md5()
-    while True:
-        data = f.read(block_size)
-        if not data:
-            break
-        md5.update(data)
-    return md5.digest()
+def calc_file_checksum(filePath, block_size=BLOCK_SIZE):
+    return combine(calc_block_hashes(filePath, block_size))
+
+def calc_block_hashes(filePath, block_size=BLOCK_SIZE):
+    # hashed straight from a mapping of the file, nothing is copied
+    return [hashlib.md5(block).digest() for block in filesystem.map_blocks(filePath, block_size)]
+
+def combine(block_hashes):
+    '''the file checksum for a list of block hashes'''
+    return merkle.root(block_hashes)
+
+def legacy_checksum(file_path):
+    '''
+    the md5 of the whole file, which was its checksum before checksums
+    were Merkle roots (db.CHECKSUM_FORMAT 0). The same for files of up
+    to one block
+    '''
+    f = open(file_path, "rb")
+    try:
+        return md5_for_file(f)
+    finally:
+        f.close()
+
+def file_stamp(file_path):
+    '''
+    (size, mtime, ctime, inode) of file_path, or None if it doesn't exist.
+    A file replaced by renaming another one over it gets a new inode, and
+    ctime catches writes that don't move mtime past its granularity
+    '''
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime, st.st_ctime, st.st_ino
 
 def md5_for_file(f, block_size=2**20):
     md5 = hashlib.md5()
@@ -23,3 +58,87 @@ def md5_for_file(f, block_size=2**20):
     return md5.digest()
 
 
+class BlockHashes(object):
+    '''
+    The block hashes of the local copies of files, kept up to date as
+    ranges of them are written. An entry is only used while the local
+    copy's file_stamp() is the one it was computed for. Whole files
+    are hashed by hasher (a hashing.HashingService) if there is one
+    '''
+    def __init__(self, block_size=BLOCK_SIZE, hasher=None):
+        self.block_size = block_size
+        self.hasher = hasher
+        self._lock = threading.Lock()
+        self._files = {} # file path -> (local path, file_stamp(), block hashes)
+
+    def _cached(self, file_path, local_path):
+        # must be called with _lock held
+        entry = self._files.get(file_path)
+        if entry is None or entry[0] != local_path:
+            return None
+        return entry[2] if entry[1] == file_stamp(local_path) else None
+
+    def _calc(self, local_path):
+        if self.hasher is not None:
+            return self.hasher.hash_blocks(local_path, self.block_size).result()
+        return calc_block_hashes(local_path, self.block_size)
+
+    def get(self, file_path, local_path):
+        '''returns the block hashes of local_path, the local copy of file_path'''
+        with self._lock:
+            hashes = self._cached(file_path, local_path)
+            if hashes is not None:
+                return list(hashes)
+        # hashed without the lock, a write meanwhile leaves a stamp that won't match
+        stamp = file_stamp(local_path)
+        hashes = self._calc(local_path)
+        with self._lock:
+            self._files[file_path] = (local_path, stamp, hashes)
+        return list(hashes)
+
+    def update(self, file_path, local_path, old_stamp, offset, length):
+        '''
+        returns the block hashes of local_path after length bytes were
+        written at offset. old_stamp is the file_stamp() from before the
+        write. Only the blocks that changed are read, if the hashes from
+        before the write are known
+        '''
+        bs = self.block_size
+        with self._lock:
+            entry = self._files.get(file_path)
+            hashes = None
+            if old_stamp is not None and entry is not None and entry[:2] == (local_path, old_stamp):
+                hashes = entry[2]
+                old_size = old_stamp[0]
+        new_size = os.path.getsize(local_path)
+        if hashes is None or (offset == 0 and length >= new_size):
+            # nothing to reuse, the whole file is hashed
+            stamp = file_stamp(local_path)
+            hashes = self._calc(local_path)
+            with self._lock:
+                self._files[file_path] = (local_path, stamp, hashes)
+            return list(hashes)
+
+        with self._lock:
+            count = (new_size + bs - 1) // bs
+            dirty = set(range(offset // bs, (offset + length + bs - 1) // bs))
+            if new_size != old_size:
+                # the old last block, and any hole before offset
+                dirty.update(range(min(old_size, new_size) // bs, count))
+            hashes = hashes[:count] + [None] * (count - len(hashes))
+            for i in sorted(dirty):
+                if i < count:
+                    with filesystem.map_range(local_path, i * bs, bs) as data:
+                        hashes[i] = hashlib.md5(data).digest()
+            self._files[file_path] = (local_path, file_stamp(local_path), hashes)
+            return list(hashes)
+
+    def put(self, file_path, local_path, hashes):
+        '''records hashes, the block hashes of local_path, computed by the caller'''
+        stamp = file_stamp(local_path)
+        with self._lock:
+            self._files[file_path] = (local_path, stamp, list(hashes))
+
+    def invalidate(self, file_path):
+        with self._lock:
+            self._files.pop(file_path, None)
@@ -0,0 +1,84 @@
+"""
+checksum_test.py - Test file for checksum.py
+"""
+
+import os
+import shutil
+import tempfile
+
+import checksum
+import filesystem
+
+def check(hashes, path, block_size):
+    assert hashes == checksum.calc_block_hashes(path, block_size)
+
+def test_incremental_writes():
+    print "Testing incremental writes"
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, "f.1")
+        bs = 1000
+        hashes = checksum.BlockHashes(block_size=bs)
+        filesystem.write_file(path, os.urandom(5500))
+        hashes.get(u"f", path)
+
+        writes = [(1200, 100),  # inside a block
+                  (2990, 20),   # across two blocks
+                  (5400, 400),  # past the end
+                  (9000, 10)]   # after a hole
+        for offset, length in writes:
+            stamp = checksum.file_stamp(path)
+            filesystem.write_file(path, os.urandom(length), offset)
+            check(hashes.update(u"f", path, stamp, offset, length), path, bs)
+
+        # shrinking rewrite
+        stamp = checksum.file_stamp(path)
+        filesystem.write_file(path, "x" * 500, 0)
+        filesystem.truncate(path, 1500)
+        check(hashes.update(u"f", path, stamp, 0, 500), path, bs)
+
+        # replaced by a file of the same size and mtime, without update()
+        os.utime(path, (1000000000, 1000000000))
+        hashes.get(u"f", path)
+        filesystem.write_file(path, os.urandom(os.path.getsize(path)))
+        os.utime(path, (1000000000, 1000000000))
+        check(hashes.get(u"f", path), path, bs)
+
+        # nothing known about the file before the write
+        hashes.invalidate(u"f")
+        filesystem.write_file(path, "y", 10)
+        check(hashes.update(u"f", path, None, 10, 1), path, bs)
+
+        # hashes the caller computed
+        known = checksum.calc_block_hashes(path, bs)
+        hashes.put(u"f", path, known)
+        assert hashes.get(u"f", path) == known
+    finally:
+        shutil.rmtree(root)
+
+def test_file_checksum():
+    print "Testing file checksum"
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, "f")
+        data = os.urandom(checksum.BLOCK_SIZE + 10)
+        filesystem.write_file(path, data)
+        block_hashes = [checksum.calc_checksum(data[:checksum.BLOCK_SIZE]),
+                        checksum.calc_checksum(data[checksum.BLOCK_SIZE:])]
+        assert checksum.calc_file_checksum(path) == checksum.combine(block_hashes)
+
+        # the old style checksum only matches up to one block
+        assert checksum.legacy_checksum(path) == checksum.calc_checksum(data)
+        assert checksum.legacy_checksum(path) != checksum.calc_file_checksum(path)
+        filesystem.write_file(path, data[:1000])
+        assert checksum.legacy_checksum(path) == checksum.calc_file_checksum(path)
+    finally:
+        shutil.rmtree(root)
+
+def run():
+    test_incremental_writes()
+    test_file_checksum()
+    print "checksum tests passed"
+
+if __name__ == "__main__":
+    run()
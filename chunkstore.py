@@ -0,0 +1,440 @@
+'''
+chunkstore.py - Content-defined chunks of file versions, stored once
+
+Versions are split into chunks at boundaries picked from their content, so
+an insertion or deletion only changes the chunks around it. Each version a
+peer holds gets a manifest listing its chunks' md5s and sizes. A chunk is
+read either from a version file that holds it or from the store's objects,
+which keep the chunks of archived versions once their version files are
+gone. The same content in several files or versions is stored once.
+
+Transfers use the manifests too: download() copies the chunks the
+receiver already has and only fetches the others.
+
+Everything lives under <root_path>/.chunks:
+    objects/<md5 hex>           one file per chunk
+    manifests/<md5 hex of path>.<version>
+'''
+
+import binascii
+import hashlib
+import logging
+import os
+import socket
+import threading
+import zlib
+
+import checksum
+import communication
+import filesystem
+import messages
+
+# A chunk ends after an ANCHOR byte once the crc32 of the WINDOW bytes
+# before it has its low bits clear. Finding anchors with str.find() keeps
+# the scan in C. Chunks average a few KB with either text or binary data
+MIN_CHUNK_SIZE = 2048
+MAX_CHUNK_SIZE = 65536
+ANCHOR = "\n"
+WINDOW = 32
+BOUNDARY_MASK = 0x1f
+READ_SIZE = 2 ** 20
+# missing chunks next to each other are fetched with one request, up to this size
+MAX_FETCH_SIZE = 4 * 2 ** 20
+FETCH_TIMEOUT = 30.0
+
+
+def _chunk_end(buf, start, end):
+    '''returns the end of the chunk that starts at start, end is the furthest it can go'''
+    limit = min(start + MAX_CHUNK_SIZE, end)
+    i = buf.find(ANCHOR, start + MIN_CHUNK_SIZE, limit)
+    while i != -1:
+        if zlib.crc32(buf[i - WINDOW:i]) & BOUNDARY_MASK == 0:
+            return i + 1
+        i = buf.find(ANCHOR, i + 1, limit)
+    return limit
+
+def split(f):
+    '''generator over the content-defined chunks of the file object f'''
+    buf = ""
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < MAX_CHUNK_SIZE:
+            data = f.read(READ_SIZE)
+            eof = not data
+            buf = buf[pos:] + data
+            pos = 0
+            continue
+        if pos == len(buf):
+            return
+        end = _chunk_end(buf, pos, len(buf))
+        yield buf[pos:end]
+        pos = end
+
+def _resplit(file_path, old, old_size, offset, length):
+    '''
+    returns the manifest of the file at file_path after length bytes were
+    written at offset, given its manifest old from before. Splitting starts
+    at the chunk the write begins in, whose start only depends on the data
+    before it, and stops once a chunk ends where an old one did after the
+    written range, as the chunks from there on are the same
+    '''
+    new_size = os.path.getsize(file_path)
+    start = min(offset, old_size, new_size)
+    i = 0
+    pos = 0
+    while i + 1 < len(old) and pos + old[i][1] <= start:
+        pos += old[i][1]
+        i += 1
+    old_ends = {}
+    end = pos
+    for j in range(i, len(old)):
+        end += old[j][1]
+        old_ends[end] = j
+
+    manifest = old[:i]
+    f = open(file_path, "rb")
+    try:
+        f.seek(pos)
+        for chunk in split(f):
+            manifest.append((checksum.calc_checksum(chunk), len(chunk)))
+            pos += len(chunk)
+            # the rest only lines up if the file kept its size
+            if new_size == old_size and pos >= offset + length and pos in old_ends:
+                return manifest + old[old_ends[pos] + 1:]
+    finally:
+        f.close()
+    return manifest
+
+def manifest_of(file_path):
+    '''returns [(chunk md5, size)] for the file at file_path'''
+    f = open(file_path, "rb")
+    try:
+        return [(checksum.calc_checksum(chunk), len(chunk)) for chunk in split(f)]
+    finally:
+        f.close()
+
+
+class ChunkStore(object):
+    def __init__(self, peer):
+        self._peer = peer
+        self._lock = threading.Lock()
+        self._manifests = None # (file path, version) -> [(chunk md5, size)]
+        # chunk md5 -> set of (file path, version, offset, size) of the version files holding it
+        self._locations = {}
+        # versions only kept as chunks, their version files are gone
+        self._archived = set()
+        # chunk md5 -> number of archived versions using its object
+        self._refs = {}
+        # (file path, version) -> file_stamp() of the version file its manifest was taken from
+        self._stamps = {}
+        # held while objects are written or deleted, before _lock if both are
+        self._objects_lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self._peer.root_path, ".chunks")
+
+    def _object_path(self, chunk_hash):
+        return os.path.join(self.path, "objects", binascii.hexlify(chunk_hash))
+
+    def _manifest_path(self, file_path, version):
+        name = hashlib.md5(file_path.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "manifests", "%s.%d" % (name, version))
+
+    def _load(self):
+        # must be called with _lock held
+        if self._manifests is not None:
+            return
+        self._manifests = {}
+        manifest_dir = os.path.join(self.path, "manifests")
+        if not os.path.isdir(manifest_dir):
+            return
+        for name in os.listdir(manifest_dir):
+            f = open(os.path.join(manifest_dir, name), "rb")
+            try:
+                lines = f.read().splitlines()
+            finally:
+                f.close()
+            file_path, version, archived = lines[0].decode("utf-8"), int(lines[1]), lines[2] == "1"
+            manifest = []
+            for line in lines[3:]:
+                chunk_hex, size = line.split()
+                manifest.append((binascii.unhexlify(chunk_hex), int(size)))
+            self._set_manifest(file_path, version, manifest, archived)
+
+    def _set_manifest(self, file_path, version, manifest, archived):
+        # must be called with _lock held
+        self._drop_manifest(file_path, version)
+        self._manifests[(file_path, version)] = manifest
+        if archived:
+            self._archived.add((file_path, version))
+            for chunk_hash in set(chunk_hash for chunk_hash, size in manifest):
+                self._refs[chunk_hash] = self._refs.get(chunk_hash, 0) + 1
+            return
+        offset = 0
+        for chunk_hash, size in manifest:
+            self._locations.setdefault(chunk_hash, set()).add((file_path, version, offset, size))
+            offset += size
+
+    def _drop_manifest(self, file_path, version):
+        # must be called with _lock held. returns the md5s of the
+        # objects no archived version uses any more
+        self._stamps.pop((file_path, version), None)
+        manifest = self._manifests.pop((file_path, version), None)
+        if manifest is None:
+            return []
+        if (file_path, version) in self._archived:
+            self._archived.discard((file_path, version))
+            unused = []
+            for chunk_hash in set(chunk_hash for chunk_hash, size in manifest):
+                self._refs[chunk_hash] -= 1
+                if self._refs[chunk_hash] == 0:
+                    del self._refs[chunk_hash]
+                    unused.append(chunk_hash)
+            return unused
+        offset = 0
+        for chunk_hash, size in manifest:
+            locations = self._locations.get(chunk_hash)
+            if locations is not None:
+                locations.discard((file_path, version, offset, size))
+                if not locations:
+                    del self._locations[chunk_hash]
+            offset += size
+        return []
+
+    def _save_manifest(self, file_path, version, manifest, archived):
+        lines = [file_path.encode("utf-8"), str(version), "1" if archived else "0"]
+        lines.extend("%s %d" % (binascii.hexlify(chunk_hash), size) for chunk_hash, size in manifest)
+        _write_atomically(self._manifest_path(file_path, version), "\n".join(lines))
+
+    def manifest(self, file_path, version):
+        with self._lock:
+            self._load()
+            return self._manifests.get((file_path, version))
+
+    def add_version(self, file_path, version, local_path, old_stamp=None, offset=0, length=None):
+        '''
+        Records the chunks of the version file at local_path, which has
+        just been written. returns its manifest. If length bytes were
+        written at offset, over the file old_stamp (its
+        checksum.file_stamp() from before the write) describes, only the
+        chunks around them are split again
+        '''
+        stamp = checksum.file_stamp(local_path)
+        manifest = None
+        if old_stamp is not None and length is not None:
+            with self._lock:
+                self._load()
+                old = self._manifests.get((file_path, version))
+                if self._stamps.get((file_path, version)) != old_stamp:
+                    old = None
+            if old:
+                manifest = _resplit(local_path, old, old_stamp[0], offset, length)
+        if manifest is None:
+            manifest = manifest_of(local_path)
+        with self._lock:
+            self._load()
+            self._set_manifest(file_path, version, manifest, False)
+            self._stamps[(file_path, version)] = stamp
+        self._save_manifest(file_path, version, manifest, False)
+        return manifest
+
+    def archive_version(self, file_path, version):
+        '''
+        Moves the chunks of a version into the objects, where they're
+        stored once however many versions and files share them, and
+        removes its version file
+        '''
+        local_path = filesystem.get_local_path(self._peer, file_path, version)
+        if os.path.exists(local_path):
+            manifest = self.add_version(file_path, version, local_path)
+        else:
+            manifest = self.manifest(file_path, version)
+        if manifest is None:
+            return False
+
+        # remove_file() can't delete the objects until the version is archived
+        with self._objects_lock:
+            offset = 0
+            for chunk_hash, size in manifest:
+                if not os.path.exists(self._object_path(chunk_hash)):
+                    with filesystem.map_range(local_path, offset, size) as data:
+                        if data is None or checksum.calc_checksum(data) != chunk_hash:
+                            data = self.get_chunk(chunk_hash)
+                        if data is None:
+                            logging.error("Can't archive %s v%d, chunk at %d is missing" %
+                                          (file_path, version, offset))
+                            return False
+                        _write_atomically(self._object_path(chunk_hash), data)
+                offset += size
+
+            with self._lock:
+                self._set_manifest(file_path, version, manifest, True)
+        self._save_manifest(file_path, version, manifest, True)
+        filesystem.delete_file(local_path)
+        return True
+
+    def remove_file(self, file_path):
+        '''forgets every version of file_path and deletes the objects no archived version uses any more'''
+        with self._objects_lock:
+            with self._lock:
+                self._load()
+                versions = [v for (path, v) in self._manifests if path == file_path]
+                unused = []
+                for version in versions:
+                    unused.extend(self._drop_manifest(file_path, version))
+            for version in versions:
+                filesystem.delete_file(self._manifest_path(file_path, version))
+            for chunk_hash in unused:
+                filesystem.delete_file(self._object_path(chunk_hash))
+
+    def has_chunk(self, chunk_hash):
+        with self._lock:
+            self._load()
+            if chunk_hash in self._locations:
+                return True
+        return os.path.exists(self._object_path(chunk_hash))
+
+    def get_chunk(self, chunk_hash):
+        '''returns the chunk's data, or None if it isn't stored here'''
+        data = filesystem.read_range(self._object_path(chunk_hash), 0, -1)
+        if data is not None:
+            return data
+
+        with self._lock:
+            self._load()
+            locations = list(self._locations.get(chunk_hash, ()))
+        for file_path, version, offset, size in locations:
+            data = filesystem.read_range(filesystem.get_local_path(self._peer, file_path, version),
+                                         offset, size)
+            # the version file may have been written since its manifest was taken
+            if data is not None and checksum.calc_checksum(data) == chunk_hash:
+                return data
+        return None
+
+    def read_range(self, file_path, version, offset, length):
+        '''returns length bytes of a version starting at offset, rebuilt from its chunks'''
+        manifest = self.manifest(file_path, version)
+        if manifest is None:
+            return None
+        parts = []
+        chunk_start = 0
+        end = offset + length
+        for chunk_hash, size in manifest:
+            chunk_end = chunk_start + size
+            if chunk_end > offset and chunk_start < end:
+                data = self.get_chunk(chunk_hash)
+                if data is None:
+                    return None
+                parts.append(data[max(offset - chunk_start, 0):min(end, chunk_end) - chunk_start])
+            if chunk_end >= end:
+                break
+            chunk_start = chunk_end
+        return "".join(parts)
+
+    def stats(self):
+        '''returns (versions, archived versions, bytes in all versions, bytes in objects)'''
+        with self._lock:
+            self._load()
+            versions = len(self._manifests)
+            archived = len(self._archived)
+            logical = sum(size for manifest in self._manifests.values() for h, size in manifest)
+        stored = 0
+        object_dir = os.path.join(self.path, "objects")
+        if os.path.isdir(object_dir):
+            stored = sum(os.path.getsize(os.path.join(object_dir, name))
+                         for name in os.listdir(object_dir))
+        return versions, archived, logical, stored
+
+    def report(self):
+        versions, archived, logical, stored = self.stats()
+        return ("chunk store: %d versions (%d archived), %d bytes in versions, %d bytes in chunk objects" %
+                (versions, archived, logical, stored))
+
+
+def _write_atomically(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    tmp_path = "%s.%d.tmp" % (path, threading.current_thread().ident)
+    f = open(tmp_path, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+
+def download(store, peer, file_model, manifest, local_path):
+    '''
+    Builds the version described by file_model and manifest at local_path,
+    copying the chunks store already has and fetching the rest from peer.
+    returns the number of bytes fetched, or None if the download failed
+    '''
+    part_file = filesystem.create_part_file(local_path, file_model.size)
+    fetched = 0
+    done = False
+    try:
+        offset = 0
+        i = 0
+        while i < len(manifest):
+            chunk_hash, size = manifest[i]
+            data = store.get_chunk(chunk_hash)
+            if data is not None:
+                part_file.write(data)
+                offset += size
+                i += 1
+                continue
+
+            # fetch this chunk along with the missing ones after it
+            run = [manifest[i]]
+            run_size = size
+            i += 1
+            while (i < len(manifest) and run_size + manifest[i][1] <= MAX_FETCH_SIZE and
+                   not store.has_chunk(manifest[i][0])):
+                run.append(manifest[i])
+                run_size += manifest[i][1]
+                i += 1
+
+            data = _fetch_range(peer, file_model, offset, run_size)
+            if data is None:
+                return None
+            pos = 0
+            for chunk_hash, size in run:
+                if checksum.calc_checksum(data[pos:pos + size]) != chunk_hash:
+                    logging.warning("Bad chunk at %d of %s from %s" % (offset + pos, file_model.path, peer))
+                    return None
+                pos += size
+            part_file.write(data)
+            offset += run_size
+            fetched += run_size
+        done = offset == file_model.size
+    finally:
+        part_file.close()
+        if not done:
+            filesystem.remove_part_file(part_file)
+
+    if not done:
+        return None
+    filesystem.replace_with_part_file(local_path, part_file)
+    return fetched
+
+def _fetch_range(peer, file_model, offset, length):
+    request = messages.FileBlockRequest(file_model.path, file_model.latest_version, offset, length)
+    try:
+        response = communication.request(request, peer, timeout=FETCH_TIMEOUT)
+    except (socket.error, RuntimeError), e:
+        logging.debug("Fetching %d bytes at %d of %s from %s failed: %s" %
+                      (length, offset, file_model.path, peer, e))
+        return None
+    if not isinstance(response, messages.FileBlock) or response.file_model.data is None:
+        return None
+    data = response.file_model.data
+    if len(data) != length:
+        return None
+    return data.tobytes() if isinstance(data, memoryview) else data
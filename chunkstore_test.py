@@ -0,0 +1,100 @@
+"""
+chunkstore_test.py - Test file for chunkstore.py
+"""
+
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import checksum
+import chunkstore
+import filesystem
+
+class FakePeer(object):
+    def __init__(self, root_path):
+        self.root_path = root_path
+
+def test_split():
+    print "Testing split"
+    data = os.urandom(500000)
+    chunks = list(chunkstore.split(StringIO(data)))
+    assert "".join(chunks) == data
+    assert all(len(c) <= chunkstore.MAX_CHUNK_SIZE for c in chunks)
+    assert all(len(c) >= chunkstore.MIN_CHUNK_SIZE for c in chunks[:-1])
+
+    # an insertion only changes the chunk it's in
+    shifted = list(chunkstore.split(StringIO(data[:1000] + "inserted" + data[1000:])))
+    assert len(set(chunks) - set(shifted)) == 1
+
+    # no anchors at all
+    chunks = list(chunkstore.split(StringIO("\x00" * 200000)))
+    assert [len(c) for c in chunks] == [65536, 65536, 65536, 3392]
+
+def test_store():
+    print "Testing store"
+    root = tempfile.mkdtemp()
+    try:
+        peer = FakePeer(root)
+        store = chunkstore.ChunkStore(peer)
+        data = os.urandom(300000)
+        filesystem.write_file(filesystem.get_local_path(peer, "a", 1), data)
+        filesystem.write_file(filesystem.get_local_path(peer, "b", 1), data[:100000] + "b" + data[100000:])
+        manifest = store.add_version("a", 1, filesystem.get_local_path(peer, "a", 1))
+        store.add_version("b", 1, filesystem.get_local_path(peer, "b", 1))
+        assert all(store.has_chunk(chunk_hash) for chunk_hash, size in manifest)
+
+        # archived versions are read back from the objects
+        assert store.archive_version("a", 1)
+        assert not os.path.exists(filesystem.get_local_path(peer, "a", 1))
+        assert store.read_range("a", 1, 1000, 250000) == data[1000:251000]
+        versions, archived, logical, stored = store.stats()
+        assert (versions, archived, logical, stored) == (2, 1, 600001, 300000)
+
+        # manifests are reloaded from disk
+        store = chunkstore.ChunkStore(peer)
+        assert store.manifest("a", 1) == manifest
+
+        # objects another file's archived version uses are kept
+        filesystem.write_file(filesystem.get_local_path(peer, "c", 1), data)
+        assert store.archive_version("c", 1)
+        store.remove_file("a")
+        assert store.manifest("a", 1) is None
+        assert store.read_range("c", 1, 0, 300000) == data
+        store.remove_file("c")
+        assert store.stats()[3] == 0
+    finally:
+        shutil.rmtree(root)
+
+def test_positional_write():
+    print "Testing positional write"
+    root = tempfile.mkdtemp()
+    try:
+        store = chunkstore.ChunkStore(FakePeer(root))
+        local_path = os.path.join(root, "a.1")
+        data = "".join("line %d %s\n" % (i, os.urandom(20).encode("hex")) for i in range(20000))
+        filesystem.write_file(local_path, data)
+        store.add_version("a", 1, local_path)
+
+        for offset, new_data in [(500000, "x" * 100), (0, "y"), (len(data) - 10, "z" * 5000),
+                                 (200000, "w" * 200000)]:
+            old_stamp = checksum.file_stamp(local_path)
+            filesystem.write_file(local_path, new_data, offset)
+            manifest = store.add_version("a", 1, local_path, old_stamp, offset, len(new_data))
+            assert manifest == chunkstore.manifest_of(local_path)
+
+        # without the stamp the manifest was taken for, the file is split again
+        filesystem.write_file(local_path, "v" * 100, 1000)
+        manifest = store.add_version("a", 1, local_path, None, 1000, 100)
+        assert manifest == chunkstore.manifest_of(local_path)
+    finally:
+        shutil.rmtree(root)
+
+def run():
+    test_split()
+    test_store()
+    test_positional_write()
+    print "chunkstore tests passed"
+
+if __name__ == "__main__":
+    run()
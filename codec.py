@@ -0,0 +1,451 @@
+'''
+codec.py - Compact binary encoding for the messages in messages.py
+
+An encoded message is a fixed header, followed by the message's fields
+in the order given by its schema, followed by the raw file data of the
+message's FileModel (if it has any). The file data is kept out of the
+encoded fields so it can be sent and received without being copied
+into them.
+
+    header:  magic (u8), version (u8), msg_type (u8), flags (u8),
+             request id (u32), payload length (u32)
+    text:    u32 length + utf-8 bytes
+    blob:    u32 length + bytes
+    opt_*:   u8 presence flag + the value if present
+
+The payload can be compressed (see compression.py). Bits 1-3 of flags
+hold the compression method id, 0 if the payload is sent as is. Bits 4-6
+hold the id of the method the sender agreed on with the receiver, which
+the receiver uses for its replies on the same connection.
+
+Pickled messages start with the pickle PROTO opcode (0x80), so the magic
+byte tells the two formats apart.
+'''
+
+import struct
+
+import compression
+import messages
+from messages import MessageType, FileModel
+
+MAGIC = 0xD5
+
+# wire version of a peer that only understands pickled messages
+PICKLE_VERSION = 0
+VERSION = 1
+
+FLAG_PAYLOAD = 0x01
+COMPRESSION_SHIFT = 1
+COMPRESSION_MASK = 0x07
+AGREED_COMPRESSION_SHIFT = 4
+
+HEADER = struct.Struct("<BBBBLL")
+_U8 = struct.Struct("<B")
+_U32 = struct.Struct("<L")
+_U64 = struct.Struct("<Q")
+
+
+class CodecError(RuntimeError):
+    pass
+
+
+def _pack_u8(parts, value):
+    parts.append(_U8.pack(value))
+
+def _pack_u32(parts, value):
+    parts.append(_U32.pack(value))
+
+def _pack_u64(parts, value):
+    parts.append(_U64.pack(value))
+
+def _pack_bool(parts, value):
+    parts.append(_U8.pack(1 if value else 0))
+
+def _pack_blob(parts, value):
+    parts.append(_U32.pack(len(value)))
+    parts.append(value)
+
+def _pack_text(parts, value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    _pack_blob(parts, value)
+
+def _pack_opt(pack):
+    def pack_opt(parts, value):
+        if value is None:
+            parts.append(_U8.pack(0))
+        else:
+            parts.append(_U8.pack(1))
+            pack(parts, value)
+    return pack_opt
+
+def _pack_list(pack):
+    def pack_list(parts, values):
+        parts.append(_U32.pack(len(values)))
+        for value in values:
+            pack(parts, value)
+    return pack_list
+
+_pack_opt_u8 = _pack_opt(_pack_u8)
+_pack_opt_u32 = _pack_opt(_pack_u32)
+_pack_opt_u64 = _pack_opt(_pack_u64)
+_pack_opt_blob = _pack_opt(_pack_blob)
+_pack_opt_text = _pack_opt(_pack_text)
+
+def _pack_peer(parts, peer):
+    _pack_text(parts, peer.hostname)
+    _pack_u32(parts, int(peer.port))
+    _pack_opt_text(parts, peer.name)
+    _pack_opt_u8(parts, peer.state)
+
+def _pack_file_model(parts, f):
+    _pack_text(parts, f.path)
+    _pack_bool(parts, f.is_dir)
+    _pack_opt_blob(parts, f.checksum)
+    _pack_opt_u64(parts, f.size)
+    _pack_opt_u32(parts, f.latest_version)
+    _pack_opt_u64(parts, f.parent_id)
+
+
+# unpackers take the buffer and an offset into it and
+# return (value, offset past the value)
+
+def _unpack_u8(buf, pos):
+    return _U8.unpack_from(buf, pos)[0], pos + 1
+
+def _unpack_u32(buf, pos):
+    return _U32.unpack_from(buf, pos)[0], pos + 4
+
+def _unpack_u64(buf, pos):
+    return _U64.unpack_from(buf, pos)[0], pos + 8
+
+def _unpack_bool(buf, pos):
+    return _U8.unpack_from(buf, pos)[0] != 0, pos + 1
+
+def _unpack_blob(buf, pos):
+    start = pos + 4
+    end = start + _U32.unpack_from(buf, pos)[0]
+    if end > len(buf):
+        raise CodecError("truncated message")
+    return buf[start:end], end
+
+def _unpack_text(buf, pos):
+    value, pos = _unpack_blob(buf, pos)
+    try:
+        return value.decode("utf-8"), pos
+    except UnicodeDecodeError, e:
+        raise CodecError("bad text: %s" % e)
+
+def _unpack_opt(unpack):
+    def unpack_opt(buf, pos):
+        present, pos = _unpack_u8(buf, pos)
+        if not present:
+            return None, pos
+        return unpack(buf, pos)
+    return unpack_opt
+
+def _unpack_list(unpack):
+    def unpack_list(buf, pos):
+        count, pos = _unpack_u32(buf, pos)
+        values = []
+        for i in xrange(count):
+            value, pos = unpack(buf, pos)
+            values.append(value)
+        return values, pos
+    return unpack_list
+
+_unpack_opt_u8 = _unpack_opt(_unpack_u8)
+_unpack_opt_u32 = _unpack_opt(_unpack_u32)
+_unpack_opt_u64 = _unpack_opt(_unpack_u64)
+_unpack_opt_blob = _unpack_opt(_unpack_blob)
+_unpack_opt_text = _unpack_opt(_unpack_text)
+
+def _unpack_peer_list(buf, pos):
+    # peer imports communication, which imports this module
+    from peer import Peer
+
+    count, pos = _unpack_u32(buf, pos)
+    peers = []
+    for i in xrange(count):
+        hostname, pos = _unpack_text(buf, pos)
+        port, pos = _unpack_u32(buf, pos)
+        name, pos = _unpack_opt_text(buf, pos)
+        state, pos = _unpack_opt_u8(buf, pos)
+        peers.append(Peer(hostname, port, name, state))
+    return peers, pos
+
+def _unpack_file_model(buf, pos):
+    # inlined, file lists can hold thousands of these
+    start = pos + 4
+    pos = start + _U32.unpack_from(buf, pos)[0]
+    path = buf[start:pos].decode("utf-8")
+    is_dir = buf[pos] != "\x00"
+    pos += 1
+
+    checksum = None
+    if buf[pos] != "\x00":
+        start = pos + 5
+        pos = start + _U32.unpack_from(buf, pos + 1)[0]
+        checksum = buf[start:pos]
+    else:
+        pos += 1
+
+    size = None
+    if buf[pos] != "\x00":
+        size = _U64.unpack_from(buf, pos + 1)[0]
+        pos += 9
+    else:
+        pos += 1
+
+    latest_version = None
+    if buf[pos] != "\x00":
+        latest_version = _U32.unpack_from(buf, pos + 1)[0]
+        pos += 5
+    else:
+        pos += 1
+
+    parent_id = None
+    if buf[pos] != "\x00":
+        parent_id = _U64.unpack_from(buf, pos + 1)[0]
+        pos += 9
+    else:
+        pos += 1
+
+    if pos > len(buf):
+        raise CodecError("truncated message")
+    return FileModel(path, is_dir, checksum, size, latest_version, parent_id), pos
+
+
+def _pack_message_list(parts, msgs):
+    parts.append(_U32.pack(len(msgs)))
+    for msg in msgs:
+        body, payload = encode(msg)
+        if payload is not None:
+            raise CodecError("can't nest a message with file data")
+        _pack_blob(parts, body)
+
+def _unpack_message_list(buf, pos):
+    count, pos = _unpack_u32(buf, pos)
+    msgs = []
+    for i in xrange(count):
+        body, pos = _unpack_blob(buf, pos)
+        msgs.append(decode(body))
+    return msgs, pos
+
+
+FIELD_TYPES = {
+    "u8": (_pack_u8, _unpack_u8),
+    "u32": (_pack_u32, _unpack_u32),
+    "u64": (_pack_u64, _unpack_u64),
+    "bool": (_pack_bool, _unpack_bool),
+    "blob": (_pack_blob, _unpack_blob),
+    "text": (_pack_text, _unpack_text),
+    "opt_u64": (_pack_opt_u64, _unpack_opt_u64),
+    "opt_blob": (_pack_opt_blob, _unpack_opt_blob),
+    "opt_text": (_pack_opt_text, _unpack_opt_text),
+    "text_list": (_pack_list(_pack_text), _unpack_list(_unpack_text)),
+    "blob_list": (_pack_list(_pack_blob), _unpack_list(_unpack_blob)),
+    "u32_list": (_pack_list(_pack_u32), _unpack_list(_unpack_u32)),
+    "file_model": (_pack_file_model, _unpack_file_model),
+    "file_list": (_pack_list(_pack_file_model), _unpack_list(_unpack_file_model)),
+    "peer_list": (_pack_list(_pack_peer), _unpack_peer_list),
+    "message_list": (_pack_message_list, _unpack_message_list),
+}
+
+# msg_type -> (message class, ((attribute, field type), ...))
+SCHEMAS = {
+    MessageType.PEER_LIST_REQUEST: (messages.PeerListRequest, (("file_path", "opt_text"),)),
+    MessageType.PEER_LIST: (messages.PeerList, (("peer_list", "peer_list"),)),
+
+    MessageType.FILE_DOWNLOAD_REQUEST: (messages.FileDownloadRequest, (("file_path", "text"),
+                                                                       ("stream", "bool"))),
+    MessageType.FILE_DOWNLOAD_DECLINE: (messages.FileDownloadDecline, (("file_path", "text"),)),
+    MessageType.FILE_DATA: (messages.FileData, (("file_model", "file_model"),)),
+    MessageType.FILE_STREAM_HEADER: (messages.FileStreamHeader, (("file_model", "file_model"),
+                                                                 ("block_hashes", "blob_list"))),
+
+    MessageType.CONNECT_REQUEST: (messages.ConnectRequest, (("pwd", "text"),
+                                                            ("port", "u32"),
+                                                            ("maxFileSize", "u64"),
+                                                            ("maxFileSysSize", "u64"),
+                                                            ("currFileSysSize", "u64"),
+                                                            ("wire_version", "u8"),
+                                                            ("compression", "text_list"))),
+    MessageType.CONNECT_RESPONSE: (messages.ConnectResponse, (("successful", "bool"),
+                                                              ("wire_version", "u8"),
+                                                              ("compression", "opt_text"))),
+
+    MessageType.DISCONNECT_REQUEST: (messages.DisconnectRequest, (("check_for_unreplicated_files", "bool"),
+                                                                  ("port", "u32"))),
+    MessageType.DISCONNECT_RESPONSE: (messages.DisconnectResponse, (("should_wait", "bool"),)),
+
+    MessageType.FILE_CHANGED: (messages.FileChanged, (("file_model", "file_model"),
+                                                      ("port", "u32"),
+                                                      ("start_offset", "opt_u64"),
+                                                      ("delta", "opt_blob"),
+                                                      ("base_checksum", "opt_blob"))),
+    MessageType.NEW_FILE_AVAILABLE: (messages.NewFileAvailable, (("file_model", "file_model"),
+                                                                 ("port", "u32"))),
+    MessageType.NOTIFICATION_BATCH: (messages.NotificationBatch, (("notifications", "message_list"),)),
+
+    MessageType.FILE_BLOCK_REQUEST: (messages.FileBlockRequest, (("file_path", "text"),
+                                                                 ("version", "u32"),
+                                                                 ("offset", "u64"),
+                                                                 ("length", "u32"))),
+    MessageType.FILE_BLOCK: (messages.FileBlock, (("file_model", "file_model"),
+                                                  ("offset", "u64"))),
+    MessageType.READ_RANGE_REQUEST: (messages.ReadRangeRequest, (("file_path", "text"),
+                                                                 ("offset", "u64"),
+                                                                 ("length", "u32"))),
+    MessageType.BLOCK_HASHES_REQUEST: (messages.BlockHashesRequest, (("file_path", "text"),
+                                                                     ("block_size", "u32"))),
+    MessageType.BLOCK_HASHES: (messages.BlockHashes, (("file_model", "file_model"),
+                                                      ("block_size", "u32"),
+                                                      ("hashes", "blob_list"))),
+
+    MessageType.CHUNK_MANIFEST_REQUEST: (messages.ChunkManifestRequest, (("file_path", "text"),)),
+    MessageType.CHUNK_MANIFEST: (messages.ChunkManifest, (("file_model", "file_model"),
+                                                          ("hashes", "blob_list"),
+                                                          ("sizes", "u32_list"))),
+
+    MessageType.HEARTBEAT: (messages.Heartbeat, (("port", "u32"),)),
+    MessageType.HEARTBEAT_RESPONSE: (messages.HeartbeatResponse, ()),
+
+    MessageType.VALIDATE_CHECKSUM_REQUEST: (messages.ValidateChecksumRequest, (("file_path", "text"),
+                                                                               ("file_checksum", "blob"))),
+    MessageType.VALIDATE_CHECKSUM_RESPONSE: (messages.ValidateChecksumResponse, (("file_path", "text"),
+                                                                                 ("valid", "bool"))),
+
+    MessageType.DELETE_REQUEST: (messages.DeleteRequest, (("file_path", "text"),)),
+    MessageType.DELETE_RESPONSE: (messages.DeleteResponse, (("file_path", "text"),
+                                                            ("can_delete", "bool"),
+                                                            ("peer_list", "peer_list"))),
+    MessageType.DELETE: (messages.Delete, (("file_path", "text"),)),
+
+    MessageType.MOVE_REQUEST: (messages.MoveRequest, (("source_path", "text"),
+                                                      ("dest_path", "text"))),
+    MessageType.MOVE_RESPONSE: (messages.MoveResponse, (("source_path", "text"),
+                                                        ("dest_path", "text"),
+                                                        ("valid", "bool"))),
+    MessageType.MOVE: (messages.Move, (("src_path", "text"),
+                                       ("dest_path", "text"))),
+
+    MessageType.LIST_REQUEST: (messages.ListRequest, (("dir_path", "opt_text"),)),
+    MessageType.LIST: (messages.List, (("file_list", "file_list"),)),
+
+    MessageType.ARCHIVE_REQUEST: (messages.ArchiveRequest, (("file_path", "text"),)),
+    MessageType.ARCHIVE_RESPONSE: (messages.ArchiveResponse, (("file_path", "text"),
+                                                              ("archived", "bool"))),
+    MessageType.FILE_ARCHIVED: (messages.FileArchived, (("file_path", "text"),
+                                                        ("new_version", "u32"))),
+}
+
+
+def encode(msg, compress_with=None):
+    '''
+    returns (body, payload). body holds the header and all of the fields,
+    payload is the FileModel's raw data or None. The frame is body + payload.
+    The payload is compressed with the compress_with method if it's worth it
+    '''
+    schema = SCHEMAS.get(msg.msg_type)
+    if schema is None:
+        raise CodecError("no schema for message type %s" % msg.msg_type)
+
+    parts = [None]
+    payload = None
+    for attr, field_type in schema[1]:
+        value = getattr(msg, attr, None)
+        try:
+            if field_type == "file_model" and value.data is not None:
+                payload = value.data
+            FIELD_TYPES[field_type][0](parts, value)
+        except (struct.error, TypeError, AttributeError), e:
+            raise CodecError("cannot encode %s.%s: %s" % (type(msg).__name__, attr, e))
+
+    flags = 0
+    if compress_with is not None:
+        flags |= compression.METHOD_IDS[compress_with] << AGREED_COMPRESSION_SHIFT
+    payload_len = 0
+    if payload is not None:
+        flags |= FLAG_PAYLOAD
+        payload, method_id = compression.compress(msg.msg_type, payload, compress_with)
+        flags |= method_id << COMPRESSION_SHIFT
+        payload_len = len(payload)
+
+    parts[0] = HEADER.pack(MAGIC, VERSION, msg.msg_type, flags,
+                           getattr(msg, "request_id", 0), payload_len)
+    return "".join(parts), payload
+
+def is_encoded(frame):
+    return len(frame) > 0 and _U8.unpack_from(frame, 0)[0] == MAGIC
+
+def message_type(frame):
+    '''returns the message type of frame, or None if it isn't an encoded message'''
+    if not is_encoded(frame) or len(frame) < HEADER.size:
+        return None
+    return HEADER.unpack_from(frame, 0)[2]
+
+def agreed_compression(frame):
+    '''returns the compression method the sender of frame agreed on with us, or None'''
+    if len(frame) < HEADER.size:
+        return None
+    flags = _U8.unpack_from(frame, 3)[0]
+    return compression.method_name((flags >> AGREED_COMPRESSION_SHIFT) & COMPRESSION_MASK)
+
+def decode(frame):
+    '''
+    Builds a message from a frame made by encode(). frame can be a str,
+    bytearray or memoryview. The file data of the decoded message is a
+    memoryview slice of frame if frame is a memoryview, so it isn't copied
+    unless it was compressed
+    '''
+    if len(frame) < HEADER.size:
+        raise CodecError("truncated message header")
+
+    magic, version, msg_type, flags, request_id, payload_len = HEADER.unpack_from(frame, 0)
+    if magic != MAGIC:
+        raise CodecError("not an encoded message")
+    if version > VERSION:
+        raise CodecError("unsupported wire version %d" % version)
+
+    schema = SCHEMAS.get(msg_type)
+    if schema is None:
+        raise CodecError("no schema for message type %d" % msg_type)
+
+    body_end = len(frame) - payload_len
+    if body_end < HEADER.size:
+        raise CodecError("truncated message")
+    # the fields are small, parse them out of a str. Only the payload is
+    # left in the caller's buffer
+    buf = frame[:body_end]
+    if not isinstance(buf, str):
+        buf = buf.tobytes() if isinstance(buf, memoryview) else str(buf)
+
+    msg_class, fields = schema
+    msg = msg_class.__new__(msg_class)
+    msg.msg_type = msg_type
+    msg.request_id = request_id
+
+    pos = HEADER.size
+    file_model = None
+    try:
+        for attr, field_type in fields:
+            value, pos = FIELD_TYPES[field_type][1](buf, pos)
+            setattr(msg, attr, value)
+            if field_type == "file_model":
+                file_model = value
+    except (struct.error, IndexError), e:
+        raise CodecError("truncated message: " + str(e))
+
+    if pos != body_end:
+        raise CodecError("message length doesn't match its fields")
+
+    if flags & FLAG_PAYLOAD:
+        if file_model is None:
+            raise CodecError("payload sent with a message that has no file")
+        file_model.data = frame[body_end:]
+        method_id = (flags >> COMPRESSION_SHIFT) & COMPRESSION_MASK
+        if method_id:
+            file_model.data = compression.decompress(msg_type, file_model.data, method_id)
+
+    return msg
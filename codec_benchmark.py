@@ -0,0 +1,74 @@
+"""
+codec_benchmark.py - Encode/decode throughput of codec.py against cPickle
+
+Usage: python codec_benchmark.py [seconds per case]
+"""
+
+import sys
+import time
+import cPickle as pickle
+
+import codec
+import messages
+from messages import FileModel
+# peer and tracker import each other, tracker has to go first
+from tracker import Tracker
+from peer import Peer
+
+def make_cases():
+    def file_model(i, data=None):
+        return FileModel("some/dir/file%d.txt" % i, False, "\xab" * 16, 4096 * i, 1, data=data)
+
+    return [
+        ("DeleteRequest", messages.DeleteRequest("some/dir/file.txt")),
+        ("ConnectRequest", messages.ConnectRequest("12345", 11111, 100000000, 1000000000, 0,
+                                                   codec.VERSION)),
+        ("PeerList x50", messages.PeerList([Peer("10.0.0.%d" % i, 11111 + i, "", 1)
+                                             for i in range(50)])),
+        ("List x1000", messages.List([file_model(i) for i in range(1000)])),
+        ("FileData 64KB", messages.FileData(file_model(1, "x" * 65536))),
+        ("FileData 4MB", messages.FileData(file_model(1, "x" * (4 * 2 ** 20)))),
+    ]
+
+def pickle_encode(msg):
+    return pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+
+def codec_encode(msg):
+    # what communication._send puts on the wire, without joining the payload
+    return codec.encode(msg)
+
+def codec_frame(msg):
+    body, payload = codec.encode(msg)
+    return body + (payload or "")
+
+def measure(function, arg, seconds):
+    count = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < seconds:
+        for i in xrange(10):
+            function(arg)
+        count += 10
+        elapsed = time.time() - start
+    return count / elapsed
+
+def run(seconds=0.5):
+    print "%-16s %8s %8s %12s %12s %12s %12s" % ("message", "pickle B", "codec B",
+                                                  "pickle enc/s", "codec enc/s",
+                                                  "pickle dec/s", "codec dec/s")
+    for name, msg in make_cases():
+        pickled = pickle_encode(msg)
+        frame = codec_frame(msg)
+
+        results = (measure(pickle_encode, msg, seconds),
+                   measure(codec_encode, msg, seconds),
+                   measure(pickle.loads, pickled, seconds),
+                   measure(codec.decode, frame, seconds))
+        print "%-16s %8d %8d %12.0f %12.0f %12.0f %12.0f" % ((name, len(pickled), len(frame)) +
+                                                              results)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(float(sys.argv[1]))
+    else:
+        run()
@@ -0,0 +1,240 @@
+"""
+codec_test.py - Test file for codec.py
+"""
+
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import zlib
+import cPickle as pickle
+
+import codec
+import communication
+import compression
+import messages
+from messages import FileModel
+# peer and tracker import each other, tracker has to go first
+from tracker import Tracker
+from peer import Peer
+
+def make_file_model(data=None):
+    return FileModel(path=u"dir/file1.txt",
+                     is_dir=False,
+                     checksum="\x00\x01\xfe\xff" * 4,
+                     size=12345,
+                     latest_version=3,
+                     data=data)
+
+def round_trip(msg):
+    body, payload = codec.encode(msg)
+    frame = body + (payload if payload is not None else "")
+    assert codec.is_encoded(frame)
+    return codec.decode(frame)
+
+def test_control_messages():
+    print "Testing control messages"
+    msg = round_trip(messages.ConnectRequest("12345", 11111, 100, 1000, 0, codec.VERSION))
+    assert isinstance(msg, messages.ConnectRequest)
+    assert (msg.pwd, msg.port, msg.maxFileSize, msg.wire_version) == ("12345", 11111, 100, codec.VERSION)
+
+    request = messages.ListRequest()
+    request.request_id = 0xFFFFFFFF
+    msg = round_trip(request)
+    assert msg.dir_path is None
+    assert msg.request_id == 0xFFFFFFFF
+
+    msg = round_trip(messages.MoveResponse(u"a", u"b\xe9", True))
+    assert (msg.source_path, msg.dest_path, msg.valid) == (u"a", u"b\xe9", True)
+
+    msg = round_trip(messages.PeerList([Peer("127.0.0.1", 11111, "p1", 1), Peer("10.0.0.2", 22, None, None)]))
+    assert [(p.hostname, p.port, p.name, p.state) for p in msg.peer_list] == \
+        [("127.0.0.1", 11111, "p1", 1), ("10.0.0.2", 22, None, None)]
+
+    msg = round_trip(messages.List([make_file_model(), make_file_model()]))
+    assert len(msg.file_list) == 2
+    assert msg.file_list[1].checksum == make_file_model().checksum
+
+def test_file_data_payload():
+    print "Testing file data payload"
+    data = "".join(chr(i % 256) for i in range(100000))
+    body, payload = codec.encode(messages.FileChanged(make_file_model(data), 4444, 17))
+    assert payload is data
+    assert len(body) < 100
+
+    msg = codec.decode(memoryview(bytearray(body + payload)))
+    assert isinstance(msg.file_model.data, memoryview)
+    assert msg.file_model.data.tobytes() == data
+    assert (msg.port, msg.start_offset, msg.file_model.latest_version) == (4444, 17, 3)
+    assert msg.delta is None
+
+    msg = round_trip(messages.FileChanged(make_file_model(), 4444, delta="\x00delta", base_checksum="\xff" * 16))
+    assert (msg.delta, msg.base_checksum, msg.file_model.data) == ("\x00delta", "\xff" * 16, None)
+
+    msg = round_trip(messages.FileData(make_file_model()))
+    assert msg.file_model.data is None
+
+def test_compressed_payload():
+    print "Testing compressed payload"
+    data = "some text that compresses well. " * 4000
+    body, payload = codec.encode(messages.FileData(make_file_model(data)), "zlib")
+    assert len(payload) < len(data) / 10
+    msg = codec.decode(memoryview(bytearray(body + payload)))
+    assert msg.file_model.data == data
+
+    # random data isn't worth compressing and goes out as is
+    data = os.urandom(100000)
+    body, payload = codec.encode(messages.FileData(make_file_model(data)), "bz2")
+    assert payload is data
+
+    msg = round_trip(messages.ConnectRequest("12345", 11111, 100, 1000, 0, codec.VERSION,
+                                             compression.PREFERRED))
+    assert msg.compression == compression.PREFERRED
+    assert compression.choose_method(["bz2", "lzma"]) == "bz2"
+    assert compression.choose_method([]) is None
+
+    # the method agreed on with the receiver is announced for its replies
+    body, payload = codec.encode(messages.FileDownloadRequest(u"f"), "bz2")
+    assert codec.agreed_compression(body) == "bz2"
+    body, payload = codec.encode(messages.FileDownloadRequest(u"f"))
+    assert codec.agreed_compression(body) is None
+
+def test_compressed_replies():
+    print "Testing compressed replies and streams"
+    root = tempfile.mkdtemp()
+    server, client = socket.socketpair()
+    try:
+        # the request tells the server which method to reply with
+        request = messages.FileDownloadRequest(u"f")
+        communication._send(request, client, codec.VERSION, "zlib")
+        communication.recv_message(server)
+        reply = communication.ReplySocket(server, 1, threading.Lock())
+
+        data = "compressible text. " * 20000
+        communication.send_message(messages.FileData(make_file_model(data)), socket=reply)
+        assert communication.recv_message(client).file_model.data == data
+
+        # a stream is compressed until a frame doesn't compress
+        path = os.path.join(root, "f")
+        data = "a" * 200000 + os.urandom(200000) + "b" * 100000
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        sender = threading.Thread(target=communication.send_file_stream, args=(path, reply))
+        sender.start()
+        received = "".join(block.tobytes() for block in communication.recv_stream(client))
+        sender.join()
+        assert received == data
+        # 200000 bytes of "a" in 4 frames, then the first random frame stops compression
+        stats = compression.stats.snapshot()
+        assert stats[(messages.MessageType.FILE_STREAM_HEADER, "in")]["compressed"] == 4
+
+        sender = threading.Thread(target=communication.send_stream, args=(["x" * 5000, "y"], reply))
+        sender.start()
+        assert "".join(block.tobytes() for block in communication.recv_stream(client)) == "x" * 5000 + "y"
+        sender.join()
+    finally:
+        server.close()
+        client.close()
+        shutil.rmtree(root)
+
+def test_decompression_limits():
+    print "Testing decompression limits"
+    data = "\0" * 200000
+    for method in ("zlib", "bz2"):
+        compressed, method_id = compression.compress(messages.MessageType.FILE_DATA, data, method)
+        assert compression.decompress(messages.MessageType.FILE_DATA, compressed, method_id,
+                                      len(data)) == data
+        try:
+            compression.decompress(messages.MessageType.FILE_DATA, compressed, method_id, 1000)
+            assert False, "decompressed past the limit"
+        except RuntimeError:
+            pass
+
+    server, client = socket.socketpair()
+    try:
+        # a stream frame that expands past STREAM_FRAME_SIZE
+        frame = zlib.compress("\0" * (communication.STREAM_FRAME_SIZE + 1))
+        client.sendall(communication._frame_header(len(frame), compression.METHOD_IDS["zlib"]) +
+                       frame)
+        try:
+            list(communication.recv_stream(server))
+            assert False, "took a frame past the limit"
+        except RuntimeError:
+            pass
+
+        # a message longer than MAX_MESSAGE_SIZE isn't read
+        client.sendall(struct.pack(communication.MSGLEN_STRUCT_FORMAT,
+                                   communication.MAX_MESSAGE_SIZE + 1))
+        try:
+            communication.recv_message(server)
+            assert False, "took a message past the limit"
+        except RuntimeError:
+            pass
+    finally:
+        server.close()
+        client.close()
+
+def test_every_message_type_has_a_schema():
+    print "Testing schema coverage"
+    for name, value in vars(messages.MessageType).items():
+        if not name.startswith("_"):
+            assert value in codec.SCHEMAS, name
+
+def test_bad_frames():
+    print "Testing bad frames"
+    assert not codec.is_encoded(pickle.dumps(messages.Delete("x"), pickle.HIGHEST_PROTOCOL))
+
+    body, payload = codec.encode(messages.DeleteRequest(u"some/file"))
+    assert codec.message_type(body) == messages.MessageType.DELETE_REQUEST
+    assert codec.message_type(body[:4]) is None
+    for frame in (body[:-3], body + "extra", body[:4]):
+        try:
+            codec.decode(frame)
+        except codec.CodecError:
+            continue
+        assert False, "decoded a bad frame"
+
+    # text that isn't utf-8
+    body, payload = codec.encode(messages.DeleteRequest(u"\xe9"))
+    try:
+        codec.decode(body.replace("\xc3\xa9", "\xff\xfe"))
+        assert False, "decoded bad text"
+    except codec.CodecError:
+        pass
+
+def test_pickle_refused():
+    print "Testing pickles after the codec"
+    server, client = socket.socketpair()
+    try:
+        # pickles are fine until the connection carries a message in the codec
+        communication._send(messages.DeleteRequest(u"a"), client, codec.PICKLE_VERSION)
+        assert communication.recv_message(server).file_path == u"a"
+        communication._send(messages.DeleteRequest(u"b"), client, codec.VERSION)
+        assert communication.recv_message(server).file_path == u"b"
+        for sender, receiver in ((client, server), (server, client)):
+            communication._send(messages.DeleteRequest(u"c"), sender, codec.PICKLE_VERSION)
+            try:
+                communication.recv_message(receiver)
+                assert False, "accepted a pickle"
+            except codec.CodecError:
+                pass
+    finally:
+        server.close()
+        client.close()
+
+def run():
+    test_control_messages()
+    test_file_data_payload()
+    test_compressed_payload()
+    test_compressed_replies()
+    test_decompression_limits()
+    test_every_message_type_has_a_schema()
+    test_bad_frames()
+    test_pickle_refused()
+    print "codec tests passed"
+
+if __name__ == "__main__":
+    run()
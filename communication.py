@@ -3,76 +3,764 @@ communication.py - Socket communication methods
 
 '''
 
+import os
+import sys
+import errno
 import socket
 import threading
 import struct
+import select
+import time
 import Queue
 import cPickle as pickle
 import logging
+import weakref
+from contextlib import contextmanager
+
+import codec
+import compression
+import instrumentation
+from messages import MessageType
+
+# Largest frame send_file_stream() hands to sendfile() at once
+SENDFILE_FRAME_SIZE = 8 * 2 ** 20
+
+def _load_sendfile():
+    '''
+    returns libc's sendfile(out_fd, in_fd, off64_t *offset, count), or None.
+    Python 2 has no os.sendfile. Only Linux's sendfile has this signature
+    '''
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendfile = getattr(libc, "sendfile64", None) or libc.sendfile
+    except (ImportError, OSError, AttributeError):
+        return None
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                         ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+    return sendfile
+
+_sendfile = _load_sendfile()
 
 # Use a little-endian, unsigned long
 MSGLEN_STRUCT_FORMAT = "<L"
 
+# Largest data frame send_stream() puts on the wire. Bounds the memory
+# used per transfer on both ends
+STREAM_FRAME_SIZE = 65536
+# The top bits of a stream frame's length hold the id of the compression
+# method the frame was compressed with, 0 if it's sent as is
+STREAM_COMPRESSION_SHIFT = 29
+STREAM_LENGTH_MASK = (1 << STREAM_COMPRESSION_SHIFT) - 1
+# Largest message recv_message() takes. A whole file of LocalPeer.MAX_FILE_SIZE
+# in a FileData fits. Decompressed payloads are held to compression.MAX_SIZE
+MAX_MESSAGE_SIZE = 2 ** 27
+
+# newest message encoding we can send and receive (see codec.py)
+WIRE_VERSION = codec.VERSION
+
+# set to False to refuse pickled messages from the network. Either way
+# they're refused on a connection that has carried a message in the codec
+ACCEPT_PICKLE = True
+
+# (hostname, port) -> wire version agreed on with that peer
+_peer_wire_versions = {}
+# (hostname, port) -> compression method agreed on with that peer
+_peer_compression = {}
+# socket -> wire version of the last message received on it, or of the
+# last one sent if that was in the codec. Replies are sent in the same
+# encoding as the request
+_socket_wire_versions = weakref.WeakKeyDictionary()
+# accepted socket -> compression method the other end agreed on with us,
+# as announced in the last message received on it
+_socket_compression = weakref.WeakKeyDictionary()
+_socket_wire_versions_lock = threading.Lock()
+
+
+class ConnectionClosed(RuntimeError):
+    '''Raised when the remote end closes the connection between two messages'''
+    pass
+
+
+class ConnectionPool(object):
+    '''
+    Keeps connections to peers open so they can be reused across messages.
+
+    Connections are keyed by the peer's (hostname, port). A connection is
+    checked out by one thread at a time, and at most max_per_peer connections
+    to the same peer can exist at once. Idle connections are closed after
+    idle_timeout seconds and are health checked before being handed out again.
+    '''
+    MAX_PER_PEER = 4
+    IDLE_TIMEOUT = 60.0
+    CHECKOUT_TIMEOUT = 30.0
+
+    def __init__(self, max_per_peer=MAX_PER_PEER, idle_timeout=IDLE_TIMEOUT,
+                 checkout_timeout=CHECKOUT_TIMEOUT):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = {} # key -> list of (socket, time it was checked in)
+        self._open_count = {} # key -> # of open connections, idle or checked out
+        self._last_sweep = time.time()
+
+    @staticmethod
+    def _key(peer):
+        return (peer.hostname, peer.port)
+
+    def checkout(self, peer):
+        '''
+        returns a connected socket for the exclusive use of the calling thread.
+        It must be given back with checkin() or discard()
+        '''
+        key = self._key(peer)
+        deadline = time.time() + self.checkout_timeout
+
+        with self._cond:
+            self._sweep_if_due()
+            while True:
+                idle = self._idle.get(key)
+                while idle:
+                    sock, last_used = idle.pop()
+                    if _is_healthy(sock):
+                        return sock
+                    logging.debug("Dropping a stale connection to %s:%s", key[0], key[1])
+                    self._close(key, sock)
+
+                if self._open_count.get(key, 0) < self.max_per_peer:
+                    self._open_count[key] = self._open_count.get(key, 0) + 1
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError("Timed out waiting for a connection to %s:%s" % key)
+                self._cond.wait(remaining)
+
+        # connect outside of the lock. The slot is already reserved
+        try:
+            return connect_to_peer(peer)
+        except:
+            with self._cond:
+                self._open_count[key] -= 1
+                self._cond.notify()
+            raise
+
+    def checkin(self, peer, sock):
+        key = self._key(peer)
+        with self._cond:
+            self._idle.setdefault(key, []).append((sock, time.time()))
+            self._cond.notify()
+            self._sweep_if_due()
+
+    def discard(self, peer, sock):
+        key = self._key(peer)
+        with self._cond:
+            self._close(key, sock)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, peer):
+        '''
+        with pool.connection(peer) as sock:
+            ...
+
+        The socket goes back to the pool if the block finishes normally
+        and is closed if it raises.
+        '''
+        sock = self.checkout(peer)
+        try:
+            yield sock
+        except:
+            self.discard(peer, sock)
+            raise
+        else:
+            self.checkin(peer, sock)
+
+    def evict_idle(self):
+        with self._cond:
+            self._evict_idle(time.time())
+
+    def close_all(self):
+        with self._cond:
+            for key, idle in self._idle.items():
+                for sock, last_used in idle:
+                    self._close(key, sock)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    # the following must be called with the lock held
+    def _sweep_if_due(self):
+        now = time.time()
+        if now - self._last_sweep >= self.idle_timeout / 2:
+            self._last_sweep = now
+            self._evict_idle(now)
 
-peer_socket_index = {}
+    def _evict_idle(self, now):
+        for key, idle in self._idle.items():
+            expired = [i for i in idle if now - i[1] >= self.idle_timeout]
+            for item in expired:
+                idle.remove(item)
+                self._close(key, item[0])
+            if not idle:
+                del self._idle[key]
 
-def connect_to_peer(peer):
+    def _close(self, key, sock):
+        self._open_count[key] = self._open_count.get(key, 1) - 1
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+
+def _is_healthy(sock):
+    '''
+    An idle connection shouldn't have anything to read. If it does, the
+    remote end either closed it or is out of sync with us.
+    '''
+    try:
+        readable, writable, errored = select.select([sock], [], [sock], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable and not errored
+
+
+class ReplySocket(object):
+    '''
+    What a handler gets instead of the accepted socket. Messages sent on it
+    carry the id of the request being handled, and a lock shared by all of
+    the connection's handlers keeps their replies from interleaving
+    '''
+    def __init__(self, socket, request_id, send_lock):
+        self.socket = socket
+        self.request_id = request_id
+        self.send_lock = send_lock
+
+    def sendall(self, data):
+        with self.send_lock:
+            self.socket.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+
+class _MultiplexedConnection(object):
+    '''
+    A connection that many threads can have requests in flight on. A
+    reader thread matches responses to requests by their request id
+    '''
+    def __init__(self, peer, on_closed, connect_timeout=None):
+        self.peer = peer
+        self._on_closed = on_closed
+        self._socket = connect_to_peer(peer, connect_timeout)
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._pending = {} # request id -> [event, response, error]
+        self._last_request_id = 0
+        self.closed = False
+
+        reader = threading.Thread(target=self._read_responses,
+                                  name="Mux_%s:%s" % (peer.hostname, peer.port))
+        reader.daemon = True
+        reader.start()
+
+    def request(self, msg, timeout):
+        waiter = [threading.Event(), None, None]
+        with self._lock:
+            if self.closed:
+                raise ConnectionClosed("connection to %s:%s is closed" %
+                                       (self.peer.hostname, self.peer.port))
+            # ids are u32 on the wire. 0 means "not a request"
+            self._last_request_id = self._last_request_id % 0xFFFFFFFF + 1
+            request_id = self._last_request_id
+            self._pending[request_id] = waiter
+
+        msg.request_id = request_id
+        sent_at = time.time()
+        try:
+            with self._send_lock:
+                _send(msg, self._socket, _wire_version(self.peer, None), _compression(self.peer))
+        except:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            self.close()
+            raise
+
+        waiter[0].wait(timeout)
+        with self._lock:
+            self._pending.pop(request_id, None)
+        if waiter[2] is not None:
+            raise waiter[2]
+        if not waiter[0].is_set():
+            raise RuntimeError("no response from %s:%s to %s after %.0f seconds" %
+                               (self.peer.hostname, self.peer.port, msg, timeout))
+        if instrumentation.ENABLED:
+            instrumentation.record_round_trip(msg.msg_type,
+                                              "%s:%s" % (self.peer.hostname, self.peer.port),
+                                              time.time() - sent_at)
+        return waiter[1]
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = self._pending.values()
+            self._pending.clear()
+
+        self._on_closed(self)
+        for waiter in pending:
+            waiter[2] = ConnectionClosed("connection to %s:%s closed" %
+                                         (self.peer.hostname, self.peer.port))
+            waiter[0].set()
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._socket.close()
+
+    def _read_responses(self):
+        try:
+            while True:
+                response = recv_message(self._socket)
+                with self._lock:
+                    waiter = self._pending.get(getattr(response, "request_id", 0))
+                if waiter is None:
+                    logging.warning("Dropping %s, nothing is waiting for it", response)
+                    continue
+                waiter[1] = response
+                waiter[0].set()
+        except (socket.error, RuntimeError), e:
+            logging.debug("Multiplexed connection to %s:%s ended: %s",
+                          self.peer.hostname, self.peer.port, e)
+        finally:
+            self.close()
+
+
+class Multiplexer(object):
     '''
-    returns a socket
+    Sends requests over one long-lived connection per peer. Requests from
+    different threads are pipelined on it instead of each taking a
+    connection for the round trip
     '''
-    peer_socket = socket.create_connection((peer.hostname, peer.port))# tries ipv4 then ipv6 (TCP/IP)
+    REQUEST_TIMEOUT = 60.0
+
+    def __init__(self, request_timeout=REQUEST_TIMEOUT):
+        self.request_timeout = request_timeout
+        self._lock = threading.Lock()
+        self._connections = {} # (hostname, port) -> _MultiplexedConnection
+        # (hostname, port) -> [event, connection, error] of a connect in progress
+        self._connecting = {}
+
+    def request(self, msg, peer, timeout=None):
+        timeout = timeout or self.request_timeout
+        deadline = time.time() + timeout
+        connection = self._connection(peer, timeout)
+        return connection.request(msg, max(deadline - time.time(), 0))
+
+    def _connection(self, peer, timeout):
+        '''
+        returns the connection to peer. Only the first thread to ask for a
+        new one connects, outside of the lock. The others wait for it
+        '''
+        key = (peer.hostname, peer.port)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None:
+                return connection
+            connecting = self._connecting.get(key)
+            waiting = connecting is not None
+            if not waiting:
+                connecting = [threading.Event(), None, None]
+                self._connecting[key] = connecting
+
+        if waiting:
+            connecting[0].wait(timeout)
+            if connecting[2] is not None:
+                raise connecting[2]
+            if connecting[1] is None:
+                raise RuntimeError("timed out connecting to %s:%s" % key)
+            return connecting[1]
+
+        try:
+            connection = _MultiplexedConnection(peer, self._closed, timeout)
+        except (socket.error, RuntimeError), e:
+            connecting[2] = e
+            raise
+        else:
+            connecting[1] = connection
+        finally:
+            with self._lock:
+                del self._connecting[key]
+                if connecting[1] is not None and not connection.closed:
+                    self._connections[key] = connection
+            connecting[0].set()
+        return connection
+
+    def close_all(self):
+        with self._lock:
+            connections = self._connections.values()
+        for connection in connections:
+            connection.close()
+
+    def _closed(self, connection):
+        key = (connection.peer.hostname, connection.peer.port)
+        with self._lock:
+            if self._connections.get(key) is connection:
+                del self._connections[key]
+
+
+pool = ConnectionPool()
+multiplexer = Multiplexer()
+
+def connect_to_peer(peer, timeout=None):
+    '''
+    returns a socket. Raises socket.error if it can't connect within timeout
+    seconds. The socket is blocking either way
+    '''
+    peer_socket = socket.create_connection((peer.hostname, peer.port), timeout)# tries ipv4 then ipv6 (TCP/IP)
+    peer_socket.settimeout(None)
     return peer_socket
 
 
+def set_wire_version(hostname, port, version):
+    '''
+    Records the wire version a peer announced. Messages to that peer use the
+    lower of its version and ours
+    '''
+    _peer_wire_versions[(hostname, port)] = min(version, WIRE_VERSION)
+
+def set_compression(hostname, port, method):
+    '''
+    Records the compression method to use for file data sent to a peer.
+    None turns compression off
+    '''
+    _peer_compression[(hostname, port)] = method
+
+def _compression(peer, socket=None):
+    if peer is not None:
+        return _peer_compression.get((peer.hostname, peer.port))
+    socket = getattr(socket, "socket", socket)
+    with _socket_wire_versions_lock:
+        return _socket_compression.get(socket)
+
+def _wire_version(peer, socket):
+    socket = getattr(socket, "socket", socket)
+    if peer is not None:
+        return _peer_wire_versions.get((peer.hostname, peer.port), codec.PICKLE_VERSION)
+    with _socket_wire_versions_lock:
+        return _socket_wire_versions.get(socket, codec.PICKLE_VERSION)
+
 def send_message(msg, topeer=None, socket=None):
+    '''
+    Sends msg over socket, or over a pooled connection to topeer if no
+    socket is given. The encoding is the one agreed on with topeer, or
+    the one the last message on socket used if topeer isn't known
+    '''
     logging.debug("Sending " + str(msg))
+    version = _wire_version(topeer, socket)
     if socket == None:
-        socket = connect_to_peer(topeer)
-        peer_socket_index[topeer] = socket
-    
-    serial_msg = pickle.dumps(msg, protocol=pickle.HIGHEST_PROTOCOL)
-    msglen_header = struct.pack(MSGLEN_STRUCT_FORMAT, len(serial_msg))
-    
+        with pool.connection(topeer) as peer_socket:
+            _send(msg, peer_socket, version, _compression(topeer))
+    elif isinstance(socket, ReplySocket):
+        msg.request_id = socket.request_id
+        with socket.send_lock:
+            _send(msg, socket.socket, version, _compression(None, socket))
+    else:
+        _send(msg, socket, version, _compression(topeer, socket))
+
+def _peer_label(sock):
+    try:
+        return "%s:%d" % sock.getpeername()[:2]
+    except (socket.error, TypeError):
+        return "?"
+
+def _send(msg, socket, version, compress_with=None):
+    instrumented = instrumentation.ENABLED
+    if instrumented:
+        start = time.time()
+
+    if version >= codec.VERSION:
+        serial_msg, payload = codec.encode(msg, compress_with)
+        # the other end speaks the codec, it has no reason to send pickles
+        with _socket_wire_versions_lock:
+            _socket_wire_versions[socket] = version
+    else:
+        # received file data can be a memoryview, and data read from a
+        # mapped file a buffer, which don't pickle
+        file_model = getattr(msg, "file_model", None)
+        if file_model is not None and isinstance(file_model.data, memoryview):
+            file_model.data = file_model.data.tobytes()
+        elif file_model is not None and isinstance(file_model.data, buffer):
+            file_model.data = str(file_model.data)
+        serial_msg, payload = pickle.dumps(msg, protocol=pickle.HIGHEST_PROTOCOL), None
+
+    msglen = len(serial_msg)
+    if payload is not None:
+        msglen += len(payload)
+    msglen_header = struct.pack(MSGLEN_STRUCT_FORMAT, msglen)
+
+    if instrumented:
+        encoded = time.time()
     try:
         socket.sendall(msglen_header + serial_msg)
+        if payload:
+            # file data goes out as is, without being copied into the message
+            socket.sendall(payload)
     except IOError as e:
         raise RuntimeError("cannot send msg. " + str(e))
 
+    if instrumented:
+        instrumentation.record_sent(msg.msg_type, _peer_label(socket), msglen + 4,
+                                    encoded - start, time.time() - encoded)
+
+def request(msg, topeer, timeout=None):
+    '''
+    Sends msg to topeer and returns the response. Safe to call from many
+    threads at once, the requests share one connection to topeer. Raises
+    RuntimeError if there's no response within timeout seconds
+    '''
+    return multiplexer.request(msg, topeer, timeout)
+
+def recv_into(socket, view):
+    '''
+    Fills the memoryview view with data from socket. returns the number of
+    bytes received, which is less than len(view) only if the connection closed
+    '''
+    size = len(view)
+    received = 0
+    while received < size:
+        count = socket.recv_into(view[received:], size - received)
+        if count == 0:
+            break
+        received += count
+    return received
+
 def recv_bytes(socket, byteCount):
-    msg = ''
-    while len(msg) < byteCount:
-        data = socket.recv(byteCount - len(msg))
-        if data == '' and len(msg) < byteCount:
-            logging.error("socket connection broken")
-            raise RuntimeError("socket connection broken. Received %d out of %d bytes",
-                               len(msg), byteCount)
-        msg = msg + data
+    '''returns a bytearray of exactly byteCount bytes'''
+    msg = bytearray(byteCount)
+    received = recv_into(socket, memoryview(msg))
+    if received < byteCount:
+        logging.error("socket connection broken")
+        raise RuntimeError("socket connection broken. Received %d out of %d bytes" %
+                           (received, byteCount))
     return msg
 
-def recv_message(frompeer=None, socket=None):    
-    if (frompeer == None and socket == None):
-        raise Exception("Must enter a peer or socket to receive a message")    
-    
+def _frame_header(frame_len, method_id=0):
+    return struct.pack(MSGLEN_STRUCT_FORMAT, frame_len | method_id << STREAM_COMPRESSION_SHIFT)
+
+def send_stream(blocks, socket):
+    '''
+    Sends an iterable of data blocks as length prefixed frames, followed by
+    an empty frame to mark the end of the stream. The blocks are compressed
+    with the method agreed on for socket, if there is one
+    '''
+    method = _compression(None, socket)
+    try:
+        for block in blocks:
+            if method is None:
+                if block:
+                    socket.sendall(_frame_header(len(block)) + block)
+                continue
+            # the receiver won't decompress a frame past STREAM_FRAME_SIZE
+            for start in xrange(0, len(block), STREAM_FRAME_SIZE):
+                frame, method_id = compression.compress(
+                    MessageType.FILE_STREAM_HEADER, block[start:start + STREAM_FRAME_SIZE], method)
+                socket.sendall(_frame_header(len(frame), method_id) + frame)
+        socket.sendall(_frame_header(0))
+    except IOError as e:
+        raise RuntimeError("cannot send stream. " + str(e))
+
+def send_file_stream(file_path, socket):
+    '''
+    Sends the contents of file_path in the send_stream() format. The frames
+    are sent with the kernel's sendfile() when we have it, so the file data
+    never enters Python. Falls back to reading the file in blocks otherwise.
+
+    If a compression method is agreed on for socket, frames are compressed
+    until one of them doesn't compress well, and the rest of the file goes
+    out as is
+    '''
+    # frames from one stream must not interleave with replies sent by other handlers
+    send_lock = socket.send_lock if isinstance(socket, ReplySocket) else threading.Lock()
+    method = _compression(None, socket)
+    socket = getattr(socket, "socket", socket)
+
+    f = open(file_path, "rb")
+    try:
+        with send_lock:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            if method is not None:
+                offset = _send_compressed_frames(socket, f, size, method)
+            use_sendfile = _sendfile is not None
+            while offset < size:
+                frame_len = min(SENDFILE_FRAME_SIZE, size - offset)
+                socket.sendall(struct.pack(MSGLEN_STRUCT_FORMAT, frame_len))
+                sent = 0
+                if use_sendfile:
+                    sent = _sendfile_range(socket, f, offset, frame_len)
+                    use_sendfile = sent == frame_len
+                if sent < frame_len:
+                    _copy_range(socket, f, offset + sent, frame_len - sent)
+                offset += frame_len
+            socket.sendall(struct.pack(MSGLEN_STRUCT_FORMAT, 0))
+    except (IOError, OSError) as e:
+        raise RuntimeError("cannot send stream. " + str(e))
+    finally:
+        f.close()
+
+def _send_compressed_frames(socket, f, size, method):
+    '''
+    sends frames of f compressed with method, until one doesn't compress.
+    returns the offset the frames got to
+    '''
+    offset = 0
+    while offset < size:
+        data = f.read(min(STREAM_FRAME_SIZE, size - offset))
+        if not data:
+            raise IOError("%s shrank while it was being sent" % f.name)
+        offset += len(data)
+        data, method_id = compression.compress(MessageType.FILE_STREAM_HEADER, data, method)
+        socket.sendall(_frame_header(len(data), method_id) + data)
+        if not method_id:
+            break
+    return offset
+
+def _sendfile_range(socket, f, offset, count):
+    '''
+    sends count bytes of f from offset with sendfile(). returns the number
+    of bytes sent, which is less than count only if sendfile() doesn't
+    work with this file or socket
+    '''
+    import ctypes
+
+    position = ctypes.c_int64(offset)
+    end = offset + count
+    while position.value < end:
+        sent = _sendfile(socket.fileno(), f.fileno(), ctypes.byref(position),
+                         end - position.value)
+        if sent < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EINTR, errno.EAGAIN):
+                continue
+            if error in (errno.EINVAL, errno.ENOSYS):
+                break
+            raise IOError(error, os.strerror(error))
+        if sent == 0:
+            raise IOError("%s shrank while it was being sent" % f.name)
+    return position.value - offset
+
+def _copy_range(socket, f, offset, count):
+    f.seek(offset)
+    while count > 0:
+        data = f.read(min(count, STREAM_FRAME_SIZE))
+        if not data:
+            raise IOError("%s shrank while it was being sent" % f.name)
+        socket.sendall(data)
+        count -= len(data)
+
+def recv_stream(socket, block_size=STREAM_FRAME_SIZE):
+    '''
+    Generator over the data sent with send_stream(). Yields memoryviews of at
+    most block_size bytes. They all point into the same buffer, so each block
+    is only valid until the next one is requested. The stream has to be
+    consumed completely before the socket can be used for anything else.
+    A timeout set on socket applies to every receive, a sender that
+    stalls raises socket.timeout
+    '''
+    buf = memoryview(bytearray(block_size))
+    while True:
+        header = struct.unpack_from(MSGLEN_STRUCT_FORMAT, recv_bytes(socket, 4))[0]
+        if header == 0:
+            return
+        framelen = header & STREAM_LENGTH_MASK
+        method_id = header >> STREAM_COMPRESSION_SHIFT
+        if method_id:
+            # frames are compressed STREAM_FRAME_SIZE bytes at a time, and
+            # only sent compressed if that made them smaller
+            if framelen > STREAM_FRAME_SIZE:
+                raise RuntimeError("compressed frame of %d bytes" % framelen)
+            data = memoryview(compression.decompress(MessageType.FILE_STREAM_HEADER,
+                                                     recv_bytes(socket, framelen), method_id,
+                                                     STREAM_FRAME_SIZE))
+            for start in xrange(0, len(data), block_size):
+                yield data[start:start + block_size]
+            continue
+
+        while framelen > 0:
+            block = buf[:min(framelen, block_size)]
+            if recv_into(socket, block) < len(block):
+                raise RuntimeError("socket connection broken")
+            framelen -= len(block)
+            yield block
+
+def check_message_length(msglen):
+    '''raises RuntimeError if a message of msglen bytes is too big to take'''
+    if msglen > MAX_MESSAGE_SIZE:
+        raise RuntimeError("refusing a message of %d bytes" % msglen)
+
+def recv_message(socket):
     if socket == None:
-        socket = peer_socket_index.get(frompeer)
-        if socket == None:
-            socket = connect_to_peer(frompeer)
-            peer_socket_index[frompeer] = socket
-      
-    msg = ''
-    msglen_header = recv_bytes(socket, 4)
-
-    if len(msglen_header) != 4:
-        raise Exception("socket closed")
-    
-    msglen = struct.unpack(MSGLEN_STRUCT_FORMAT, msglen_header)[0]
-    
-    while len(msg) < msglen:
-        chunk = socket.recv(msglen-len(msg))
-        if chunk == '':
+        raise Exception("Must enter a socket to receive a message")
+
+    msglen_header = bytearray(4)
+    received = recv_into(socket, memoryview(msglen_header))
+    if received == 0:
+        raise ConnectionClosed("connection closed by peer")
+    if received != 4:
+        raise RuntimeError("socket connection broken")
+
+    msglen = struct.unpack_from(MSGLEN_STRUCT_FORMAT, msglen_header)[0]
+    check_message_length(msglen)
+
+    # one buffer for the whole message, filled in place. File data in
+    # decoded messages is a view into it rather than a copy
+    msg = memoryview(bytearray(msglen))
+    if instrumentation.ENABLED:
+        # the wait for the header isn't counted, the connection may just be idle
+        start = time.time()
+        if recv_into(socket, msg) < msglen:
             raise RuntimeError("socket connection broken")
-        msg += chunk
-    
-    new_msg = pickle.loads(msg)
+        return decode_message(msg, socket, time.time() - start)
+
+    if recv_into(socket, msg) < msglen:
+        raise RuntimeError("socket connection broken")
+    return decode_message(msg, socket)
+
+def decode_message(msg, socket, socket_seconds=None):
+    '''
+    Builds a message from the memoryview msg, which holds one whole message
+    received on socket (without its length header). socket_seconds is how
+    long receiving it took, if known
+    '''
+    instrumented = instrumentation.ENABLED
+    if instrumented:
+        start = time.time()
+
+    agreed = None
+    if codec.is_encoded(msg):
+        new_msg = codec.decode(msg)
+        version = codec.VERSION
+        agreed = codec.agreed_compression(msg)
+    elif ACCEPT_PICKLE and _wire_version(None, socket) < codec.VERSION:
+        new_msg = pickle.loads(msg.tobytes())
+        version = codec.PICKLE_VERSION
+    else:
+        raise codec.CodecError("refusing a pickled message")
+
+    with _socket_wire_versions_lock:
+        _socket_wire_versions[socket] = version
+        _socket_compression[socket] = agreed
+
+    if instrumented:
+        instrumentation.record_received(new_msg.msg_type, _peer_label(socket), len(msg) + 4,
+                                        time.time() - start, socket_seconds)
+
     logging.debug("Received " + str(new_msg))
     return new_msg
@@ -0,0 +1,173 @@
+'''
+compression.py - Compression of file data sent inside messages
+
+Two peers agree on a compression method when they connect (see
+ConnectRequest.compression). The file data of a message is compressed
+only if a sample of it compresses well enough to be worth it. Ratios and
+time spent are kept per message type.
+
+Decompression is bounded: data that would expand past the limit the
+receiver sets (MAX_SIZE for message payloads) is rejected as it's
+decompressed, before the rest of it takes up any memory.
+'''
+
+import bz2
+import logging
+import threading
+import time
+import zlib
+
+import messages
+
+# methods we offer, most preferred first. Their ids go on the wire
+METHOD_IDS = {"zlib": 1, "bz2": 2}
+PREFERRED = ["zlib", "bz2"]
+LEVELS = {"zlib": 6, "bz2": 9}
+
+# payloads smaller than this aren't worth compressing
+MIN_SIZE = 512
+# how much of a payload is compressed to decide whether to compress it all
+SAMPLE_SIZE = 16384
+# skip compression if the sample doesn't shrink below this fraction
+MAX_SAMPLE_RATIO = 0.9
+# largest payload decompress() produces unless it's given a limit
+MAX_SIZE = 2 ** 27
+# bz2 can't stop at a given output size, so compressed data is fed to it in
+# pieces this big and the output checked after each
+BZ2_STEP = 64
+
+
+def _compress(method, data):
+    if method == "zlib":
+        return zlib.compress(data, LEVELS["zlib"])
+    return bz2.compress(data, LEVELS["bz2"])
+
+def _decompress(method, data, max_size):
+    # raises ValueError if data expands to more than max_size bytes
+    if method == "zlib":
+        decompressor = zlib.decompressobj()
+        raw = decompressor.decompress(data, max_size + 1)
+        if len(raw) > max_size:
+            raise ValueError("expands to more than %d bytes" % max_size)
+        return raw + decompressor.flush()
+
+    decompressor = bz2.BZ2Decompressor()
+    parts = []
+    size = 0
+    for start in xrange(0, len(data), BZ2_STEP):
+        try:
+            part = decompressor.decompress(data[start:start + BZ2_STEP])
+        except EOFError:
+            break # data after the end of the stream
+        size += len(part)
+        if size > max_size:
+            raise ValueError("expands to more than %d bytes" % max_size)
+        parts.append(part)
+    return "".join(parts)
+
+_METHOD_NAMES = dict((method_id, name) for name, method_id in METHOD_IDS.items())
+
+def method_name(method_id):
+    '''returns the method with the wire id method_id, or None for 0 or an unknown id'''
+    return _METHOD_NAMES.get(method_id)
+
+
+def choose_method(offered):
+    '''returns the first of our preferred methods that the other end offered, or None'''
+    for method in PREFERRED:
+        if method in (offered or []):
+            return method
+    return None
+
+
+class CompressionStats(object):
+    '''Per message type counters of how compression did'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, msg_type, raw_bytes, wire_bytes, seconds, compressed, direction="out"):
+        with self._lock:
+            stats = self._stats.get((msg_type, direction))
+            if stats is None:
+                stats = {"messages": 0, "compressed": 0, "skipped": 0,
+                         "raw_bytes": 0, "wire_bytes": 0, "seconds": 0.0}
+                self._stats[(msg_type, direction)] = stats
+            stats["messages"] += 1
+            if compressed:
+                stats["compressed"] += 1
+            else:
+                stats["skipped"] += 1
+            stats["raw_bytes"] += raw_bytes
+            stats["wire_bytes"] += wire_bytes
+            stats["seconds"] += seconds
+
+    def snapshot(self):
+        '''returns {(msg_type, "in" or "out"): counters}'''
+        with self._lock:
+            return dict((key, dict(value)) for key, value in self._stats.items())
+
+    def report(self):
+        lines = ["%-20s %4s %8s %8s %12s %12s %7s %9s" % ("message", "dir", "msgs", "skipped",
+                                                          "raw bytes", "wire bytes", "ratio",
+                                                          "time (s)")]
+        for (msg_type, direction), s in sorted(self.snapshot().items()):
+            ratio = float(s["wire_bytes"]) / s["raw_bytes"] if s["raw_bytes"] else 1.0
+            lines.append("%-20s %4s %8d %8d %12d %12d %7.3f %9.3f" %
+                         (messages.type_name(msg_type), direction, s["messages"],
+                          s["skipped"], s["raw_bytes"], s["wire_bytes"], ratio, s["seconds"]))
+        return "\n".join(lines)
+
+stats = CompressionStats()
+
+
+def compress(msg_type, data, method):
+    '''
+    returns (data, method id). The method id is 0 if the data was left
+    as is because it's small or doesn't compress well
+    '''
+    if method is None or len(data) < MIN_SIZE:
+        return data, 0
+
+    start = time.time()
+    if isinstance(data, (memoryview, bytearray)):
+        # zlib only takes strings and read-only buffers
+        data = data.tobytes() if isinstance(data, memoryview) else str(data)
+
+    if len(data) > SAMPLE_SIZE:
+        # sample the start and the middle, headers often compress better than the rest
+        half = SAMPLE_SIZE / 2
+        middle = len(data) / 2
+        sample = data[:half] + data[middle:middle + half]
+        if len(_compress(method, sample)) > MAX_SAMPLE_RATIO * len(sample):
+            stats.record(msg_type, len(data), len(data), time.time() - start, False)
+            return data, 0
+
+    compressed = _compress(method, data)
+    if len(compressed) >= len(data):
+        stats.record(msg_type, len(data), len(data), time.time() - start, False)
+        return data, 0
+
+    stats.record(msg_type, len(data), len(compressed), time.time() - start, True)
+    return compressed, METHOD_IDS[method]
+
+def decompress(msg_type, data, method_id, max_size=MAX_SIZE):
+    '''
+    returns data decompressed with the method with the wire id method_id.
+    Raises RuntimeError if it's damaged or expands to more than max_size bytes
+    '''
+    method = _METHOD_NAMES.get(method_id)
+    if method is None:
+        raise RuntimeError("unknown compression method %d" % method_id)
+
+    start = time.time()
+    if isinstance(data, (memoryview, bytearray)):
+        data = data.tobytes() if isinstance(data, memoryview) else str(data)
+    try:
+        raw = _decompress(method, data, max_size)
+    except (zlib.error, IOError, ValueError), e:
+        raise RuntimeError("cannot decompress file data: " + str(e))
+
+    stats.record(msg_type, len(raw), len(data), time.time() - start, True, direction="in")
+    logging.debug("Decompressed %d bytes to %d with %s", len(data), len(raw), method)
+    return raw
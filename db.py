@@ -7,8 +7,18 @@ import logging
 import Queue
 import threading
 import os.path
+from contextlib import contextmanager
 from messages import FileModel
 
+# the format of the checksums in the Files table, kept as the DB's
+# user_version. 0 was the md5 of the whole file, 1 is the root of the
+# Merkle tree over its blocks (merkle.py)
+CHECKSUM_FORMAT = 1
+
+# queued in place of a statement to end an open transaction
+_COMMIT = ("COMMIT", None, False)
+_ROLLBACK = ("ROLLBACK", None, False)
+
 def wait_for_commit_queue(function):
     """A decorator that waits for the commit queue to be empty, 
         then calls the function
@@ -16,12 +26,14 @@ def wait_for_commit_queue(function):
 
     def wrapper(*args, **kwargs):
         db = args[0]
-        #logging.debug(function.func_name + " - Waiting until the DB Commit queue is empty")
-        db.q.join()
-        #logging.debug("Commit queue is now empty. Executing query")
+        # waits for a transaction of another thread to end
+        with db._transaction_lock:
+            #logging.debug(function.func_name + " - Waiting until the DB Commit queue is empty")
+            db.q.join()
+            #logging.debug("Commit queue is now empty. Executing query")
 
-        return_value = function(*args, **kwargs)
-        return return_value
+            return_value = function(*args, **kwargs)
+            return return_value
         
     return wrapper
 
@@ -39,12 +51,55 @@ class PeerDb(object):
             os.makedirs(db_dirpath)
         
         self.q = Queue.Queue()
+        # held by the thread that has a transaction open, for all of it
+        self._transaction_lock = threading.RLock()
+        self._transaction_depth = 0
+        self._transaction_failed = False
         self.connection = None
         self.cur = None
         self.db_thread = DbThread(self)
         self.db_thread.start()
         self.create_common_tables()
 
+    @contextmanager
+    def transaction(self):
+        '''
+        with db.transaction():
+            ...
+
+        Statements queued in the block are committed together when the
+        outermost block ends, instead of one commit per statement. They're
+        rolled back if an exception leaves any of the blocks. Other threads'
+        DB calls wait for the outermost block to end, so nothing they do is
+        committed or rolled back with it
+        '''
+        with self._transaction_lock:
+            if self._transaction_depth == 0:
+                # statements queued before are committed on their own
+                self.q.join()
+                self._transaction_failed = False
+            self._transaction_depth += 1
+            try:
+                yield
+            except:
+                self._transaction_failed = True
+                raise
+            finally:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self.q.put(_ROLLBACK if self._transaction_failed else _COMMIT)
+                    self.q.join()
+
+    def in_transaction(self):
+        '''True if the calling thread has a transaction open'''
+        with self._transaction_lock:
+            return self._transaction_depth > 0
+
+    def _put(self, statement):
+        '''queues (query, params) to be run by the DbThread'''
+        with self._transaction_lock:
+            self.q.put(statement + (self._transaction_depth > 0,))
+
     @wait_for_commit_queue
     def execute_now(self, query, params=[]):
         with self.dblock:
@@ -73,6 +128,8 @@ class PeerDb(object):
                             "FileName TEXT, IsDirectory INT, " +
                             "GoldenChecksum BLOB, Size INT, LastVersionNumber INT, " +
                             "ParentId INT)", [])
+                # nothing to migrate in a new DB
+                self.set_checksum_format(CHECKSUM_FORMAT)
                 
         with self.connection:
             res = self.excute_now_and_fetch_one("SELECT count(*) FROM sqlite_master WHERE type='table' " +
@@ -90,6 +147,45 @@ class PeerDb(object):
                 logging.info("Creating the LocalPeerFiles table")
                 self.execute_now("CREATE TABLE LocalPeerFiles(FileId INT)", [])
 
+        with self.connection:
+            res = self.excute_now_and_fetch_one("SELECT count(*) FROM sqlite_master WHERE type='table' " +
+                             "AND name='BlockHashes'")
+            if res[0] == 0:
+                # the leaves of each version's Merkle tree (see merkle.py)
+                logging.info("Creating the BlockHashes table")
+                self.execute_now("CREATE TABLE BlockHashes(FileName TEXT, VersionNumber INT, " +
+                            "BlockSize INT, Hashes BLOB, " +
+                            "PRIMARY KEY (FileName, VersionNumber))", [])
+
+        with self.connection:
+            res = self.excute_now_and_fetch_one("SELECT count(*) FROM sqlite_master WHERE type='table' " +
+                             "AND name='LegacyChecksums'")
+            if res[0] == 0:
+                # files whose checksum is still in format 0, see CHECKSUM_FORMAT
+                logging.info("Creating the LegacyChecksums table")
+                self.execute_now("CREATE TABLE LegacyChecksums(FileName TEXT PRIMARY KEY)", [])
+
+    @wait_for_commit_queue
+    def checksum_format(self):
+        '''the CHECKSUM_FORMAT of the checksums stored in the DB'''
+        return self.excute_now_and_fetch_one("PRAGMA user_version")[0]
+
+    def set_checksum_format(self, checksum_format):
+        self._put(("PRAGMA user_version=%d" % checksum_format, []))
+
+    def mark_legacy_checksum(self, file_path):
+        '''records that the checksum stored for file_path is still in format 0'''
+        self._put(("INSERT OR REPLACE INTO LegacyChecksums (FileName) VALUES (?)", [file_path]))
+
+    def clear_legacy_checksum(self, file_path):
+        self._put(("DELETE FROM LegacyChecksums WHERE FileName=?", [file_path]))
+
+    @wait_for_commit_queue
+    def has_legacy_checksum(self, file_path):
+        res = self.excute_now_and_fetch_one("SELECT count(*) FROM LegacyChecksums WHERE FileName=?",
+                                            [file_path])
+        return res[0] > 0
+
     @wait_for_commit_queue
     def list_files(self, path):
         # for now, this just lists all files that the tracker knows about
@@ -129,7 +225,7 @@ class PeerDb(object):
             if not self.check_file_exists_locally(file_name):
                 # add a new entry
                 query = "INSERT INTO LocalPeerFiles (FileId) VALUES (?)"
-                self.q.put((query, [file_id]))
+                self._put((query, [file_id]))
 
     @wait_for_commit_queue
     def check_file_exists_locally(self, file_name):
@@ -160,12 +256,12 @@ class PeerDb(object):
             query = ("INSERT INTO Files " +
                      "(FileName, IsDirectory, Size, GoldenChecksum, LastVersionNumber) " +
                      "VALUES (?, ?, ?, ?, ?)")
-            self.q.put((query, [file_name, is_directory, size, sqlite3.Binary(checksum), last_ver_num]))
+            self._put((query, [file_name, is_directory, size, sqlite3.Binary(checksum), last_ver_num]))
         else:
             # Update existing one
             query = ("UPDATE Files SET FileName=?, IsDirectory=?, Size=?, GoldenChecksum=?, " +
                      "LastVersionNumber=? WHERE Id=?")
-            self.q.put((query, [file_name, is_directory, size, sqlite3.Binary(checksum), last_ver_num, res]))
+            self._put((query, [file_name, is_directory, size, sqlite3.Binary(checksum), last_ver_num, res]))
 
 
     @wait_for_commit_queue        
@@ -176,7 +272,7 @@ class PeerDb(object):
         
         f = file_model
 
-        self.q.put((query, (f.path, 
+        self._put((query, (f.path, 
                             str(f.is_dir),
                             sqlite3.Binary(f.checksum), 
                             f.size,
@@ -192,7 +288,7 @@ class PeerDb(object):
                  "(FileId, VersionNumber, FileSize, Checksum) " +
                  "VALUES (?, ?, ?, ?)")
         
-        self.q.put((query, [file_id, 
+        self._put((query, [file_id, 
                             file_model.latest_version,
                             sqlite3.Binary(file_model.checksum), 
                             file_model.size]
@@ -202,16 +298,35 @@ class PeerDb(object):
     def delete_file(self, file_path):
         query = "DELETE FROM Files WHERE FileName=?"
         
-        self.q.put((query, (file_path,)))
+        self._put((query, (file_path,)))
+        self._put(("DELETE FROM BlockHashes WHERE FileName=?", (file_path,)))
+        self.clear_legacy_checksum(file_path)
+
+    @wait_for_commit_queue
+    def set_block_hashes(self, file_path, version, block_size, hashes):
+        query = ("INSERT OR REPLACE INTO BlockHashes " +
+                 "(FileName, VersionNumber, BlockSize, Hashes) VALUES (?, ?, ?, ?)")
+        self._put((query, [file_path, version, block_size, sqlite3.Binary("".join(hashes))]))
+
+    @wait_for_commit_queue
+    def get_block_hashes(self, file_path, version, block_size):
+        '''returns the block hashes stored for the version, or None'''
+        query = ("SELECT Hashes FROM BlockHashes " +
+                 "WHERE FileName=? AND VersionNumber=? AND BlockSize=?")
+        res = self.excute_now_and_fetch_one(query, [file_path, version, block_size])
+        if res is None:
+            return None
+        hashes = str(res[0])
+        return [hashes[i:i + 16] for i in range(0, len(hashes), 16)]
         
     # Delete everything from the files table and repopulate it with file_list
     @wait_for_commit_queue
     def clear_files_and_add_all(self, file_list):
         logging.debug("Adding a files into the File table")
         query = ("DELETE FROM Files")
-        self.q.put((query, []))
+        self._put((query, []))
         query = ("INSERT INTO Files VALUES (?, ?, ?, ?, ?, ?, ?)")
-        self.q.put((query, file_list))
+        self._put((query, file_list))
     
     @wait_for_commit_queue
     def get_peer_id(self, peer_ip, peer_port):
@@ -238,7 +353,7 @@ class PeerDb(object):
         res = self.get_peer_id(ip, port)
         if res is not None:
             query = ("UPDATE Peers SET state=? WHERE Id=?")
-            self.q.put((query, [state, res]))
+            self._put((query, [state, res]))
 
 class TrackerDb(PeerDb):    
     DB_FILE = "tracker_db.db"
@@ -275,7 +390,7 @@ class TrackerDb(PeerDb):
                              "AND name='PeerExcludedFiles'")
             if res[0] == 0:
                 logging.debug("Creating the PeerExcludedFiles table")
-                self.q.put(("CREATE TABLE PeerExcludedFiles(Id INTEGER PRIMARY KEY AUTOINCREMENT, " +
+                self._put(("CREATE TABLE PeerExcludedFiles(Id INTEGER PRIMARY KEY AUTOINCREMENT, " +
                             "PeerId INT, FileId INT, FileNamePattern TEXT)", []))
     @wait_for_commit_queue            
     def add_or_update_peer(self, ip, port, state, maxFileSize, maxFileSysSize, 
@@ -289,7 +404,7 @@ class TrackerDb(PeerDb):
             if block:
                 self.execute_now(query, [state, maxFileSize, maxFileSysSize, currFileSysSize, name, res])
             else:
-                self.q.put((query, [state, maxFileSize, maxFileSysSize, currFileSysSize, name, res]))
+                self._put((query, [state, maxFileSize, maxFileSysSize, currFileSysSize, name, res]))
         else:
             query = ("INSERT INTO Peers " +
                      "(Name, Ip, Port, State, MaxFileSize, MaxFileSysSize, CurrFileSysSize) " +
@@ -299,7 +414,7 @@ class TrackerDb(PeerDb):
                 self.execute_now(query, [name, ip, port, state, maxFileSize,
                                          maxFileSysSize, currFileSysSize])
             else:
-                self.q.put((query, [name, ip, port, state, maxFileSize,
+                self._put((query, [name, ip, port, state, maxFileSize,
                                     maxFileSysSize, currFileSysSize]))
 
     @wait_for_commit_queue
@@ -369,12 +484,12 @@ class TrackerDb(PeerDb):
             query = ("INSERT INTO PeerFile (FileId, PeerId, Checksum, PendingUpdate) " +
                      "VALUES (?, ?, ?, ?)")
             # TODO add pending update
-            self.q.put((query, [file_id, peer_id, sqlite3.Binary(file_model.checksum), 0]))
+            self._put((query, [file_id, peer_id, sqlite3.Binary(file_model.checksum), 0]))
         else:
             query = ("UPDATE PeerFile SET FileId=?, PeerId=?, Checksum=?, PendingUpdate=? " +
                      "WHERE Id=?")
             # TODO add pending update
-            self.q.put((query, [file_id, peer_id, sqlite3.Binary(file_model.checksum), 0, res[0]]))
+            self._put((query, [file_id, peer_id, sqlite3.Binary(file_model.checksum), 0, res[0]]))
     
     @wait_for_commit_queue
     def get_peers_to_replicate_file(self, file_model, peer_ip, peer_port, max_replication):
@@ -465,11 +580,11 @@ class LocalPeerDb(PeerDb):
     @wait_for_commit_queue
     def clear_peers_and_insert(self, peers_list):
         query = "DELETE FROM Peers"
-        self.q.put((query, []))
+        self._put((query, []))
         
         for p in peers_list:
             query = "INSERT INTO Peers (Name, Ip, Port, State) VALUES (?, ?, ?, ?)"
-            self.q.put((query, (p.name, p.hostname, p.port, p.state)))
+            self._put((query, (p.name, p.hostname, p.port, p.state)))
         
     @wait_for_commit_queue
     def get_peers(self):
@@ -489,13 +604,13 @@ class LocalPeerDb(PeerDb):
         # peer already exists. Update it, else make a new entry
         if res is not None:
             query = ("UPDATE Peers SET state=?, name=? WHERE Id=?")
-            self.q.put((query, [state, name, res]))
+            self._put((query, [state, name, res]))
         else:
             query = ("INSERT INTO Peers " +
                      "(Name, Ip, Port, State) " +
                      "VALUES (?, ?, ?, ?)")
             
-            self.q.put((query, [name, ip, port, state]))
+            self._put((query, [name, ip, port, state]))
 
 
 
@@ -527,6 +642,17 @@ class DbThread(threading.Thread):
         logging.debug("Spawned a Database Thread")
         while self.alive.is_set():
             item = self.db.q.get(block=True)
+            if item is _COMMIT or item is _ROLLBACK:
+                with self.db.dblock:
+                    if item is _COMMIT:
+                        logging.debug("Committing a transaction")
+                        self.db.connection.commit()
+                    else:
+                        logging.warning("Rolling back a transaction")
+                        self.db.connection.rollback()
+                self.db.q.task_done()
+                continue
+
             logging.debug("Performing a db statement: " + item[0] + " " + str(item[1]))
             #with self.db.connection:
             
@@ -538,7 +664,9 @@ class DbThread(threading.Thread):
                 else:
                     with self.db.dblock:
                         self.db.cur.execute(item[0], item[1])
-                self.db.connection.commit()
+                # statements queued in a transaction wait for its _COMMIT
+                if not item[2]:
+                    self.db.connection.commit()
                 self.db.q.task_done()
                 success = True
                 
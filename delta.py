@@ -0,0 +1,241 @@
+'''
+delta.py - rsync style deltas between two versions of a file
+
+signature() takes an adler32 weak checksum and an md5 of every block of
+the version the replicas have. compute() slides a block sized window over
+the new version, rolling the weak checksum along one byte at a time and
+confirming weak matches with md5, and describes the new version as runs of
+base blocks to copy with literal data in between. apply() rebuilds the new
+version from a replica's copy of the base version and the delta.
+
+The rolling loop runs in Python and takes about a second per 3MB of
+literal data. Before it starts, compute() looks for short probes taken
+from a few of the base blocks in the new version with bytearray.find(),
+and gives up if too few of them are there for the delta to pay off.
+
+A delta is a block size followed by a list of ops:
+    "C" first block (u32), block count (u32)
+    "L" length (u32), then length bytes of literal data
+'''
+
+import math
+import os
+import struct
+import zlib
+
+import checksum
+import filesystem
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 65536
+# smaller files are always sent whole
+MIN_FILE_SIZE = 64 * 1024
+# past this fraction of literal data a delta isn't worth building and
+# patching, the new version is sent whole
+MAX_LITERAL_RATIO = 0.5
+
+# probes of PROBE_SIZE bytes are taken from PROBES blocks of the base version
+PROBES = 16
+PROBE_SIZE = 64
+
+_ADLER_MOD = 65521
+_HEADER = struct.Struct(">L")
+_COPY = struct.Struct(">cLL")
+_LITERAL = struct.Struct(">cL")
+_COPY_CHUNK = 2 ** 20
+
+
+class DeltaError(RuntimeError):
+    pass
+
+
+class Signature(object):
+    def __init__(self, size, block_size, weak, strong, probes=None):
+        self.size = size
+        self.block_size = block_size
+        self.weak = weak # adler32 of each block
+        self.strong = strong # md5 of each block
+        # the first PROBE_SIZE bytes of evenly spaced whole blocks
+        self.probes = probes or []
+
+
+def block_size_for(size):
+    '''about sqrt(size), like rsync, so bigger files have fewer, bigger blocks'''
+    return max(MIN_BLOCK_SIZE, min(int(math.sqrt(size)) & ~1023, MAX_BLOCK_SIZE))
+
+def _adler32(data):
+    return zlib.adler32(data) & 0xffffffff
+
+def signature(file_path, block_size=None):
+    size = os.path.getsize(file_path)
+    if block_size is None:
+        block_size = block_size_for(size)
+    weak = []
+    strong = []
+    probes = []
+    whole_blocks = size // block_size
+    step = max(whole_blocks // PROBES, 1)
+    for index, block in enumerate(filesystem.read_blocks(file_path, block_size)):
+        weak.append(_adler32(block))
+        strong.append(checksum.calc_checksum(block))
+        if index < whole_blocks and index % step == 0 and len(probes) < PROBES:
+            probes.append(block[:PROBE_SIZE])
+    return Signature(size, block_size, weak, strong, probes)
+
+def _worth_scanning(sig, buf, max_literal):
+    '''
+    False if so few of sig's probes are in buf that more than max_literal
+    bytes of it would have to be sent as literals. Stops looking as soon
+    as the answer is known
+    '''
+    probes = len(sig.probes)
+    if probes == 0:
+        return True
+    # each probe stands for an equal share of the base version's whole blocks
+    share = float(sig.size // sig.block_size * sig.block_size) / probes
+    found = missed = 0
+    for probe in sig.probes:
+        if buf.find(probe) >= 0:
+            found += 1
+        else:
+            missed += 1
+        if len(buf) - (probes - missed) * share > max_literal:
+            return False
+        if len(buf) - found * share <= max_literal:
+            return True
+    return True
+
+
+class _DeltaWriter(object):
+    def __init__(self, block_size):
+        self.parts = [_HEADER.pack(block_size)]
+        self.literal_bytes = 0
+        self._run = None # [first block, count] of the copy op being built
+
+    def copy(self, index):
+        if self._run is not None and self._run[0] + self._run[1] == index:
+            self._run[1] += 1
+        else:
+            self._end_run()
+            self._run = [index, 1]
+
+    def literal(self, data):
+        if not data:
+            return
+        self._end_run()
+        self.parts.append(_LITERAL.pack("L", len(data)))
+        self.parts.append(data)
+        self.literal_bytes += len(data)
+
+    def _end_run(self):
+        if self._run is not None:
+            self.parts.append(_COPY.pack("C", *self._run))
+            self._run = None
+
+    def getvalue(self):
+        self._end_run()
+        return "".join(self.parts)
+
+
+def compute(sig, data):
+    '''
+    returns the delta that turns the version described by sig into data,
+    or None if it would carry more than MAX_LITERAL_RATIO of data as literals
+    '''
+    block_size = sig.block_size
+    max_literal = int(len(data) * MAX_LITERAL_RATIO)
+
+    # only whole blocks are looked up while rolling, a short last block can
+    # only match the end of data
+    table = {}
+    for index in range(sig.size // block_size):
+        table.setdefault(sig.weak[index], []).append(index)
+
+    buf = bytearray(data)
+    if not _worth_scanning(sig, buf, max_literal):
+        return None
+
+    out = _DeltaWriter(block_size)
+    n = len(data)
+    pos = 0
+    literal_start = 0
+    weak = None
+    while pos + block_size <= n:
+        if weak is None:
+            weak = _adler32(data[pos:pos + block_size])
+            a = weak & 0xffff
+            b = weak >> 16
+
+        candidates = table.get(weak)
+        if candidates is not None:
+            strong = checksum.calc_checksum(data[pos:pos + block_size])
+            matches = [index for index in candidates if sig.strong[index] == strong]
+            if matches:
+                out.literal(data[literal_start:pos])
+                out.copy(matches[0])
+                pos += block_size
+                literal_start = pos
+                weak = None
+                continue
+
+        if pos - literal_start + out.literal_bytes > max_literal:
+            return None
+
+        # roll the window forward by one byte
+        if pos + block_size < n:
+            removed = buf[pos]
+            a = (a - removed + buf[pos + block_size]) % _ADLER_MOD
+            b = (b - block_size * removed + a - 1) % _ADLER_MOD
+            weak = (b << 16) | a
+        pos += 1
+
+    tail = sig.size % block_size
+    if (tail and n - literal_start >= tail and
+        checksum.calc_checksum(data[n - tail:]) == sig.strong[-1]):
+        out.literal(data[literal_start:n - tail])
+        out.copy(len(sig.strong) - 1)
+    else:
+        out.literal(data[literal_start:])
+
+    if out.literal_bytes > max_literal:
+        return None
+    return out.getvalue()
+
+def apply(base_path, delta):
+    '''generator over the contents of the new version, built from the base version at base_path'''
+    if len(delta) < _HEADER.size:
+        raise DeltaError("truncated delta")
+    block_size = _HEADER.unpack_from(delta, 0)[0]
+    pos = _HEADER.size
+
+    base = open(base_path, "rb")
+    try:
+        while pos < len(delta):
+            op = delta[pos]
+            if op == "C":
+                if pos + _COPY.size > len(delta):
+                    raise DeltaError("truncated delta")
+                first, count = _COPY.unpack_from(delta, pos)[1:]
+                pos += _COPY.size
+                base.seek(first * block_size)
+                # the last block of the base version can be short
+                remaining = count * block_size
+                while remaining:
+                    chunk = base.read(min(remaining, _COPY_CHUNK))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            elif op == "L":
+                if pos + _LITERAL.size > len(delta):
+                    raise DeltaError("truncated delta")
+                length = _LITERAL.unpack_from(delta, pos)[1]
+                pos += _LITERAL.size
+                if pos + length > len(delta):
+                    raise DeltaError("truncated delta")
+                yield delta[pos:pos + length]
+                pos += length
+            else:
+                raise DeltaError("unknown delta op %r" % op)
+    finally:
+        base.close()
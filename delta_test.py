@@ -0,0 +1,90 @@
+"""
+delta_test.py - Test file for delta.py
+"""
+
+import os
+import tempfile
+
+import delta
+
+def patch(base, new):
+    '''returns (delta, rebuilt new version) for base and new'''
+    fd, base_path = tempfile.mkstemp()
+    os.write(fd, base)
+    os.close(fd)
+    try:
+        d = delta.compute(delta.signature(base_path), new)
+        if d is None:
+            return None, None
+        return d, "".join(str(chunk) for chunk in delta.apply(base_path, d))
+    finally:
+        os.remove(base_path)
+
+def test_rolling_checksum():
+    print "Testing rolling checksum"
+    # an insertion shifts every block after it, they're found by rolling
+    base = os.urandom(300000)
+    new = base[:1000] + "inserted" + base[1000:]
+    d, rebuilt = patch(base, new)
+    assert rebuilt == new
+    assert len(d) < delta.block_size_for(len(base)) * 2
+
+def test_small_edits():
+    print "Testing small edits"
+    base = os.urandom(200003) # short last block
+    new = base[:50000] + "x" + base[50001:150000] + base[150100:]
+    d, rebuilt = patch(base, new)
+    assert rebuilt == new
+    assert len(d) < len(new) / 10
+
+    # appended data
+    d, rebuilt = patch(base, base + "more")
+    assert rebuilt == base + "more"
+
+    d, rebuilt = patch(base, base)
+    assert rebuilt == base
+    assert len(d) < 100
+
+def test_large_delta():
+    print "Testing large delta"
+    base = os.urandom(100000)
+    assert patch(base, os.urandom(100000)) == (None, None)
+
+    # unrelated data is turned down by the probes, before the rolling scan
+    fd, base_path = tempfile.mkstemp()
+    os.write(fd, os.urandom(2 ** 20))
+    os.close(fd)
+    try:
+        sig = delta.signature(base_path)
+        base = open(base_path, "rb").read()
+        assert len(sig.probes) == delta.PROBES
+        assert not delta._worth_scanning(sig, bytearray(os.urandom(2 ** 20)), 2 ** 19)
+        assert delta._worth_scanning(sig, bytearray("x" + base), 2 ** 19)
+        assert not delta._worth_scanning(sig, bytearray(base[:2 ** 18] + os.urandom(3 * 2 ** 18)),
+                                         2 ** 19)
+    finally:
+        os.remove(base_path)
+
+def test_bad_delta():
+    print "Testing bad delta"
+    base = os.urandom(100000)
+    d, rebuilt = patch(base, base[:500] + base[600:])
+    fd, base_path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        list(delta.apply(base_path, d[:-1]))
+        assert False
+    except delta.DeltaError:
+        pass
+    finally:
+        os.remove(base_path)
+
+def run():
+    test_rolling_checksum()
+    test_small_edits()
+    test_large_delta()
+    test_bad_delta()
+    print "delta tests passed"
+
+if __name__ == "__main__":
+    run()
@@ -13,6 +13,8 @@ import sys
 import re
 import os.path
 import filesystem
+import compression
+import instrumentation
 
 local_peer = None
 
@@ -41,6 +43,9 @@ def disconnect(check_for_unreplicated_files=True):
 def add_file(src_file_path, dest_file_path):
     return local_peer.add_file(src_file_path, dest_file_path)
 
+def import_tree(src_root, dest_root="", progress=None):
+    return local_peer.import_tree(src_root, dest_root, progress=progress)
+
 # File Operations
 def read(file_path, start_offset=None, length=None):
     # query the tracker for the peers with this file_path
@@ -67,9 +72,18 @@ def archive(file_path=None):
 
 def write_cli(path):
     logging.debug("Asking the local peer to write")
-    data = filesystem.read_file(path)
+    # a file outside the DFS, read without mapping it
+    data = filesystem.read_range(path, 0, -1)
     local_peer.write(path, data)
 
+def import_cli(src_root, dest_root):
+    logging.debug("Asking the local peer to import " + src_root)
+    def show(bulk_import):
+        print bulk_import.report()
+    bulk_import = import_tree(src_root, dest_root, progress=show)
+    for error in bulk_import.errors:
+        print "Failed: " + error
+
 
 def main():
     parser = OptionParser()
@@ -83,6 +97,10 @@ def main():
                       help="External IP address of this peer.")
     parser.add_option("-p", "--port", action="store", dest="port",
                       help="Start a tracker on the current system.")
+    parser.add_option("-e", "--engine", action="store", dest="engine", default="threads",
+                      help="Server engine, 'threads' or 'eventloop'.")
+    parser.add_option("--storage", action="store", dest="storage", default="files",
+                      help="Storage engine, 'files' or 'chunks'.")
     parser.add_option('-v', '--verbose', action="store_true", dest="verbose",
                       help='Enable verbose output.')
 
@@ -95,6 +113,16 @@ def main():
     if options.verbose is None:
         logging.disable(logging.CRITICAL)
 
+    if options.engine not in ("threads", "eventloop"):
+        print "Unknown engine " + options.engine
+        sys.exit()
+    LocalPeer.SERVER_ENGINE = options.engine
+
+    if options.storage not in ("files", "chunks"):
+        print "Unknown storage engine " + options.storage
+        sys.exit()
+    LocalPeer.STORAGE_ENGINE = options.storage
+
     if options.tracker:
         # iniitialize the tracker
         if options.port is None or options.self_ip is None:
@@ -121,6 +149,12 @@ def main():
                 print "File doesn't exist"
                 continue
             write_cli(f)
+        elif re.match(r'import', inp):
+            args = inp.split()[1:]
+            if not args or not os.path.isdir(args[0]):
+                print "You must enter a directory to import"
+                continue
+            import_cli(args[0], args[1] if len(args) > 1 else "")
         elif re.match(r'disco', inp):
             local_peer.disconnect()
         elif re.match(r'conn', inp):
@@ -130,6 +164,27 @@ def main():
         elif re.match(r'ls', inp):
             for f in local_peer.ls():
                 print "%s\n\tSize: %d LastVer: %d" % (f.path, f.size, f.latest_version)
+        elif re.match(r'wire', inp):
+            m = re.search(r'\s(type|peer|both)', inp)
+            print instrumentation.report(m.group(1) if m else "type")
+        elif re.match(r'sync', inp):
+            if re.search(r'\swait', inp):
+                local_peer.sync.wait()
+            print local_peer.sync.report()
+            print local_peer.journal.report()
+        elif re.match(r'stats', inp):
+            print compression.stats.report()
+            print local_peer.worker_pool.report()
+            print local_peer.read_cache.report()
+            print local_peer.range_cache.report()
+            print filesystem.mappings.report()
+            if local_peer.hasher is not None:
+                print local_peer.hasher.report()
+            print local_peer.replicas.report()
+            print local_peer.sync.report()
+            print local_peer.journal.report()
+            if local_peer.chunks is not None:
+                print local_peer.chunks.report()
         elif re.match(r'arch', inp):
             m = re.search(r'\s[^\s]+', inp)
             if m is None:
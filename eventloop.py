@@ -0,0 +1,191 @@
+'''
+eventloop.py - select() based server engine
+
+One thread waits on the server socket and every accepted connection at
+once, and reads whole messages off the connections as data arrives.
+Decoding a message (decompressing its data included) and handling it,
+with any disk or DB work the handler does, runs on the peer's worker
+pool (see workers.py), so the number of threads doesn't grow with the
+number of connections or messages. The loop only reads the message type
+from the header, to pick the worker lane. Pickled messages from peers
+that predate the codec have to be decoded for that, which is done on the
+loop.
+'''
+
+import errno
+import logging
+import select
+import socket
+import struct
+import threading
+
+import codec
+import communication
+import workers
+
+# read without blocking, even though the sockets stay in blocking mode for
+# the workers that send replies on them
+_RECV_FLAGS = getattr(socket, "MSG_DONTWAIT", 0)
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class _Connection(object):
+    '''Read state of one accepted connection'''
+    def __init__(self, pool, sock):
+        self.socket = sock
+        self.send_lock = threading.Lock()
+        # messages waiting for room in their worker lane. The connection
+        # isn't read from while it's full
+        self.held = workers.HeldMessages(pool)
+        self._header = bytearray(4)
+        self._body = None
+        self._received = 0
+
+    def read(self):
+        '''
+        Reads everything the socket has for us. returns a list of the
+        messages (memoryviews) completed by this read. Raises ConnectionClosed
+        when the remote end has closed the connection
+        '''
+        messages = []
+        while True:
+            target = memoryview(self._header) if self._body is None else self._body
+            try:
+                count = self.socket.recv_into(target[self._received:],
+                                              len(target) - self._received, _RECV_FLAGS)
+            except socket.error, e:
+                if e.errno in _WOULD_BLOCK:
+                    return messages
+                raise
+            if count == 0:
+                if self._received or self._body is not None:
+                    raise RuntimeError("socket connection broken")
+                raise communication.ConnectionClosed("connection closed by peer")
+
+            self._received += count
+            if self._received < len(target):
+                if not _RECV_FLAGS:
+                    # recv would block on the next call, wait for select
+                    return messages
+                continue
+
+            self._received = 0
+            if self._body is None:
+                msglen = struct.unpack_from(communication.MSGLEN_STRUCT_FORMAT, self._header)[0]
+                communication.check_message_length(msglen)
+                self._body = memoryview(bytearray(msglen))
+                if msglen > 0:
+                    if not _RECV_FLAGS:
+                        return messages
+                    continue
+            messages.append(self._body)
+            self._body = None
+            if not _RECV_FLAGS:
+                return messages
+
+
+class EventLoopServer(threading.Thread):
+    '''
+    Drop-in replacement for AcceptorThread. Accepts connections and reads
+    messages off all of them on this thread, handlers run on the peer's
+    worker pool
+    '''
+    SELECT_TIMEOUT = 0.5
+    # how often held messages are retried
+    RETRY_INTERVAL = 0.01
+
+    def __init__(self, peer):
+        super(EventLoopServer, self).__init__()
+        self.name = type(peer).__name__ + "_EventLoop"
+        self._peer = peer
+        self._connections = {} # socket -> _Connection
+        self.stop = False
+
+        self.alive = threading.Event()
+        self.alive.set()
+        # terminate this thread when the main thread exits
+        self.daemon = True
+
+    def run(self):
+        server_socket = self._peer.get_server_socket()
+        try:
+            while self.alive.is_set() and not self.stop:
+                held = self._retry_held()
+                sockets = [server_socket] + [sock for sock, connection in self._connections.items()
+                                             if not connection.held.full()]
+                timeout = self.RETRY_INTERVAL if held else self.SELECT_TIMEOUT
+                try:
+                    readable, writable, errored = select.select(sockets, [], [], timeout)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for sock in readable:
+                    if sock is server_socket:
+                        client_socket, addr = server_socket.accept()
+                        self._connections[client_socket] = _Connection(self._peer.worker_pool,
+                                                                       client_socket)
+                    else:
+                        self._read(self._connections[sock])
+        finally:
+            for connection in self._connections.values():
+                self._close(connection)
+
+    def join(self, timeout=None):
+        logging.debug("Ending thread")
+        self.alive.clear()
+        threading.Thread.join(self, timeout)
+
+    def _read(self, connection):
+        try:
+            for frame in connection.read():
+                msg_type = codec.message_type(frame)
+                if msg_type is None:
+                    # pickled, its type is only known once it's decoded
+                    received_msg = communication.decode_message(frame, connection.socket)
+                    connection.held.submit(workers.lane_of(received_msg.msg_type),
+                                           self._handle, connection, received_msg)
+                else:
+                    connection.held.submit(workers.lane_of(msg_type),
+                                           self._decode_and_handle, connection, frame)
+        except communication.ConnectionClosed:
+            self._close(connection)
+        except (socket.error, RuntimeError), e:
+            logging.debug("Connection dropped: " + str(e))
+            self._close(connection)
+
+    def _close(self, connection):
+        self._connections.pop(connection.socket, None)
+        try:
+            connection.socket.close()
+        except socket.error:
+            pass
+
+    def _decode_and_handle(self, connection, frame):
+        # on a worker
+        try:
+            received_msg = communication.decode_message(frame, connection.socket)
+        except RuntimeError, e:
+            logging.debug("Dropping the connection, bad message: " + str(e))
+            # the loop sees the end of the connection and closes it
+            try:
+                connection.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            return
+        self._handle(connection, received_msg)
+
+    def _handle(self, connection, received_msg):
+        reply_socket = communication.ReplySocket(connection.socket,
+                                                 getattr(received_msg, "request_id", 0),
+                                                 connection.send_lock)
+        self._peer.handle_message(reply_socket, received_msg)
+
+    def _retry_held(self):
+        '''returns True if messages are still held after the retry'''
+        held = False
+        for connection in self._connections.values():
+            if connection.held.retry():
+                held = True
+        return held
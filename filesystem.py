@@ -1,44 +1,385 @@
-from threading import Lock
+from threading import Condition, Lock
+import collections
+import mmap
 import os
+import tempfile
 
 lock = Lock()
 
+# mkstemp() makes files only their owner can read
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Version files are read through memory mappings that are shared by every
+# reader until the file is written (see MappedFiles). Python 2's mmap
+# can't back a memoryview, so map_range() hands out buffer() slices of the
+# mapping, which hashlib, zlib and sockets take without a copy.
+#
+# A buffer is handed out in a Lease, which the caller releases once it's
+# done with the data. A mapping stays valid as long as a buffer refers to
+# it, even after it's dropped from the cache. Shrinking a mapped file in
+# place would leave those buffers pointing past its end (SIGBUS), so files
+# are only ever replaced by renaming a new file over them, or grown in
+# place. They're only overwritten in place while no lease on them is held,
+# or the data already handed out would change under its readers. A lease
+# that's never released only costs that: the file is replaced on every
+# write from then on
+MAX_MAPPINGS = 64
+
+
+class MappedFiles(object):
+    def __init__(self, max_mappings=MAX_MAPPINGS):
+        self.max_mappings = max_mappings
+        self._lock = Lock()
+        self._mappings = collections.OrderedDict() # file path -> (stat stamp, mmap), LRU first
+        # file path -> leases held on mappings of it, old ones included
+        self._leases = collections.defaultdict(int)
+        # files being written in place, and the number of mappings being made of each
+        self._writing = set()
+        self._opening = collections.defaultdict(int)
+        self._changed = Condition(self._lock)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, file_path):
+        '''
+        returns a read-only mmap of file_path, or None if it doesn't exist
+        or is empty. Unless it's None, the mapping is leased: release()
+        has to be called once nothing refers to it any more
+        '''
+        with self._lock:
+            while file_path in self._writing:
+                self._changed.wait()
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return None
+            stamp = (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+            entry = self._mappings.pop(file_path, None)
+            if entry is not None and entry[0] == stamp:
+                self._mappings[file_path] = entry
+                self.hits += 1
+                self._leases[file_path] += 1
+                return entry[1]
+            if st.st_size == 0:
+                return None
+            # begin_write() waits for it
+            self._opening[file_path] += 1
+
+        m = None
+        try:
+            try:
+                f = open(file_path, "rb")
+            except IOError:
+                return None
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        finally:
+            with self._lock:
+                self._opening[file_path] -= 1
+                if not self._opening[file_path]:
+                    del self._opening[file_path]
+                    self._changed.notify_all()
+                if m is not None:
+                    self.misses += 1
+                    self._leases[file_path] += 1
+                    self._mappings[file_path] = (stamp, m)
+                    while len(self._mappings) > self.max_mappings:
+                        # unmapped once the last buffer over it is gone
+                        self._mappings.popitem(last=False)
+        return m
+
+    def release(self, file_path):
+        '''gives back a lease taken by get()'''
+        with self._lock:
+            self._leases[file_path] -= 1
+            if self._leases[file_path] <= 0:
+                del self._leases[file_path]
+
+    def leases(self, file_path):
+        with self._lock:
+            return self._leases.get(file_path, 0)
+
+    def invalidate(self, file_path):
+        with self._lock:
+            if self._mappings.pop(file_path, None) is not None:
+                self.invalidations += 1
+
+    def begin_write(self, file_path):
+        '''
+        returns True if file_path can be written in place, as no lease on
+        a mapping of it is held. Until end_write() is called it isn't mapped
+        again. returns False if the file should be replaced instead
+        '''
+        with self._lock:
+            while self._opening.get(file_path) or file_path in self._writing:
+                self._changed.wait()
+            if self._mappings.pop(file_path, None) is not None:
+                self.invalidations += 1
+            if self._leases.get(file_path):
+                return False
+            self._writing.add(file_path)
+            return True
+
+    def end_write(self, file_path):
+        with self._lock:
+            self._writing.discard(file_path)
+            self._changed.notify_all()
+
+    def report(self):
+        with self._lock:
+            return ("mapped files: %d mapped, %d hits, %d misses, %d invalidations" %
+                    (len(self._mappings), self.hits, self.misses, self.invalidations))
+
+
+class Lease(object):
+    '''
+    data is a read-only buffer over part of a file's mapping (see
+    map_range()), or None. The file isn't overwritten in place until the
+    lease is released. Used as a context manager, it gives data and
+    releases the lease on the way out
+    '''
+    def __init__(self, data, file_path=None, files=None):
+        self.data = data
+        self._file_path = file_path
+        self._files = files
+
+    def release(self):
+        files, self._files = self._files, None
+        if files is not None:
+            files.release(self._file_path)
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+mappings = MappedFiles()
+
+
+def temp_file(file_path, suffix=".part"):
+    '''
+    returns a new, empty file object next to file_path, to be renamed over
+    it once it's written. Its name is unique, so writers of the same file
+    never share one
+    '''
+    file_dir = os.path.dirname(file_path)
+    if file_dir and not os.path.isdir(file_dir):
+        try:
+            os.makedirs(file_dir)
+        except OSError:
+            if not os.path.isdir(file_dir):
+                raise
+    fd, tmp_path = tempfile.mkstemp(suffix, os.path.basename(file_path) + ".", file_dir or ".")
+    os.fchmod(fd, 0666 & ~_UMASK)
+    os.close(fd)
+    # opened again by name, an fdopen()ed file has no name
+    return open(tmp_path, "wb")
+
+def _replace(file_path, blocks):
+    # must be called with lock held. Readers, and buffers over a mapping
+    # of the old file, keep seeing the old contents
+    f = temp_file(file_path, ".tmp")
+    try:
+        for block in blocks:
+            f.write(block)
+    except:
+        f.close()
+        os.remove(f.name)
+        raise
+    f.close()
+    os.rename(f.name, file_path)
+
+def _read_part(file_path, size, offset=0, block_size=2 ** 20):
+    # size bytes of file_path from offset, a block at a time
+    f = open(file_path, "rb")
+    try:
+        f.seek(offset)
+        while size > 0:
+            data = f.read(min(block_size, size))
+            if not data:
+                break
+            size -= len(data)
+            yield data
+    finally:
+        f.close()
+
+def _spliced(file_path, file_data, start_offset, block_size=2 ** 20):
+    # the contents of file_path with file_data written at start_offset
+    size = os.path.getsize(file_path)
+    for block in _read_part(file_path, min(size, start_offset)):
+        yield block
+    for gap in xrange(size, start_offset, block_size):
+        yield "\0" * min(block_size, start_offset - gap)
+    yield file_data
+    end = start_offset + len(file_data)
+    for block in _read_part(file_path, size - end, end):
+        yield block
+
 def write_file(file_path, file_data, start_offset=None):
     with lock:
         file_dir = os.path.dirname(file_path)
         if not os.path.exists(file_dir):
             os.makedirs(file_dir)
-        
-        if start_offset == None:
-            start_offset = 0
-        
-        f = open(file_path, "w")
-        f.seek(start_offset)
-        f.write(str(file_data))
-
-def read_file(file_path, start_offset=None, length=-1):    
-    if not os.path.exists(file_path):
-        return None
-    
-    f = open(file_path, "r")
-    if start_offset:
-        f.seek(start_offset)
+
+        if not isinstance(file_data, (str, bytearray, memoryview, buffer)):
+            file_data = str(file_data)
+        # without an offset the file is replaced, with one the data is
+        # written over that part of the file in place, zero filled up to
+        # the offset if the file is new. Buffers are written straight from
+        # the receive buffer
+        if start_offset is None:
+            mappings.invalidate(file_path)
+            _replace(file_path, [file_data])
+            return
+        if not os.path.exists(file_path):
+            mappings.invalidate(file_path)
+            f = open(file_path, "wb")
+        elif mappings.begin_write(file_path):
+            try:
+                f = open(file_path, "r+b")
+            except:
+                mappings.end_write(file_path)
+                raise
+        else:
+            # a lease on a mapping of it is held, for a reply being sent
+            # say, so the write goes to a copy that replaces it
+            _replace(file_path, _spliced(file_path, file_data, start_offset))
+            return
+        try:
+            f.seek(start_offset)
+            f.write(file_data)
+        finally:
+            f.close()
+            mappings.end_write(file_path)
+
+def truncate(file_path, size):
+    with lock:
+        mappings.invalidate(file_path)
+        if size < os.path.getsize(file_path):
+            # the file may be mapped, so it's replaced rather than shrunk
+            _replace(file_path, _read_part(file_path, size))
+            return
+        f = open(file_path, "r+b")
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+
+def read_file(file_path, start_offset=None, length=-1):
+    '''
+    returns length bytes of the version file at file_path from
+    start_offset (all of it by default), or None if it doesn't exist.
+    They're copied once, out of the file's shared mapping
+    '''
+    with map_range(file_path, start_offset or 0, length) as data:
+        return None if data is None else str(data)
     
-    data = f.read(length)
+
+def read_blocks(file_path, block_size):
+    '''Generator over the contents of file_path, block_size bytes at a time'''
+    f = open(file_path, "rb")
+    try:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+def write_blocks(file_path, blocks):
+    '''
+    Writes an iterable of data blocks to file_path. The blocks go to a
+    temporary file which replaces file_path once all of them are written,
+    so readers never see a partial file
+    '''
+    f = temp_file(file_path)
+    try:
+        for block in blocks:
+            f.write(block)
+    except:
+        f.close()
+        os.remove(f.name)
+        raise
     f.close()
-    return data
-    
+
+    with lock:
+        mappings.invalidate(file_path)
+        os.rename(f.name, file_path)
+
+def create_part_file(file_path, size):
+    '''
+    returns a file object for a temporary file that replace_with_part_file()
+    moves to file_path, already extended to size bytes
+    '''
+    f = temp_file(file_path)
+    f.truncate(size)
+    return f
+
+def replace_with_part_file(file_path, part_file):
+    with lock:
+        mappings.invalidate(file_path)
+        os.rename(part_file.name, file_path)
+
+def remove_part_file(part_file):
+    if os.path.exists(part_file.name):
+        os.remove(part_file.name)
+
+def read_range(file_path, offset, length):
+    '''returns length bytes of file_path starting at offset, or None if it doesn't exist'''
+    if not os.path.exists(file_path):
+        return None
+    f = open(file_path, "rb")
+    try:
+        f.seek(offset)
+        return f.read(length)
+    finally:
+        f.close()
+
+def map_range(file_path, offset=0, length=-1):
+    '''
+    returns a Lease on length bytes of file_path from offset (the rest of
+    the file if length is negative), mapped rather than copied. Its data
+    is None if the file doesn't exist
+    '''
+    m = mappings.get(file_path)
+    if m is None:
+        return Lease(buffer("") if os.path.exists(file_path) else None)
+    end = len(m) if length is None or length < 0 else min(len(m), offset + length)
+    return Lease(buffer(m, offset, max(end - offset, 0)), file_path, mappings)
+
+def map_blocks(file_path, block_size):
+    '''
+    Like read_blocks(), but yields buffers over a mapping of the file. The
+    mapping is leased until the generator is exhausted or closed
+    '''
+    m = mappings.get(file_path)
+    if m is None:
+        return
+    try:
+        for offset in xrange(0, len(m), block_size):
+            yield buffer(m, offset, block_size)
+    finally:
+        mappings.release(file_path)
 
 def delete_file(file_path):
     if not os.path.exists(file_path):
         return
     
+    mappings.invalidate(file_path)
     os.remove(file_path)
 
 def move(src_path, dest_path):
     if not os.path.exists(src_path):
         return
     
+    mappings.invalidate(src_path)
+    mappings.invalidate(dest_path)
     os.renames(src_path, dest_path)
 
 def get_local_path(peer, file_path, version=None):
@@ -0,0 +1,141 @@
+"""
+filesystem_test.py - Test file for the mapped reads in filesystem.py
+"""
+
+import os
+import shutil
+import tempfile
+
+import filesystem
+
+def mapped(path, offset=0, length=-1):
+    with filesystem.map_range(path, offset, length) as data:
+        return None if data is None else str(data)
+
+def test_map_range():
+    print "Testing map_range"
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, "f.1")
+        data = os.urandom(300000)
+        filesystem.write_file(path, data)
+        assert mapped(path) == data
+        assert mapped(path, 1000, 50) == data[1000:1050]
+        assert mapped(path, 299990, 50) == data[299990:]
+        assert mapped(path, 400000, 50) == ""
+        assert mapped(os.path.join(root, "missing")) is None
+
+        blocks = [str(b) for b in filesystem.map_blocks(path, 2 ** 16)]
+        assert len(blocks) == 5 and "".join(blocks) == data
+
+        filesystem.write_file(path, "")
+        assert mapped(path) == ""
+        assert list(filesystem.map_blocks(path, 2 ** 16)) == []
+        # every lease was given back
+        assert filesystem.mappings.leases(path) == 0
+    finally:
+        shutil.rmtree(root)
+
+def test_invalidation():
+    print "Testing invalidation"
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, "f.1")
+        mappings = filesystem.mappings
+        filesystem.write_file(path, "a" * 100000)
+        mapped(path)
+        hits = mappings.hits
+        old = filesystem.map_range(path, 0, 10)
+        assert mappings.hits == hits + 1
+
+        # a replaced file is mapped again, leased buffers over the old one still work
+        filesystem.write_file(path, "b" * 50000)
+        assert mapped(path, 0, 10) == "b" * 10
+        assert str(old.data) == "a" * 10
+
+        # written in place once no lease is held
+        old.release()
+        inode = os.stat(path).st_ino
+        filesystem.write_file(path, "cc", 10)
+        assert mapped(path, 9, 4) == "bccb"
+        assert os.stat(path).st_ino == inode
+
+        # replaced while a lease covers the range
+        old = filesystem.map_range(path, 9, 4)
+        filesystem.write_file(path, "dd", 10)
+        assert str(old.data) == "bccb"
+        assert filesystem.read_file(path, 9, 4) == "bddb"
+        assert os.stat(path).st_ino != inode
+        assert os.path.getsize(path) == 50000
+        filesystem.write_file(path, "e", 50005)
+        assert filesystem.read_file(path, 49999) == "b\0\0\0\0\0e"
+        old.release()
+        old.release() # only given back once
+        assert mappings.leases(path) == 0
+
+        # a lease on a mapping that's not cached any more still counts
+        old = filesystem.map_range(path, 0, 10)
+        mappings.invalidate(path)
+        inode = os.stat(path).st_ino
+        filesystem.write_file(path, "f", 0)
+        assert os.stat(path).st_ino != inode and str(old.data) == "b" * 10
+        old.release()
+
+        # shrunk, the old mapping stays readable
+        with filesystem.map_range(path, 40000, 10) as data:
+            filesystem.truncate(path, 20000)
+            assert len(mapped(path)) == 20000
+            assert str(data) == "b" * 10
+        filesystem.truncate(path, 30000)
+        assert mapped(path, 19999, 2) == "b\0"
+
+        # a new file written at an offset is zero filled up to it
+        new_path = os.path.join(root, "new.1")
+        filesystem.write_file(new_path, "abc", 10)
+        assert open(new_path, "rb").read() == "\0" * 10 + "abc"
+
+        filesystem.move(path, path + ".moved")
+        assert mapped(path) is None
+        assert len(mapped(path + ".moved")) == 30000
+    finally:
+        shutil.rmtree(root)
+
+def test_part_files():
+    print "Testing part files"
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, "sub", "f.1")
+        # two downloads of the same version don't share a temporary file
+        first = filesystem.create_part_file(path, 10)
+        second = filesystem.create_part_file(path, 5)
+        assert first.name != second.name
+        first.write("a" * 10)
+        second.write("b" * 5)
+        first.close()
+        second.close()
+        filesystem.replace_with_part_file(path, first)
+        assert open(path, "rb").read() == "a" * 10
+        filesystem.remove_part_file(second)
+        assert os.listdir(os.path.dirname(path)) == ["f.1"]
+
+        def failing():
+            yield "x"
+            raise IOError("connection lost")
+        try:
+            filesystem.write_blocks(path, failing())
+            assert False
+        except IOError:
+            pass
+        assert os.listdir(os.path.dirname(path)) == ["f.1"]
+        assert open(path, "rb").read() == "a" * 10
+    finally:
+        shutil.rmtree(root)
+
+def run():
+    test_map_range()
+    test_invalidation()
+    test_part_files()
+    print "filesystem tests passed"
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,218 @@
+'''
+hashing.py - Hashing files on a pool of worker processes
+
+A HashingService splits a file into parts of PART_BLOCKS blocks and hashes
+the parts on its process pool, so a large file is hashed on every core and
+the peer's handler threads don't wait on each other for the GIL. Many
+files can be queued at once. Every call returns a Future right away;
+result() waits for it.
+
+Files smaller than MIN_PARALLEL_SIZE are hashed in the calling thread, a
+round trip to the pool costs more than hashing them. So is everything
+while the pool isn't running. start() has to be called before the process
+opens any socket: the workers inherit every descriptor that is open when
+they are forked, and live as long as the pool. A listening socket kept
+open by a worker can't be bound again, and a connection it holds is never
+closed. For the same reason the pool is forked only once: after close()
+start() does nothing and the service hashes inline.
+
+The service is shared by every peer in the process (see shared()). Peers
+acquire() it when they start and release() it when they stop, the pool is
+closed when the last one does.
+'''
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import checksum
+import merkle
+
+PROCESSES = multiprocessing.cpu_count()
+PART_BLOCKS = 8
+MIN_PARALLEL_SIZE = 4 * checksum.BLOCK_SIZE
+
+
+def hash_part(file_path, offset, count, block_size):
+    '''the md5s of up to count blocks of file_path from offset. Runs in a worker process'''
+    hashes = []
+    f = open(file_path, "rb")
+    try:
+        f.seek(offset)
+        for i in xrange(count):
+            data = f.read(block_size)
+            if not data:
+                break
+            hashes.append(hashlib.md5(data).digest())
+    finally:
+        f.close()
+    return hashes
+
+
+class _Done(object):
+    # a part that was computed in the calling thread
+    def __init__(self, value=None, error=None):
+        self._value = value
+        self._error = error
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class Future(object):
+    '''
+    The result of a hashing job, after concurrent.futures.Future. It's
+    made of parts computed by the pool, which combine() puts together
+    '''
+    def __init__(self, parts, combine):
+        self._parts = parts
+        self._combine = combine
+
+    def done(self):
+        return all(part.ready() for part in self._parts)
+
+    def result(self, timeout=None):
+        '''
+        waits for the result. Raises multiprocessing.TimeoutError after
+        timeout seconds, or whatever hashing the file raised
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        values = []
+        for part in self._parts:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            # AsyncResult.get() can't be interrupted without a timeout
+            values.append(part.get(remaining if remaining is not None else 1e9))
+        return self._combine(values)
+
+    # so a Future can be a part of another one
+    ready = done
+    get = result
+
+
+class HashingService(object):
+    def __init__(self, processes=PROCESSES, part_blocks=PART_BLOCKS,
+                 min_parallel_size=MIN_PARALLEL_SIZE):
+        self.processes = processes
+        self.part_blocks = part_blocks
+        self.min_parallel_size = min_parallel_size
+        self._lock = threading.Lock()
+        self._pool = None
+        self._started = False
+        self._users = 0
+        self.files = 0
+        self.parallel_files = 0
+        self.bytes = 0
+
+    def start(self):
+        '''
+        forks the worker processes, unless they were forked before or
+        there's only one core
+        '''
+        with self._lock:
+            if not self._started and self.processes >= 2:
+                logging.info("Starting %d hashing processes" % self.processes)
+                self._pool = multiprocessing.Pool(self.processes)
+                self._started = True
+
+    def acquire(self):
+        '''starts the pool for a new user of the service, see start()'''
+        with self._lock:
+            self._users += 1
+        self.start()
+
+    def release(self):
+        '''a user is done with the service, the last one closes the pool'''
+        with self._lock:
+            self._users -= 1
+            last = self._users == 0
+        if last:
+            self.close()
+
+    def _get_pool(self):
+        with self._lock:
+            return self._pool
+
+    def imap_unordered(self, function, tasks, chunksize=1):
+        '''
+        runs function(task) for every task on the pool, see Pool.imap_unordered().
+        returns None if the pool isn't running
+        '''
+        pool = self._get_pool()
+        if pool is None:
+            return None
+        try:
+            return pool.imap_unordered(function, tasks, chunksize)
+        except ValueError:
+            return None # closed meanwhile
+
+    def hash_blocks(self, file_path, block_size=checksum.BLOCK_SIZE):
+        '''returns a Future for the md5s of the block_size blocks of file_path'''
+        try:
+            size = os.path.getsize(file_path)
+        except OSError, e:
+            return Future([_Done(error=e)], lambda values: values[0])
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+        pool = self._get_pool() if size >= self.min_parallel_size else None
+        if pool is not None:
+            part_size = self.part_blocks * block_size
+            try:
+                parts = [pool.apply_async(hash_part,
+                                          (file_path, offset, self.part_blocks, block_size))
+                         for offset in xrange(0, size, part_size)]
+            except ValueError:
+                pass # closed meanwhile
+            else:
+                with self._lock:
+                    self.parallel_files += 1
+                return Future(parts, lambda values: [h for hashes in values for h in hashes])
+
+        try:
+            part = _Done(checksum.calc_block_hashes(file_path, block_size))
+        except (IOError, OSError), e:
+            part = _Done(error=e)
+        return Future([part], lambda values: values[0])
+
+    def file_checksum(self, file_path):
+        '''returns a Future for checksum.calc_file_checksum(file_path)'''
+        future = self.hash_blocks(file_path)
+        return Future([future], lambda values: merkle.root(values[0]))
+
+    def hash_files(self, file_paths):
+        '''returns {file path: Future for its checksum}. All of the files are hashed at once'''
+        return dict((file_path, self.file_checksum(file_path)) for file_path in file_paths)
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def report(self):
+        with self._lock:
+            return ("hashing: %d processes (%s), %d files, %d on the pool, %.1f MB" %
+                    (self.processes, "running" if self._pool is not None else "not running",
+                     self.files, self.parallel_files, self.bytes / 2.0 ** 20))
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared():
+    '''the HashingService shared by every peer in this process'''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = HashingService()
+        return _shared
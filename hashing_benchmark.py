@@ -0,0 +1,75 @@
+"""
+hashing_benchmark.py - Hashing throughput of hashing.py for 1 to N processes
+
+Hashes one large file, then many medium sized ones, with the serial
+checksum.calc_block_hashes and with a HashingService of each size.
+
+Usage: python hashing_benchmark.py [MB per case] [max processes]
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import checksum
+import hashing
+
+def make_files(root, mb):
+    big = os.path.join(root, "big")
+    f = open(big, "wb")
+    for i in range(mb):
+        f.write(os.urandom(2 ** 20))
+    f.close()
+
+    small = []
+    for i in range(max(mb / 8, 1)):
+        path = os.path.join(root, "small%d" % i)
+        f = open(path, "wb")
+        f.write(os.urandom(8 * 2 ** 20))
+        f.close()
+        small.append(path)
+    return big, small
+
+def measure(function):
+    start = time.time()
+    function()
+    return time.time() - start
+
+def run(mb=256, max_processes=None):
+    max_processes = max_processes or multiprocessing.cpu_count()
+    root = tempfile.mkdtemp()
+    try:
+        big, small = make_files(root, mb)
+        small_mb = 8 * len(small)
+        # read once so every case starts from the page cache
+        checksum.calc_block_hashes(big)
+        for path in small:
+            checksum.calc_block_hashes(path)
+
+        print "%d cores" % multiprocessing.cpu_count()
+        print "%-12s %16s %16s" % ("processes", "1 file MB/s", "many files MB/s")
+        serial_big = measure(lambda: checksum.calc_block_hashes(big))
+        serial_small = measure(lambda: [checksum.calc_block_hashes(path) for path in small])
+        print "%-12s %16.1f %16.1f" % ("serial", mb / serial_big, small_mb / serial_small)
+
+        processes = 1
+        while processes <= max_processes:
+            service = hashing.HashingService(processes=processes, min_parallel_size=0)
+            # start the pool outside of the measurement
+            service.start()
+            service.hash_blocks(small[0]).result()
+            big_time = measure(lambda: service.hash_blocks(big).result())
+            small_time = measure(lambda: [future.result() for future
+                                          in service.hash_files(small).values()])
+            service.close()
+            print "%-12d %16.1f %16.1f" % (processes, mb / big_time, small_mb / small_time)
+            processes *= 2
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 256,
+        int(sys.argv[2]) if len(sys.argv) > 2 else None)
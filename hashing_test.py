@@ -0,0 +1,118 @@
+"""
+hashing_test.py - Test file for hashing.py
+"""
+
+import os
+import shutil
+import tempfile
+
+import checksum
+import filesystem
+import hashing
+
+def write(root, name, size):
+    path = os.path.join(root, name)
+    filesystem.write_file(path, os.urandom(size))
+    return path
+
+def test_parallel():
+    print "Testing parallel hashing"
+    root = tempfile.mkdtemp()
+    service = hashing.HashingService(processes=2, part_blocks=3, min_parallel_size=1000)
+    service.start()
+    try:
+        bs = 1000
+        for size in (0, 999, 3000, 3001, 17500):
+            path = write(root, "f%d" % size, size)
+            future = service.hash_blocks(path, bs)
+            assert future.result(timeout=30) == checksum.calc_block_hashes(path, bs)
+            assert future.done()
+
+        paths = [write(root, "g%d" % i, 3 * checksum.BLOCK_SIZE + i) for i in range(4)]
+        futures = service.hash_files(paths)
+        for path in paths:
+            assert futures[path].result() == checksum.calc_file_checksum(path)
+
+        try:
+            service.hash_blocks(os.path.join(root, "missing")).result()
+            assert False
+        except OSError:
+            pass
+        assert service.parallel_files == 7
+    finally:
+        service.close()
+        shutil.rmtree(root)
+
+def test_inline():
+    print "Testing inline hashing"
+    root = tempfile.mkdtemp()
+    service = hashing.HashingService(processes=2)
+    try:
+        path = write(root, "small", 5000)
+        assert service.file_checksum(path).result() == checksum.calc_file_checksum(path)
+        assert service.parallel_files == 0 and "not running" in service.report()
+
+        # without a pool, big files are hashed here too
+        path = write(root, "big", 5 * checksum.BLOCK_SIZE)
+        assert service.file_checksum(path).result() == checksum.calc_file_checksum(path)
+        assert service.imap_unordered(len, ["a"]) is None
+        service.start()
+        assert list(service.imap_unordered(len, ["a", "bc"])) in ([1, 2], [2, 1])
+        service.close()
+        assert service.file_checksum(path).result() == checksum.calc_file_checksum(path)
+        assert service.parallel_files == 0
+        # the pool isn't forked again once it was closed
+        service.start()
+        assert service.imap_unordered(len, ["a"]) is None
+    finally:
+        service.close()
+        shutil.rmtree(root)
+
+def test_block_hashes():
+    print "Testing BlockHashes with a hasher"
+    root = tempfile.mkdtemp()
+    service = hashing.HashingService(processes=2, part_blocks=2, min_parallel_size=1000)
+    service.start()
+    try:
+        bs = 1000
+        hashes = checksum.BlockHashes(block_size=bs, hasher=service)
+        path = write(root, "f.1", 9500)
+        assert hashes.get(u"f", path) == checksum.calc_block_hashes(path, bs)
+
+        # a rewrite of the whole file goes to the pool, a small write doesn't
+        stamp = checksum.file_stamp(path)
+        filesystem.write_file(path, os.urandom(12000))
+        assert hashes.update(u"f", path, stamp, 0, 12000) == checksum.calc_block_hashes(path, bs)
+        stamp = checksum.file_stamp(path)
+        filesystem.write_file(path, "x" * 10, 5000)
+        assert hashes.update(u"f", path, stamp, 5000, 10) == checksum.calc_block_hashes(path, bs)
+        assert service.parallel_files == 2
+    finally:
+        service.close()
+        shutil.rmtree(root)
+
+def test_users():
+    print "Testing users of a shared service"
+    service = hashing.HashingService(processes=2)
+    try:
+        service.acquire()
+        service.acquire()
+        service.release()
+        # one user is left
+        assert list(service.imap_unordered(len, ["a"])) == [1]
+        service.release()
+        assert service.imap_unordered(len, ["a"]) is None
+        service.acquire()
+        assert service.imap_unordered(len, ["a"]) is None
+    finally:
+        service.close()
+
+def run():
+    test_parallel()
+    test_inline()
+    test_users()
+    test_block_hashes()
+    print "hashing tests passed"
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,104 @@
+'''
+heartbeat.py - Cached liveness of the tracker
+
+A background thread sends the tracker a Heartbeat every INTERVAL seconds.
+The tracker is considered offline after FAILURE_THRESHOLD heartbeats in a
+row go unanswered, and online again after the first one that's answered.
+Callers get the cached state without touching the network, unless the
+last heartbeat is older than TTL (the thread is stuck), in which case one
+heartbeat is sent inline. Only one caller sends it, the ones that come
+meanwhile get the cached state.
+'''
+
+import logging
+import socket
+import threading
+import time
+
+import communication
+import messages
+
+
+class Heartbeat(object):
+    INTERVAL = 2.0
+    TIMEOUT = 2.0
+    FAILURE_THRESHOLD = 3
+    TTL = 10.0
+
+    def __init__(self, local_peer, on_change=None):
+        '''on_change(online) is called on every transition between online and offline'''
+        self._local_peer = local_peer
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._online = False
+        self._failures = 0
+        self._last_checked = 0
+        self._checking = False # a caller of is_online() is sending a heartbeat
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, online=True):
+        '''starts the heartbeat thread. online is the state to start in'''
+        with self._lock:
+            self._online = online
+            self._failures = 0
+            self._last_checked = time.time()
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="Heartbeat")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_online(self):
+        with self._lock:
+            probe = not self._checking and time.time() - self._last_checked > self.TTL
+            if probe:
+                self._checking = True
+            online = self._online
+        if probe:
+            try:
+                self.check()
+            finally:
+                with self._lock:
+                    self._checking = False
+                    online = self._online
+        return online
+
+    def check(self):
+        '''sends one heartbeat and updates the state. returns True if it was answered'''
+        msg = messages.Heartbeat(self._local_peer.port)
+        try:
+            communication.request(msg, self._local_peer.tracker, timeout=self.TIMEOUT)
+            answered = True
+        except (socket.error, RuntimeError), e:
+            logging.debug("Heartbeat to the tracker failed: " + str(e))
+            answered = False
+        self._record(answered)
+        return answered
+
+    def _record(self, answered):
+        with self._lock:
+            self._last_checked = time.time()
+            was_online = self._online
+            if answered:
+                self._failures = 0
+                self._online = True
+            else:
+                self._failures += 1
+                if self._failures >= self.FAILURE_THRESHOLD:
+                    self._online = False
+            changed = self._online != was_online
+            online = self._online
+
+        if changed:
+            logging.info("Tracker is now %s", "online" if online else "offline")
+            if self._on_change is not None:
+                self._on_change(online)
+
+    def _run(self):
+        while not self._stop.wait(self.INTERVAL):
+            self.check()
@@ -0,0 +1,52 @@
+"""
+heartbeat_test.py - Test file for heartbeat.py
+"""
+
+import threading
+import time
+
+import heartbeat
+
+class SlowHeartbeat(heartbeat.Heartbeat):
+    '''answers every heartbeat, once release is set'''
+    def __init__(self):
+        super(SlowHeartbeat, self).__init__(None)
+        self.release = threading.Event()
+        self.checks = 0
+
+    def check(self):
+        self.checks += 1
+        self.release.wait()
+        self._record(True)
+        return True
+
+def test_stale_state():
+    print "Testing a stale state"
+    hb = SlowHeartbeat()
+    hb.TTL = 0.01
+    time.sleep(0.02)
+    results = []
+    callers = [threading.Thread(target=lambda: results.append(hb.is_online()))
+               for i in range(5)]
+    for caller in callers:
+        caller.start()
+    # one of them probes, the others get the cached state right away
+    deadline = time.time() + 5
+    while len(results) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    assert results == [False] * 4 and hb.checks == 1
+    hb.release.set()
+    for caller in callers:
+        caller.join()
+    assert results == [False] * 4 + [True] and hb.checks == 1
+
+    # the next caller after the TTL probes again
+    time.sleep(0.02)
+    assert hb.is_online() and hb.checks == 2
+
+def run():
+    test_stale_state()
+    print "heartbeat tests passed"
+
+if __name__ == "__main__":
+    run()
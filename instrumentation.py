@@ -0,0 +1,159 @@
+'''
+instrumentation.py - Per message type and per peer wire statistics
+
+communication.py reports every message it sends or receives: its size,
+the time spent encoding or decoding it, the time spent in the socket, and
+for requests, the time until the response arrived. Times are kept in
+histograms with power of two microsecond buckets.
+
+Recording costs a lock and a few additions per message. Set ENABLED to
+False (or call disable()) to turn it off: communication.py then skips the
+timing calls entirely and only pays for one module attribute check.
+'''
+
+import threading
+
+import messages
+
+ENABLED = True
+
+
+class Histogram(object):
+    '''Counts of durations in power of two microsecond buckets'''
+    BUCKETS = 28 # the last bucket holds everything above ~67s
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = min(int(seconds * 1000000).bit_length(), self.BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        '''returns the upper bound, in seconds, of the bucket holding the given fraction'''
+        if self.count == 0:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(2 ** i / 1000000.0, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class WireStats(object):
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.serialize = Histogram()
+        self.socket = Histogram()
+        self.round_trip = Histogram()
+
+    def merge(self, other):
+        self.messages += other.messages
+        self.bytes += other.bytes
+        self.serialize.merge(other.serialize)
+        self.socket.merge(other.socket)
+        self.round_trip.merge(other.round_trip)
+
+
+_lock = threading.Lock()
+# ("in" or "out", msg_type, peer) -> WireStats
+_stats = {}
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def _get(direction, msg_type, peer):
+    # must be called with _lock held
+    key = (direction, msg_type, peer)
+    stats = _stats.get(key)
+    if stats is None:
+        stats = _stats[key] = WireStats()
+    return stats
+
+def record_sent(msg_type, peer, byte_count, serialize_seconds, socket_seconds):
+    with _lock:
+        stats = _get("out", msg_type, peer)
+        stats.messages += 1
+        stats.bytes += byte_count
+        stats.serialize.add(serialize_seconds)
+        stats.socket.add(socket_seconds)
+
+def record_received(msg_type, peer, byte_count, serialize_seconds, socket_seconds=None):
+    with _lock:
+        stats = _get("in", msg_type, peer)
+        stats.messages += 1
+        stats.bytes += byte_count
+        stats.serialize.add(serialize_seconds)
+        if socket_seconds is not None:
+            stats.socket.add(socket_seconds)
+
+def record_round_trip(msg_type, peer, seconds):
+    '''time from sending a request of msg_type to getting its response'''
+    with _lock:
+        _get("out", msg_type, peer).round_trip.add(seconds)
+
+def snapshot(by="type"):
+    '''
+    returns {(direction, key): WireStats} where key is the message type
+    name (by="type"), the peer (by="peer"), or both (by="both")
+    '''
+    result = {}
+    with _lock:
+        for (direction, msg_type, peer), stats in _stats.items():
+            if by == "type":
+                key = messages.type_name(msg_type)
+            elif by == "peer":
+                key = peer
+            else:
+                key = (messages.type_name(msg_type), peer)
+            merged = result.get((direction, key))
+            if merged is None:
+                merged = result[(direction, key)] = WireStats()
+            merged.merge(stats)
+    return result
+
+def report(by="type"):
+    def ms(seconds):
+        return seconds * 1000
+
+    lines = ["%-26s %3s %7s %11s %8s %8s %8s %8s %8s %8s" %
+             ("type" if by == "type" else by, "dir", "msgs", "bytes", "ser p50", "ser p99",
+              "sock p50", "sock p99", "rtt p50", "rtt p99")]
+    for (direction, key), s in sorted(snapshot(by).items()):
+        label = key if isinstance(key, basestring) else "%s %s" % key
+        lines.append("%-26s %3s %7d %11d %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f" %
+                     (label, direction, s.messages, s.bytes,
+                      ms(s.serialize.percentile(0.5)), ms(s.serialize.percentile(0.99)),
+                      ms(s.socket.percentile(0.5)), ms(s.socket.percentile(0.99)),
+                      ms(s.round_trip.percentile(0.5)), ms(s.round_trip.percentile(0.99))))
+    lines.append("(times in ms)")
+    return "\n".join(lines)
@@ -0,0 +1,48 @@
+"""
+instrumentation_test.py - Test file for instrumentation.py
+"""
+
+import instrumentation
+from instrumentation import Histogram
+from messages import MessageType
+
+def test_histogram():
+    print "Testing histogram"
+    h = Histogram()
+    for i in range(99):
+        h.add(0.0001) # 100us, in the 128us bucket
+    h.add(2.0)
+    assert h.count == 100
+    assert h.percentile(0.5) == 128 / 1000000.0
+    assert h.percentile(1.0) == 2.0
+    assert abs(h.mean() - (99 * 0.0001 + 2.0) / 100) < 1e-9
+
+    h.add(10 ** 6) # past the last bucket
+    assert h.counts[-1] == 1
+
+def test_records():
+    print "Testing records"
+    instrumentation.reset()
+    instrumentation.record_sent(MessageType.LIST_REQUEST, "10.0.0.1:1", 20, 0.00001, 0.00002)
+    instrumentation.record_sent(MessageType.LIST_REQUEST, "10.0.0.2:1", 20, 0.00001, 0.00002)
+    instrumentation.record_round_trip(MessageType.LIST_REQUEST, "10.0.0.1:1", 0.001)
+    instrumentation.record_received(MessageType.LIST, "10.0.0.1:1", 500, 0.0001)
+
+    by_type = instrumentation.snapshot()
+    assert by_type[("out", "LIST_REQUEST")].messages == 2
+    assert by_type[("out", "LIST_REQUEST")].bytes == 40
+    assert by_type[("out", "LIST_REQUEST")].round_trip.count == 1
+    assert by_type[("in", "LIST")].socket.count == 0
+
+    by_peer = instrumentation.snapshot("peer")
+    assert by_peer[("out", "10.0.0.1:1")].messages == 1
+    assert "LIST_REQUEST" in instrumentation.report()
+    instrumentation.reset()
+
+def run():
+    test_histogram()
+    test_records()
+    print "instrumentation tests passed"
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,229 @@
+'''
+journal.py - Durable log of the operations done while the tracker is offline
+
+Writes, deletes, moves and archives done without the tracker are applied
+locally and appended to <root_path>/.journal/ops. Only what was done is
+logged, the data stays in the local copy. Each record is framed by its
+length and crc32, so a record torn by a crash is dropped when the journal
+is read back. Appends are fsynced in groups: a writer that finds another
+one syncing waits for it, and its record is usually covered by that sync.
+
+When the tracker is reachable again the operations are compacted (later
+writes of a file replace earlier ones, a file created and deleted offline
+is never mentioned) and replayed. The ones that fail stay in the journal.
+'''
+
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+WRITE = "write"
+DELETE = "delete"
+MOVE = "move"
+ARCHIVE = "archive"
+
+_HEADER = struct.Struct(">II") # payload length, crc32 of the payload
+
+
+class Op(object):
+    def __init__(self, kind, path, dest_path=None, version=None, is_new=False):
+        self.kind = kind
+        self.path = path
+        self.dest_path = dest_path # MOVE
+        self.version = version # WRITE: version written, ARCHIVE: version archived
+        self.is_new = is_new # WRITE: the tracker hasn't heard of the file
+
+    def __eq__(self, other):
+        return isinstance(other, Op) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Op(%s)" % ", ".join("%s=%r" % kv for kv in sorted(self.__dict__.items()))
+
+    def encode(self):
+        return json.dumps([self.kind, self.path, self.dest_path, self.version, self.is_new])
+
+    @classmethod
+    def decode(cls, payload):
+        kind, path, dest_path, version, is_new = json.loads(payload)
+        return cls(kind, path, dest_path, version, is_new)
+
+
+def compact(ops):
+    '''returns ops with the operations a replay doesn't need dropped'''
+    result = []
+    for op in ops:
+        if op.kind == WRITE:
+            # a later write of the same version replaces an earlier one
+            for i, prev in enumerate(result):
+                if (prev.kind == WRITE and prev.path == op.path and
+                    prev.version == op.version):
+                    op = Op(WRITE, op.path, version=op.version, is_new=prev.is_new or op.is_new)
+                    del result[i]
+                    break
+            result.append(op)
+        elif op.kind == DELETE:
+            created = any(prev.kind == WRITE and prev.path == op.path and prev.is_new
+                          for prev in result)
+            result = [prev for prev in result
+                      if not (prev.path == op.path and prev.kind in (WRITE, ARCHIVE))]
+            if not created:
+                result.append(op)
+        elif op.kind == MOVE:
+            created = [prev for prev in result
+                       if prev.kind == WRITE and prev.path == op.path and prev.is_new]
+            if created:
+                # the tracker only needs to hear about the file under its new name
+                for prev in result:
+                    if prev.path == op.path:
+                        prev.path = op.dest_path
+            else:
+                result.append(op)
+        else:
+            result.append(op)
+    return result
+
+
+class Journal(object):
+    def __init__(self, peer):
+        self._peer = peer
+        self._lock = threading.Lock() # held while appending to the file
+        self._sync_lock = threading.Lock() # held while the file is fsynced
+        self._replay_lock = threading.Lock()
+        self._file = None
+        self._appended = 0 # records appended since the file was opened
+        self._synced = 0 # of those, how many are known to be on disk
+
+    def _path(self):
+        return os.path.join(self._peer.root_path, ".journal", "ops")
+
+    def _open(self):
+        # must be called with _lock held
+        if self._file is None:
+            path = self._path()
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            ops, length = self._load()
+            self._file = open(path, "ab")
+            # records appended after a torn one would never be read
+            self._file.truncate(length)
+            self._appended = self._synced = 0
+        return self._file
+
+    def append(self, op):
+        '''returns once op is on disk'''
+        payload = op.encode()
+        with self._lock:
+            f = self._open()
+            f.write(_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+            f.flush()
+            self._appended += 1
+            seq = self._appended
+        with self._sync_lock:
+            if self._synced >= seq:
+                return # a sync that started after our write covered it
+            with self._lock:
+                f = self._file
+                target = self._appended
+            if f is not None:
+                os.fsync(f.fileno())
+                self._synced = target
+
+    def _load(self):
+        # returns (operations, length of the file up to the last whole record)
+        path = self._path()
+        if not os.path.exists(path):
+            return [], 0
+        f = open(path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        ops = []
+        pos = 0
+        while pos + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, pos)
+            payload = data[pos + _HEADER.size:pos + _HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            ops.append(Op.decode(payload))
+            pos += _HEADER.size + length
+        if pos < len(data):
+            logging.warning("Dropping a torn record at the end of the journal")
+        return ops, pos
+
+    def read(self):
+        '''returns the operations in the journal, oldest first'''
+        return self._load()[0]
+
+    def __len__(self):
+        return len(self.read())
+
+    def _rewrite(self, ops):
+        # must be called with _lock held
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        path = self._path()
+        if not ops and not os.path.exists(path):
+            return
+        tmp_path = path + ".tmp"
+        f = open(tmp_path, "wb")
+        try:
+            for op in ops:
+                payload = op.encode()
+                f.write(_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+    def report(self):
+        return "journal: %d operations waiting for the tracker" % len(self)
+
+    def replay(self, apply, flush=None):
+        '''
+        calls apply(op) on each operation left after compaction, then
+        flush(). Operations that raise stay in the journal, along with the
+        ones appended meanwhile. If flush() raises they all stay.
+        returns (replayed, left)
+        '''
+        with self._replay_lock:
+            with self._lock:
+                ops = self.read()
+            if not ops:
+                return 0, 0
+            pending = compact(ops)
+            logging.info("Replaying %d journalled operations (%d before compaction)" %
+                         (len(pending), len(ops)))
+
+            failed = []
+            for op in pending:
+                if failed:
+                    # keep the order, a move or delete may depend on an earlier op
+                    failed.append(op)
+                    continue
+                try:
+                    apply(op)
+                except Exception, e:
+                    logging.error("Couldn't replay %r: %s" % (op, e))
+                    failed.append(op)
+
+            if flush is not None:
+                try:
+                    flush()
+                except Exception, e:
+                    logging.error("Couldn't send the replayed operations: %s" % e)
+                    failed = pending
+
+            with self._lock:
+                appended = self.read()[len(ops):]
+                self._rewrite(failed + appended)
+            return len(pending) - len(failed), len(failed)
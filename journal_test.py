@@ -0,0 +1,82 @@
+"""
+journal_test.py - Test file for journal.py
+"""
+
+import os
+import shutil
+import tempfile
+
+import journal
+from journal import Op, WRITE, DELETE, MOVE, ARCHIVE
+
+class FakePeer(object):
+    def __init__(self, root_path):
+        self.root_path = root_path
+
+def test_compact():
+    print "Testing compaction"
+    ops = [Op(WRITE, u"a", version=1, is_new=True),
+           Op(WRITE, u"b", version=1),
+           Op(WRITE, u"a", version=1),
+           Op(ARCHIVE, u"b", version=1),
+           Op(WRITE, u"b", version=2),
+           Op(WRITE, u"c", version=1, is_new=True),
+           Op(MOVE, u"c", u"d"),
+           Op(WRITE, u"e", version=1, is_new=True),
+           Op(DELETE, u"e"),
+           Op(WRITE, u"f", version=1),
+           Op(DELETE, u"f")]
+    assert journal.compact(ops) == [Op(WRITE, u"b", version=1),
+                                    Op(WRITE, u"a", version=1, is_new=True),
+                                    Op(ARCHIVE, u"b", version=1),
+                                    Op(WRITE, u"b", version=2),
+                                    Op(WRITE, u"d", version=1, is_new=True),
+                                    Op(DELETE, u"f")]
+
+def test_journal():
+    print "Testing journal"
+    root = tempfile.mkdtemp()
+    try:
+        j = journal.Journal(FakePeer(root))
+        for i in range(3):
+            j.append(Op(WRITE, u"f%d" % i, version=1))
+        assert len(journal.Journal(FakePeer(root))) == 3
+
+        # a record torn by a crash is dropped, and isn't in the way of new ones
+        f = open(os.path.join(root, ".journal", "ops"), "ab")
+        f.write("\x00\x00\x00\x40abc")
+        f.close()
+        j = journal.Journal(FakePeer(root))
+        assert len(j) == 3
+        j.append(Op(DELETE, u"f0"))
+        assert [op.kind for op in j.read()] == [WRITE, WRITE, WRITE, DELETE]
+
+        # what fails, and what's appended during the replay, stays
+        applied = []
+        def apply(op):
+            if op.path == u"f2":
+                j.append(Op(WRITE, u"g", version=1))
+                raise RuntimeError("tracker went away")
+            applied.append(op)
+        assert j.replay(apply) == (1, 2)
+        assert [op.path for op in applied] == [u"f1"]
+        assert [op.path for op in j.read()] == [u"f2", u"f0", u"g"]
+
+        assert j.replay(lambda op: None) == (3, 0)
+        assert len(j) == 0
+
+        j.append(Op(WRITE, u"h", version=1))
+        def flush():
+            raise RuntimeError("tracker went away")
+        assert j.replay(lambda op: None, flush) == (0, 1)
+        assert len(j) == 1
+    finally:
+        shutil.rmtree(root)
+
+def run():
+    test_compact()
+    test_journal()
+    print "journal tests passed"
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,34 @@
+'''
+merkle.py - Merkle trees over the block hashes of a file
+
+The leaves are the md5s of a file's checksum.BLOCK_SIZE blocks, and each
+parent is the md5 of its two children. A level with an odd number of
+nodes passes its last one up unchanged. The root is the file's checksum,
+so a list of leaves sent by another peer can be checked against the
+checksum the tracker has before it's trusted, and then each block can be
+checked on its own.
+'''
+
+import hashlib
+
+EMPTY_ROOT = hashlib.md5("").digest()
+
+
+def _parents(level):
+    parents = [hashlib.md5(level[i] + level[i + 1]).digest()
+               for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+def root(leaves):
+    if not leaves:
+        return EMPTY_ROOT
+    level = list(leaves)
+    while len(level) > 1:
+        level = _parents(level)
+    return level[0]
+
+def diff(expected, actual):
+    '''returns the indexes of the blocks whose hashes don't match expected'''
+    return [i for i, h in enumerate(expected) if i >= len(actual) or actual[i] != h]
@@ -0,0 +1,42 @@
+"""
+merkle_test.py - Test file for merkle.py
+"""
+
+import hashlib
+
+import merkle
+
+def md5(data):
+    return hashlib.md5(data).digest()
+
+def test_root():
+    print "Testing root"
+    a, b, c = md5("a"), md5("b"), md5("c")
+    assert merkle.root([]) == md5("")
+    assert merkle.root([a]) == a
+    assert merkle.root([a, b]) == md5(a + b)
+    # the odd leaf is passed up unchanged
+    assert merkle.root([a, b, c]) == md5(md5(a + b) + c)
+    assert merkle.root([a, b, c, a, b]) == md5(md5(md5(a + b) + md5(c + a)) + b)
+    assert merkle.root([b, a]) != merkle.root([a, b])
+
+def test_diff():
+    print "Testing diff"
+    leaves = [md5(str(i)) for i in range(5)]
+    assert merkle.diff(leaves, list(leaves)) == []
+
+    damaged = list(leaves)
+    damaged[1] = damaged[3] = md5("x")
+    assert merkle.diff(leaves, damaged) == [1, 3]
+    # blocks missing from a short copy
+    assert merkle.diff(leaves, leaves[:2]) == [2, 3, 4]
+    # blocks past the end of the expected file don't count
+    assert merkle.diff(leaves[:2], leaves) == []
+
+def run():
+    test_root()
+    test_diff()
+    print "merkle tests passed"
+
+if __name__ == "__main__":
+    run()
@@ -37,6 +37,30 @@ class MessageType(object):
     ARCHIVE_RESPONSE = 22
     FILE_ARCHIVED = 23
 
+    FILE_STREAM_HEADER = 24
+
+    NOTIFICATION_BATCH = 25
+
+    HEARTBEAT = 26
+    HEARTBEAT_RESPONSE = 27
+
+    FILE_BLOCK_REQUEST = 28
+    FILE_BLOCK = 29
+    BLOCK_HASHES_REQUEST = 30
+    BLOCK_HASHES = 31
+
+    CHUNK_MANIFEST_REQUEST = 32
+    CHUNK_MANIFEST = 33
+
+    READ_RANGE_REQUEST = 34
+
+def type_name(msg_type):
+    '''returns the MessageType constant's name for msg_type'''
+    for name, value in vars(MessageType).items():
+        if value == msg_type and not name.startswith("_"):
+            return name
+    return str(msg_type)
+
 
 class FileModel(object):
     def __init__(self, path, is_dir, checksum, size, latest_version, parent_id=None, data=None):
@@ -54,23 +78,35 @@ class FileModel(object):
 class Message(object):    
     def __init__(self, msg_type):
         self.msg_type = msg_type
+        # set when the message is sent as a request, and copied into the
+        # response so the sender can tell which request it answers
+        self.request_id = 0
     
     def __str__(self):
         return type(self).__name__
 
+# wire_version is the newest codec.VERSION the sender can decode. Both ends
+# use the lower of their two versions from then on
 class ConnectRequest(Message):
-    def __init__(self, pwd, port, maxFileSize, maxFileSysSize, currFileSysSize):
+    def __init__(self, pwd, port, maxFileSize, maxFileSysSize, currFileSysSize, wire_version=0,
+                 compression=None):
         super(ConnectRequest, self).__init__(MessageType.CONNECT_REQUEST)
         self.pwd = pwd
         self.port = port
         self.maxFileSize = maxFileSize
         self.maxFileSysSize = maxFileSysSize
         self.currFileSysSize = currFileSysSize
+        self.wire_version = wire_version
+        # compression methods this peer can use, most preferred first
+        self.compression = compression or []
 
 class ConnectResponse(Message):
-    def __init__(self, successful):
+    def __init__(self, successful, wire_version=0, compression=None):
         super(ConnectResponse, self).__init__(MessageType.CONNECT_RESPONSE)
         self.successful = successful
+        self.wire_version = wire_version
+        # compression method picked from the request's, or None
+        self.compression = compression
         
     
     
@@ -97,9 +133,10 @@ class PeerList(Message):
         self.peer_list = peer_list
 
 class FileDownloadRequest(Message):
-    def __init__(self, file_path):
+    def __init__(self, file_path, stream=False):
         super(FileDownloadRequest, self).__init__(MessageType.FILE_DOWNLOAD_REQUEST)
         self.file_path = file_path
+        self.stream = stream
 
 class FileDownloadDecline(Message):
     def __init__(self, file_path):
@@ -111,12 +148,85 @@ class FileData(Message):
         super(FileData, self).__init__(MessageType.FILE_DATA)
         self.file_model = file_model
 
+# sent instead of FileData when the download was requested with stream=True.
+# The file contents follow as data frames (see communication.send_stream)
+class FileStreamHeader(Message):
+    def __init__(self, file_model, block_hashes=None):
+        super(FileStreamHeader, self).__init__(MessageType.FILE_STREAM_HEADER)
+        self.file_model = file_model
+        # the leaves of the version's Merkle tree, empty if the peer doesn't know them
+        self.block_hashes = block_hashes or []
+
+# a byte range of one version of a file. Answered with FileBlock, or
+# FileDownloadDecline if the peer doesn't have that version
+class FileBlockRequest(Message):
+    def __init__(self, file_path, version, offset, length):
+        super(FileBlockRequest, self).__init__(MessageType.FILE_BLOCK_REQUEST)
+        self.file_path = file_path
+        self.version = version
+        self.offset = offset
+        self.length = length
+
+# file_model.data holds the bytes starting at offset
+class FileBlock(Message):
+    def __init__(self, file_model, offset):
+        super(FileBlock, self).__init__(MessageType.FILE_BLOCK)
+        self.file_model = file_model
+        self.offset = offset
+
+# a byte range of the peer's latest version of a file, for readers without
+# a copy of it. Answered with FileBlock, or FileDownloadDecline
+class ReadRangeRequest(Message):
+    def __init__(self, file_path, offset, length):
+        super(ReadRangeRequest, self).__init__(MessageType.READ_RANGE_REQUEST)
+        self.file_path = file_path
+        self.offset = offset
+        self.length = length
+
+class BlockHashesRequest(Message):
+    def __init__(self, file_path, block_size):
+        super(BlockHashesRequest, self).__init__(MessageType.BLOCK_HASHES_REQUEST)
+        self.file_path = file_path
+        self.block_size = block_size
+
+# checksums of each block_size block of the peer's latest version of a file
+class BlockHashes(Message):
+    def __init__(self, file_model, block_size, hashes):
+        super(BlockHashes, self).__init__(MessageType.BLOCK_HASHES)
+        self.file_model = file_model
+        self.block_size = block_size
+        self.hashes = hashes
+
+# the content-defined chunks of a peer's latest version of a file (see chunkstore.py)
+class ChunkManifestRequest(Message):
+    def __init__(self, file_path):
+        super(ChunkManifestRequest, self).__init__(MessageType.CHUNK_MANIFEST_REQUEST)
+        self.file_path = file_path
+
+class ChunkManifest(Message):
+    def __init__(self, file_model, hashes, sizes):
+        super(ChunkManifest, self).__init__(MessageType.CHUNK_MANIFEST)
+        self.file_model = file_model
+        self.hashes = hashes
+        self.sizes = sizes
+
+# a change can carry the whole file in file_model.data, or a delta (see
+# delta.py) against the version whose checksum is base_checksum
 class FileChanged(Message):
-    def __init__(self, file_model, port, start_offset=0):
+    def __init__(self, file_model, port, start_offset=0, delta=None, base_checksum=None):
         super(FileChanged, self).__init__(MessageType.FILE_CHANGED)
         self.port = port
         self.file_model = file_model
         self.start_offset = start_offset
+        self.delta = delta
+        self.base_checksum = base_checksum
+
+# FileChanged and NewFileAvailable messages without file data, sent to
+# the tracker together (see notifications.py)
+class NotificationBatch(Message):
+    def __init__(self, notifications):
+        super(NotificationBatch, self).__init__(MessageType.NOTIFICATION_BATCH)
+        self.notifications = notifications
 
 class FileArchived(Message):
     def __init__(self, file_path, new_version):
@@ -210,3 +320,13 @@ class ArchiveResponse(Message):
         self.file_path = file_path
         self.archived = archived
         
+
+# sent to the tracker periodically to check that it's up (see heartbeat.py)
+class Heartbeat(Message):
+    def __init__(self, port):
+        super(Heartbeat, self).__init__(MessageType.HEARTBEAT)
+        self.port = port
+
+class HeartbeatResponse(Message):
+    def __init__(self):
+        super(HeartbeatResponse, self).__init__(MessageType.HEARTBEAT_RESPONSE)
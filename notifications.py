@@ -0,0 +1,122 @@
+'''
+notifications.py - Batching of the notifications a peer sends the tracker
+
+FileChanged messages sent after a download, and NewFileAvailable messages,
+carry no file data and aren't urgent. They're held for up to MAX_DELAY
+seconds or until MAX_BATCH of them are waiting, then sent together in one
+NotificationBatch, which the tracker applies in one DB transaction.
+
+A batch that can't be sent isn't dropped. It's handed to on_failed, which
+takes what it can keep elsewhere (LocalPeer journals new files), and the
+rest goes back to the head of the queue, to be tried again after a delay
+that doubles with each failure up to MAX_RETRY_DELAY.
+'''
+
+import logging
+import threading
+import time
+
+import messages
+from messages import MessageType
+
+BATCHABLE = frozenset([MessageType.FILE_CHANGED, MessageType.NEW_FILE_AVAILABLE])
+
+
+class NotificationBatcher(object):
+    MAX_BATCH = 64
+    MAX_DELAY = 0.05
+    RETRY_DELAY = 0.5
+    MAX_RETRY_DELAY = 10.0
+
+    def __init__(self, send, max_batch=MAX_BATCH, max_delay=MAX_DELAY, on_failed=None):
+        '''
+        send(msg) puts one message on the wire. on_failed(msgs) is called
+        with the queued messages a send failed for, and returns the ones
+        to keep queued
+        '''
+        self._send = send
+        self._on_failed = on_failed
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._retry_delay = 0
+
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = []
+        self._first_queued = 0
+        # held while a batch is being sent, so messages go out in order
+        self._send_lock = threading.Lock()
+        self._thread = None
+
+    def send(self, msg):
+        '''
+        Queues msg if it can be batched. Anything else is sent right away,
+        after whatever is already queued
+        '''
+        if (msg.msg_type not in BATCHABLE or msg.file_model.data is not None or
+            getattr(msg, "delta", None) is not None):
+            with self._send_lock:
+                self._send_pending()
+                self._send(msg)
+            return
+
+        with self._cond:
+            if not self._pending:
+                self._first_queued = time.time()
+            self._pending.append(msg)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="NotificationBatcher")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self):
+        '''sends everything that's queued before returning'''
+        with self._send_lock:
+            self._send_pending()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                while self._pending and len(self._pending) < self.max_batch:
+                    remaining = self._first_queued + self.max_delay - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+            try:
+                self.flush()
+                self._retry_delay = 0
+            except Exception, e:
+                self._retry_delay = min(max(self._retry_delay * 2, self.RETRY_DELAY),
+                                        self.MAX_RETRY_DELAY)
+                logging.warning("Couldn't send notifications to the tracker, trying again "
+                                "in %.1fs: %s" % (self._retry_delay, e))
+                time.sleep(self._retry_delay)
+
+    def pending(self):
+        '''the number of messages waiting to be sent'''
+        with self._cond:
+            return len(self._pending)
+
+    def _send_pending(self):
+        # must be called with _send_lock held
+        with self._cond:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            if len(batch) == 1:
+                self._send(batch[0])
+            else:
+                logging.debug("Sending a batch of %d notifications", len(batch))
+                self._send(messages.NotificationBatch(batch))
+        except:
+            kept = batch if self._on_failed is None else self._on_failed(batch)
+            with self._cond:
+                if kept:
+                    # ahead of anything queued meanwhile, so the order is kept
+                    self._pending[:0] = kept
+                    self._first_queued = time.time()
+            raise
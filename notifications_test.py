@@ -0,0 +1,81 @@
+"""
+notifications_test.py - Test file for notifications.py
+"""
+
+import socket
+import time
+
+import messages
+import notifications
+from messages import FileModel, MessageType
+
+def new_file(path):
+    return messages.NewFileAvailable(FileModel(path, False, "c", 1, 1), 1)
+
+def ack(path):
+    return messages.FileChanged(FileModel(path, False, "c", 1, 1), 1)
+
+class Tracker(object):
+    def __init__(self):
+        self.online = False
+        self.sent = []
+
+    def send(self, msg):
+        if not self.online:
+            raise socket.error("tracker is offline")
+        if msg.msg_type == MessageType.NOTIFICATION_BATCH:
+            self.sent.extend(m.file_model.path for m in msg.notifications)
+        else:
+            self.sent.append(msg.file_model.path)
+
+def test_failed_batches():
+    print "Testing failed batches"
+    tracker = Tracker()
+    journalled = []
+    def on_failed(msgs):
+        journalled.extend(m.file_model.path for m in msgs
+                          if m.msg_type == MessageType.NEW_FILE_AVAILABLE)
+        return [m for m in msgs if m.msg_type != MessageType.NEW_FILE_AVAILABLE]
+
+    batcher = notifications.NotificationBatcher(tracker.send, max_delay=0.01,
+                                                on_failed=on_failed)
+    batcher.RETRY_DELAY = 0.05
+    batcher.send(new_file(u"a"))
+    batcher.send(ack(u"b"))
+    try:
+        batcher.flush()
+        assert False
+    except socket.error:
+        pass
+    # new files went to on_failed, the rest is kept in order
+    assert journalled == [u"a"]
+    batcher.send(ack(u"c"))
+    assert batcher.pending() == 2
+
+    # and sent once the tracker is back
+    tracker.online = True
+    deadline = time.time() + 5
+    while batcher.pending() and time.time() < deadline:
+        time.sleep(0.01)
+    assert tracker.sent == [u"b", u"c"]
+
+    # without on_failed nothing is dropped
+    tracker.online = False
+    batcher = notifications.NotificationBatcher(tracker.send, max_delay=60)
+    batcher.send(new_file(u"d"))
+    try:
+        batcher.flush()
+        assert False
+    except socket.error:
+        pass
+    assert batcher.pending() == 1
+    tracker.online = True
+    batcher.flush()
+    assert tracker.sent[-1] == u"d"
+
+def run():
+    test_failed_batches()
+    print "notifications tests passed"
+
+if __name__ == "__main__":
+    run()
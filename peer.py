@@ -7,13 +7,31 @@ import threading
 import os.path
 import logging
 import select
+import time
 
 import communication
+import compression
+import eventloop
+import workers
+import notifications
+import heartbeat
+import swarm
+import merkle
+import delta
+import chunkstore
+import readcache
+import rangecache
+import bulkimport
+import hashing
+import replicas
+import sync
+import journal
 from messages import MessageType, FileModel
 import messages
 import checksum
 import filesystem
 import tracker
+import db
 from db import LocalPeerDb
 
 class PeerState(object):
@@ -48,15 +66,14 @@ def check_tracker_online(function):
     def wrapper(*args, **kwargs):
         peer = args[0]
         
-        function_to_call = function
-        
         if peer.is_tracker_online() == False:
-            function_to_call = getattr(peer, function.func_name + '_tracker_offline')
-        
-        if function_to_call == None:
-            return
+            # a bound method, so it doesn't get peer again
+            offline_function = getattr(peer, function.func_name + '_tracker_offline', None)
+            if offline_function == None:
+                return
+            return offline_function(*args[1:], **kwargs)
             
-        return_value = function_to_call(*args, **kwargs)
+        return_value = function(*args, **kwargs)
         return return_value
         
     return wrapper
@@ -67,22 +84,90 @@ class LocalPeer(Peer):
     PASSWORD = '12345'
     MAX_FILE_SIZE = 100000000
     MAX_FILE_SYS_SIZE = 1000000000
+    # "threads": a thread per connection and per message (AcceptorThread)
+    # "eventloop": one select() loop feeding the worker pool (eventloop.py)
+    SERVER_ENGINE = "threads"
+    # "files": every version is a whole file (see filesystem.get_local_path)
+    # "chunks": archived versions are kept as deduplicated chunks and
+    # downloads reuse the chunks already here (chunkstore.py)
+    STORAGE_ENGINE = "files"
+    READ_CACHE_BYTES = readcache.MAX_BYTES
+    # reads of part of a file we don't have fetch just that part from a
+    # replica, and keep it in a sparse local copy (rangecache.py, 0 to disable)
+    REMOTE_RANGE_READS = True
+    RANGE_CACHE_BYTES = rangecache.MAX_BYTES
+    # check the blocks a read covers against the version's Merkle tree, and
+    # fetch the ones that don't match again (merkle.py)
+    VERIFY_READS = False
+    # hash big files on a pool of processes (hashing.py)
+    PARALLEL_HASHING = True
+    # seconds a streamed download may go without receiving anything
+    STREAM_TIMEOUT = 30.0
     def __init__(self, hostname=Peer.HOSTNAME, port=Peer.PORT, root_path=LOCAL_STORE, db_name=None):
         super(LocalPeer, self).__init__(hostname, port)        
+        # forked before any socket is open, the workers would keep them open
+        self.hasher = hashing.shared() if self.PARALLEL_HASHING else None
+        if self.hasher is not None:
+            self.hasher.acquire()
+        self._hasher_acquired = self.hasher is not None
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._acceptorThread = AcceptorThread(self)
+        self.worker_pool = workers.WorkerPool(type(self).__name__ + "_Worker")
+        self.notifications = notifications.NotificationBatcher(
+            lambda msg: communication.send_message(msg, self.tracker),
+            on_failed=self._notifications_failed)
+        self.heartbeat = heartbeat.Heartbeat(self, self._tracker_state_changed)
+        self.chunks = chunkstore.ChunkStore(self) if self.STORAGE_ENGINE == "chunks" else None
+        self.read_cache = readcache.ReadCache(self.READ_CACHE_BYTES)
+        self.range_cache = rangecache.RangeCache(self, self.RANGE_CACHE_BYTES)
+        # writes, downloads and changes from other peers hash through it
+        self.block_hashes = checksum.BlockHashes(hasher=self.hasher)
+        self.replicas = replicas.ReplicaSelector()
+        self.journal = journal.Journal(self)
+        self._file_locks = {} # file path -> lock held while a change to it is applied
+        self._file_locks_lock = threading.Lock()
+        self.sync = sync.CatchUpSync(self)
+        # files other peers announce are downloaded off the worker pool
+        self.downloader = sync.Downloader(self)
+        self._acceptorThread = self._make_server()
         self.start_server()
         
-        self._backlog = []
-        
         self.root_path = root_path
         
 
         if type(self) == LocalPeer: # exclude sub-classes
             self.tracker = Peer(tracker.Tracker.HOSTNAME, tracker.Tracker.PORT)
             self.db = LocalPeerDb(db_name)
+            self._migrate_checksums()
             self.connect(LocalPeer.PASSWORD)            
 
+    def _migrate_checksums(self):
+        '''
+        Brings the checksums in the DB to db.CHECKSUM_FORMAT. They used to
+        be the md5 of the whole file, which is also the Merkle root of files
+        of up to one block. Bigger files take the root of their local copy,
+        if it matches the old checksum. The others are marked, and take the
+        root of the first copy that does (see _download_file)
+        '''
+        if self.db.checksum_format() >= db.CHECKSUM_FORMAT:
+            return
+        migrated = marked = 0
+        with self.db.transaction():
+            for f in self.db.list_files(None):
+                if f.is_dir or f.size is None or f.size <= checksum.BLOCK_SIZE:
+                    continue
+                local_path = filesystem.get_local_path(self, f.path, f.latest_version)
+                if os.path.exists(local_path) and checksum.legacy_checksum(local_path) == f.checksum:
+                    f.checksum = checksum.combine(self.block_hashes.get(f.path, local_path))
+                    self.db.add_or_update_file(f)
+                    migrated += 1
+                else:
+                    self.db.mark_legacy_checksum(f.path)
+                    marked += 1
+        # not in the transaction, sqlite commits before a PRAGMA
+        self.db.set_checksum_format(db.CHECKSUM_FORMAT)
+        logging.info("%s : Migrated %d checksums, %d are left to the next download" %
+                     (self, migrated, marked))
+
     def start_server(self):        
         connected = False
         while not connected:
@@ -97,37 +182,31 @@ class LocalPeer(Peer):
         
     def connect(self, password):
         connect_request = messages.ConnectRequest(password, self.port, LocalPeer.MAX_FILE_SIZE,
-                                                  LocalPeer.MAX_FILE_SYS_SIZE, 0)
+                                                  LocalPeer.MAX_FILE_SYS_SIZE, 0,
+                                                  communication.WIRE_VERSION,
+                                                  compression.PREFERRED)
         # Send Connection Request to Tracker
-        communication.send_message(connect_request, self.tracker)
-        response = communication.recv_message(self.tracker)
+        response = communication.request(connect_request, self.tracker)
         
         successful = response.successful
         if successful:
             logging.info("%s : Connection to tracker successful" % self)
+            communication.set_wire_version(self.tracker.hostname, self.tracker.port,
+                                           getattr(response, "wire_version", 0))
+            communication.set_compression(self.tracker.hostname, self.tracker.port,
+                                          getattr(response, "compression", None))
             self.start_accepting_connections()
             self.state = PeerState.ONLINE
+            self.heartbeat.start(online=True)
             # get peers and file lists
             peer_list = self._get_peer_list(None)
             self.db.clear_peers_and_insert(peer_list)
             
-            file_list = self.ls()
-            for remote_file in file_list:
-                # for each file, check locally stored version and checksum
-                # and fetch changes, as needed
-                db_file = self.db.get_file(remote_file.path)
-                if db_file is None:
-                    logging.debug("New file: %s", remote_file.path)
-                    self.db.add_or_update_file(remote_file)
-                else:
-                    print "1"
-                    if remote_file.latest_version == db_file.latest_version:
-                        if remote_file.checksum != db_file.checksum:
-                            # same version, but file is changed. re-fetch
-                            self._download_file(remote_file.path) # check if successful
-                    else:
-                        # TODO fetch the new versions
-                        pass
+            # the tracker hears what was done offline before anything is compared
+            self._replay_journal()
+            # catch up in the background so requests are served meanwhile
+            self.sync = sync.CatchUpSync(self)
+            self.sync.start()
         else:
             logging.error("%s : Connection to tracker unsuccessful" % self)
                 
@@ -136,12 +215,15 @@ class LocalPeer(Peer):
     def disconnect(self,check_for_unreplicated_files=True):
         logging.info("Asking tracker to disconnect")
         disconnect_msg = messages.DisconnectRequest(check_for_unreplicated_files, self.port)
-        communication.send_message(disconnect_msg, self.tracker)
-        response = communication.recv_message(self.tracker)
-        logging.info("Response received. Should wait? " + str(response.should_wait))
-        while (response.should_wait):
-            # TODO so is it is a tracker's responsibility to notify peer when it is ok to disconnect?
-            response = communication.recv_message(self.tracker)
+        # the tracker has to know about every replica before it checks for unreplicated files
+        self.notifications.flush()
+        with communication.pool.connection(self.tracker) as tracker_socket:
+            communication.send_message(disconnect_msg, self.tracker, tracker_socket)
+            response = communication.recv_message(tracker_socket)
+            logging.info("Response received. Should wait? " + str(response.should_wait))
+            while (response.should_wait):
+                # TODO so is it is a tracker's responsibility to notify peer when it is ok to disconnect?
+                response = communication.recv_message(tracker_socket)
 
         self.stop()
     
@@ -151,69 +233,393 @@ class LocalPeer(Peer):
             peer_list = self._get_peer_list(file_path)
         
         attempt = 0
+        f = None
         while attempt < maxAttempts:
-            response = None
-            # download the file from a peer
-            for peer in peer_list:
-                file_download_request = messages.FileDownloadRequest(file_path)
-                communication.send_message(file_download_request, peer)
-                
-                response = communication.recv_message(peer)
-                if isinstance(response, messages.FileData):
-                    break
+            if f is None:
+                f = self._fetch_file(file_path, peer_list)
+                if f is None:
+                    return None
             
-            if response == None or isinstance(response, messages.FileDownloadDecline):
-                return None
-            
-            f = response.file_model
             version = f.latest_version
             golden_checksum = f.checksum
             local_path = filesystem.get_local_path(self, file_path, version)
             
-            filesystem.write_file(local_path, f.data)
-            new_checksum = checksum.calc_file_checksum(local_path)
+            new_checksum = checksum.combine(self.block_hashes.get(file_path, local_path))
+            if (new_checksum != golden_checksum and f.size > checksum.BLOCK_SIZE and
+                checksum.legacy_checksum(local_path) == golden_checksum):
+                # the sender's checksum is still the md5 of the whole file
+                logging.info("Replacing the old style checksum of %s" % f.path)
+                f.checksum = golden_checksum = new_checksum
+                self.db.clear_legacy_checksum(f.path)
         
             if new_checksum == golden_checksum:
                 logging.info("File downloaded successfully! Going to notify tracker. File name: " + f.path)
                 
                 self.db.add_or_update_file(f)
                 self.db.add_local_file(f.path)
+                self._version_stored(f.path, f.latest_version)
                 f.data = None
                 response = messages.FileChanged(f, self.port)
-                communication.send_message(response, self.tracker)
+                self.notifications.send(response)
                 return True
                 
-            else:
-                logging.error("File downloaded but checksum doesn't match. " +
-                              "Going to try again. File name: %s" % f.path)
-                attempt += 1
+            attempt += 1
+            if self._repair_blocks(f, local_path, peer_list):
+                continue
+            logging.error("File downloaded but checksum doesn't match. " +
+                          "Going to try again. File name: %s" % f.path)
+            f = None
 
         logging.error("Download_file failed - max attempts reached. File: " + file_path)
         return False
+
+    def _expected_leaves(self, f, peer_list):
+        '''
+        returns the leaves of the Merkle tree of the version described by f,
+        from the DB or from a peer in peer_list, or None if no leaves
+        matching f.checksum can be found
+        '''
+        leaves = self.db.get_block_hashes(f.path, f.latest_version, checksum.BLOCK_SIZE)
+        if leaves is not None and merkle.root(leaves) == f.checksum:
+            return leaves
+        for peer in peer_list:
+            if (peer.hostname, peer.port) == (self.hostname, self.port):
+                continue
+            response = self._get_block_hashes(f.path, [peer])
+            # a stale or damaged replica sends leaves with another root
+            if (response is not None and response.block_size == checksum.BLOCK_SIZE and
+                merkle.root(response.hashes) == f.checksum):
+                self.db.set_block_hashes(f.path, f.latest_version, checksum.BLOCK_SIZE,
+                                         response.hashes)
+                return response.hashes
+        return None
+
+    def _repair_blocks(self, f, local_path, peer_list, bad=None):
+        '''
+        fetches the blocks of local_path that don't match the Merkle tree of
+        the version described by f (or just the ones in bad) from the peers
+        in peer_list. returns True if they all were
+        '''
+        expected = self._expected_leaves(f, peer_list)
+        if expected is None:
+            return False
+        if not os.path.exists(local_path):
+            return False
+        if os.path.getsize(local_path) != f.size:
+            filesystem.truncate(local_path, f.size)
+        if bad is None:
+            bad = merkle.diff(expected, self.block_hashes.get(f.path, local_path))
+
+        peers = [p for p in peer_list if (p.hostname, p.port) != (self.hostname, self.port)]
+        bs = checksum.BLOCK_SIZE
+        for index in bad:
+            offset = index * bs
+            length = min(bs, f.size - offset)
+            data = None
+            for peer in self.replicas.rank(peers, length, "block %d of %s" % (index, f.path)):
+                data = swarm.fetch_block(peer, f, offset, length, expected[index], self.replicas)
+                if data is not None:
+                    break
+            if data is None:
+                logging.warning("Couldn't fetch block %d of %s again" % (index, f.path))
+                return False
+            stamp = checksum.file_stamp(local_path)
+            filesystem.write_file(local_path, data, offset)
+            self.block_hashes.update(f.path, local_path, stamp, offset, length)
+            self._invalidate_caches(f.path)
+        logging.warning("Fetched %d of the %d blocks of %s again" % (len(bad), len(expected), f.path))
+        return True
     
+    def _fetch_file(self, file_path, peer_list):
+        '''
+        Downloads file_path into its local version file, in blocks from every
+        peer in peer_list at once if the file is big enough to be worth it.
+        returns the file model of the downloaded version, or None
+        '''
+        peer_list = [p for p in peer_list if (p.hostname, p.port) != (self.hostname, self.port)]
+        known = self.db.get_file(file_path)
+        peer_list = self.replicas.rank(peer_list, known.size if known and known.size else 0,
+                                       file_path)
+
+        if self.chunks is not None:
+            f = self._fetch_file_by_chunks(file_path, peer_list)
+            if f is not None:
+                return f
+
+        if len(peer_list) > 1:
+            block_hashes = self._get_block_hashes(file_path, peer_list)
+            if (block_hashes is not None and len(block_hashes.hashes) > 1 and
+                merkle.root(block_hashes.hashes) == block_hashes.file_model.checksum):
+                f = block_hashes.file_model
+                self.db.set_block_hashes(f.path, f.latest_version, block_hashes.block_size,
+                                         block_hashes.hashes)
+                local_path = filesystem.get_local_path(self, file_path, f.latest_version)
+                if swarm.download(f, block_hashes.block_size, block_hashes.hashes,
+                                  peer_list, local_path, self.replicas):
+                    return f
+                logging.warning("Block download of %s failed, downloading it whole" % file_path)
+
+        for peer in peer_list:
+            f = self._stream_file_from_peer(file_path, peer)
+            if f is not None:
+                return f
+        return None
+
+    def _fetch_file_by_chunks(self, file_path, peer_list):
+        '''
+        Downloads file_path from the first peer in peer_list that sends its
+        chunk manifest, copying the chunks we already have. returns the file
+        model, or None if none of its chunks are here and it's better
+        downloaded whole
+        '''
+        request = messages.ChunkManifestRequest(file_path)
+        for peer in peer_list:
+            try:
+                response = communication.request(request, peer, timeout=chunkstore.FETCH_TIMEOUT)
+            except (socket.error, RuntimeError), e:
+                logging.debug("Couldn't get the chunks of %s from %s: %s" % (file_path, peer, e))
+                continue
+            if not isinstance(response, messages.ChunkManifest):
+                continue
+
+            manifest = zip(response.hashes, response.sizes)
+            if not any(self.chunks.has_chunk(chunk_hash) for chunk_hash, size in manifest):
+                return None
+            f = response.file_model
+            local_path = filesystem.get_local_path(self, file_path, f.latest_version)
+            fetched = chunkstore.download(self.chunks, peer, f, manifest, local_path)
+            if fetched is not None:
+                logging.info("Downloaded %s, fetched %d of its %d bytes" % (file_path, fetched, f.size))
+                return f
+        return None
+
+    def _get_block_hashes(self, file_path, peer_list):
+        '''returns the BlockHashes of the first peer in peer_list that has file_path'''
+        request = messages.BlockHashesRequest(file_path, checksum.BLOCK_SIZE)
+        for peer in peer_list:
+            try:
+                response = communication.request(request, peer, timeout=swarm.BLOCK_TIMEOUT)
+            except (socket.error, RuntimeError), e:
+                logging.debug("Couldn't get block hashes of %s from %s: %s" % (file_path, peer, e))
+                continue
+            if isinstance(response, messages.BlockHashes):
+                return response
+        return None
+
+    def _stream_file_from_peer(self, file_path, peer):
+        '''
+        Streams file_path from peer straight into its local version file.
+        returns the file model sent by the peer, or None if it couldn't send the file
+        '''
+        file_download_request = messages.FileDownloadRequest(file_path, stream=True)
+        started = self.replicas.started(peer)
+        try:
+            with communication.pool.connection(peer) as peer_socket:
+                # a peer that stops sending raises socket.timeout, and the
+                # connection is closed rather than going back to the pool
+                peer_socket.settimeout(self.STREAM_TIMEOUT)
+                communication.send_message(file_download_request, peer, peer_socket)
+                response = communication.recv_message(peer_socket)
+                if not isinstance(response, messages.FileStreamHeader):
+                    peer_socket.settimeout(None)
+                    self.replicas.failed(peer, started)
+                    return None
+
+                f = response.file_model
+                if response.block_hashes and merkle.root(response.block_hashes) == f.checksum:
+                    # kept to check the blocks against if the download is damaged
+                    self.db.set_block_hashes(f.path, f.latest_version, checksum.BLOCK_SIZE,
+                                             response.block_hashes)
+                local_path = filesystem.get_local_path(self, file_path, f.latest_version)
+                filesystem.write_blocks(local_path, communication.recv_stream(peer_socket))
+                peer_socket.settimeout(None)
+                self.replicas.finished(peer, started, f.size or 0)
+                return f
+        except (socket.error, RuntimeError), e:
+            logging.error("Couldn't download %s from %s: %s" % (file_path, peer, e))
+            self.replicas.failed(peer, started)
+            return None
+
     # File Operations
     def is_tracker_online(self):
-        try:
-            communication.connect_to_peer(self.tracker)
-            return True
-        except socket.error, err:
-            logging.error("Couldn't connect to tracker" + err)
-            return False
-        
-    
+        # answered from the heartbeat's cached state
+        return self.heartbeat.is_online()
+
+    def _tracker_state_changed(self, online):
+        if not online:
+            logging.warning("%s : Lost the tracker, working offline" % self)
+            return
+
+        # replayed on another thread, the heartbeat keeps going meanwhile
+        threading.Thread(target=self._replay_journal, name="JournalReplay").start()
+
+    def _notifications_failed(self, msgs):
+        '''
+        called with the queued notifications the tracker couldn't be sent.
+        New files are journalled, the tracker hears about them when the
+        journal is replayed. returns the others, which are sent again
+        '''
+        left = []
+        for msg in msgs:
+            if msg.msg_type == MessageType.NEW_FILE_AVAILABLE:
+                f = msg.file_model
+                try:
+                    self.journal.append(journal.Op(journal.WRITE, f.path, version=f.latest_version,
+                                                   is_new=True))
+                    continue
+                except (IOError, OSError), e:
+                    logging.error("Couldn't journal the announcement of %s: %s" % (f.path, e))
+            left.append(msg)
+        return left
+
+    def _replay_journal(self):
+        replayed, left = self.journal.replay(self._replay_op, self.notifications.flush)
+        if replayed or left:
+            logging.info("%s : Replayed %d journalled operations, %d left" % (self, replayed, left))
+
+    def _replay_op(self, op):
+        if op.kind == journal.WRITE:
+            local_path = filesystem.get_local_path(self, op.path, op.version)
+            if self.db.get_file(op.path) is None or not os.path.exists(local_path):
+                return # deleted or moved since
+            file_model = FileModel(op.path, False,
+                                   checksum.combine(self.block_hashes.get(op.path, local_path)),
+                                   os.path.getsize(local_path), op.version)
+            if op.is_new:
+                self.notifications.send(messages.NewFileAvailable(file_model, self.port))
+                return
+            # sent right away, as it carries data, so the lease ends with it
+            with filesystem.map_range(local_path) as file_model.data:
+                self.notifications.send(messages.FileChanged(file_model, self.port, 0))
+        elif op.kind == journal.DELETE:
+            self.delete(op.path)
+        elif op.kind == journal.MOVE:
+            self.move(op.path, op.dest_path)
+        elif op.kind == journal.ARCHIVE:
+            # the local copy was archived already, the tracker's FileArchived
+            # for the same version is ignored
+            response = communication.request(messages.ArchiveRequest(op.path), self.tracker)
+            if not response.archived:
+                logging.warning("The tracker didn't archive %s" % op.path)
+
     @check_tracker_online
     def read(self, file_path, start_offset=None, length=-1):
-        local_path = filesystem.get_local_path(self, file_path)
-        
-        file_data = filesystem.read_file(local_path, start_offset, length)
+        # hot files are answered from memory, without the DB or the disk
+        file_data = self.read_cache.get(file_path, start_offset, length)
+        if file_data is not None:
+            return file_data
+
+        file_data = self._read_local(file_path, start_offset, length)
         if file_data != None:
             return file_data
+
+        if self.REMOTE_RANGE_READS and length is not None and length >= 0:
+            file_data = self._read_remote_range(file_path, start_offset or 0, length)
+            if file_data is not None:
+                return file_data
         
         self._download_file(file_path)
-        file_data = filesystem.read_file(file_path, start_offset, length)
-        
+        return self._read_local(file_path, start_offset, length)
+
+    def _read_remote_range(self, file_path, offset, length):
+        '''
+        Reads a range of file_path from a replica, without downloading the
+        rest of the file. returns None if no replica could send it
+        '''
+        file_data = self.range_cache.get(file_path, offset, length)
+        if file_data is not None:
+            return file_data
+
+        tried = set([(self.hostname, self.port)])
+        last_peer = self.range_cache.peer(file_path)
+        if last_peer is not None:
+            file_data = self._request_range(file_path, offset, length, last_peer)
+            if file_data is not None:
+                return file_data
+            tried.add((last_peer.hostname, last_peer.port))
+
+        peer_list = [p for p in self._get_peer_list(file_path)
+                     if (p.hostname, p.port) not in tried]
+        for peer in self.replicas.rank(peer_list, max(length or 0, 0), file_path):
+            file_data = self._request_range(file_path, offset, length, peer)
+            if file_data is not None:
+                return file_data
+        return None
+
+    def _request_range(self, file_path, offset, length, peer):
+        request = messages.ReadRangeRequest(file_path, offset, length)
+        started = self.replicas.started(peer)
+        try:
+            response = communication.request(request, peer, timeout=swarm.BLOCK_TIMEOUT)
+        except (socket.error, RuntimeError), e:
+            logging.debug("Couldn't read %s from %s: %s" % (file_path, peer, e))
+            self.replicas.failed(peer, started)
+            return None
+        if not isinstance(response, messages.FileBlock):
+            self.replicas.failed(peer, started)
+            return None
+
+        file_data = response.file_model.data
+        if file_data is None:
+            file_data = ""
+        elif isinstance(file_data, memoryview):
+            file_data = file_data.tobytes()
+        self.replicas.finished(peer, started, len(file_data))
+        self.range_cache.put(file_path, response.file_model, peer, offset, file_data)
         return file_data
+
+    def _read_local(self, file_path, start_offset=None, length=-1):
+        '''reads the local copy of file_path, keeping it in the read cache if it's small enough'''
+        generation = self.read_cache.begin_miss(file_path)
+        f = self.db.get_file(file_path)
+        if f is None:
+            return None
+        local_path = filesystem.get_local_path(self, file_path, f.latest_version)
+
+        if self.VERIFY_READS and f.size is not None:
+            return self._read_verified(f, local_path, start_offset, length)
+        if f.size is None or f.size > self.read_cache.max_entry_bytes:
+            return filesystem.read_file(local_path, start_offset, length)
+
+        file_data = filesystem.read_file(local_path)
+        if file_data is None:
+            return None
+        self.read_cache.put(file_path, f.latest_version, f.checksum, file_data, generation)
+        return readcache.byte_range(file_data, start_offset, length)
     
+    def _read_verified(self, f, local_path, start_offset, length):
+        '''
+        reads a range of the local copy of f, checking only the blocks it
+        covers. returns None if a bad block couldn't be fetched again
+        '''
+        if not os.path.exists(local_path):
+            return None
+        peer_list = None
+        leaves = self.db.get_block_hashes(f.path, f.latest_version, checksum.BLOCK_SIZE)
+        if leaves is None or merkle.root(leaves) != f.checksum:
+            peer_list = self._get_peer_list(f.path)
+            leaves = self._expected_leaves(f, peer_list)
+            if leaves is None:
+                logging.warning("No block hashes to check %s against" % f.path)
+                return None
+
+        start = start_offset or 0
+        end = f.size if length is None or length < 0 else min(f.size, start + length)
+        if start >= end:
+            return ""
+        bs = checksum.BLOCK_SIZE
+        first, last = start // bs, (end - 1) // bs
+        with filesystem.map_range(local_path, first * bs, (last + 1 - first) * bs) as data:
+            bad = [i for i in range(first, last + 1)
+                   if checksum.calc_checksum(buffer(data, (i - first) * bs, bs)) != leaves[i]]
+        if bad:
+            logging.warning("Blocks %s of %s don't match its Merkle tree" % (bad, f.path))
+            if peer_list is None:
+                peer_list = self._get_peer_list(f.path)
+            if not self._repair_blocks(f, local_path, peer_list, bad):
+                return None
+        return filesystem.read_file(local_path, start, end - start)
+
     def read_tracker_offline(self, file_path, start_offset=None, length=-1):
         file_data = filesystem.read_file(file_path, start_offset, length)
         if file_data != None:
@@ -227,6 +633,93 @@ class LocalPeer(Peer):
     
     @check_tracker_online
     def write(self, file_path, new_data, start_offset=None):
+        op, file_msg = self._write_local(file_path, new_data, start_offset, announce=True)
+        try:
+            self.notifications.send(file_msg) # let the tracker know about the file
+        except (socket.error, RuntimeError), e:
+            # the heartbeat hasn't noticed yet, the tracker hears about it on replay
+            logging.warning("Couldn't tell the tracker about %s: %s" % (file_path, e))
+            self.journal.append(op)
+
+    def write_tracker_offline(self, file_path, new_data, start_offset=None):
+        # the tracker hears about the write when the journal is replayed
+        op, file_msg = self._write_local(file_path, new_data, start_offset, announce=False)
+        self.journal.append(op)
+
+    @check_tracker_online
+    def replace(self, file_path, src_path):
+        '''
+        replaces the contents of file_path, which is in the DFS, with those
+        of the local file src_path. They're copied a block at a time into a
+        temporary file that takes the place of the version file once it's
+        complete, so readers and replicas only see the new version whole
+        '''
+        op, file_msg = self._replace_local(file_path, src_path, announce=True)
+        if file_msg is None:
+            return
+        f = file_msg.file_model
+        local_path = filesystem.get_local_path(self, file_path, f.latest_version)
+        try:
+            # all of the file from offset 0, sent right away from its mapping
+            with filesystem.map_range(local_path) as f.data:
+                self.notifications.send(file_msg)
+        except (socket.error, RuntimeError), e:
+            logging.warning("Couldn't tell the tracker about %s: %s" % (file_path, e))
+            self.journal.append(op)
+
+    def replace_tracker_offline(self, file_path, src_path):
+        op, file_msg = self._replace_local(file_path, src_path, announce=False)
+        if op is not None:
+            self.journal.append(op)
+
+    def _replace_local(self, file_path, src_path, announce):
+        '''
+        returns (journal op, message for the tracker) like _write_local(), or
+        (None, None) if src_path has the same contents as file_path already
+        '''
+        f = self.db.get_file(file_path)
+        if f is None:
+            raise RuntimeError("%s isn't in the DFS" % file_path)
+        local_path = filesystem.get_local_path(self, file_path, f.latest_version)
+
+        leaves = []
+        size = 0
+        part_file = filesystem.temp_file(local_path)
+        try:
+            for data in filesystem.read_blocks(src_path, checksum.BLOCK_SIZE):
+                leaves.append(checksum.calc_checksum(data))
+                size += len(data)
+                part_file.write(data)
+        except:
+            part_file.close()
+            filesystem.remove_part_file(part_file)
+            raise
+        part_file.close()
+
+        new_checksum = merkle.root(leaves)
+        if new_checksum == f.checksum and os.path.exists(local_path):
+            filesystem.remove_part_file(part_file)
+            return None, None
+        filesystem.replace_with_part_file(local_path, part_file)
+        self.block_hashes.put(file_path, local_path, leaves)
+
+        f.checksum = new_checksum
+        f.size = size
+        self.db.add_or_update_file(f)
+        self.db.add_local_file(f.path)
+        self._version_stored(file_path, f.latest_version, leaves)
+        op = journal.Op(journal.WRITE, file_path, version=f.latest_version, is_new=False)
+        if not announce:
+            return op, None
+        # replace() sends it with all of the file as its data
+        file_model = FileModel(file_path, False, new_checksum, size, f.latest_version)
+        return op, messages.FileChanged(file_model, self.port, 0)
+
+    def _write_local(self, file_path, new_data, start_offset, announce):
+        '''
+        writes to the local copy and returns (journal op, message for the
+        tracker). The message is None unless announce is set
+        '''
         f = self.db.get_file(file_path)
         
         if f is not None:
@@ -238,13 +731,27 @@ class LocalPeer(Peer):
         
         logging.info("Writing file %s to %s. New file? - %s", 
                         file_path, local_path, is_new_file)
-        
+
+        if (announce and start_offset is not None and not is_new_file and
+            not os.path.exists(local_path)):
+            # a positional write needs the rest of the file
+            self._download_file(file_path)
+
+        # the replicas have the version about to be overwritten. Its
+        # signature lets a rewrite of the whole file go out to them as a delta
+        base_signature = None
+        if (announce and start_offset is None and not is_new_file and
+            os.path.exists(local_path) and os.path.getsize(local_path) >= delta.MIN_FILE_SIZE):
+            base_signature = delta.signature(local_path)
+
+        # only the blocks the write touched are rehashed
+        old_stamp = checksum.file_stamp(local_path)
         filesystem.write_file(local_path, new_data, start_offset)
+        new_checksum = checksum.combine(self.block_hashes.update(
+            file_path, local_path, old_stamp, start_offset or 0, len(new_data)))
         
         is_directory = False
-        new_checksum = checksum.calc_file_checksum(local_path)
         new_size = os.path.getsize(local_path)
-        new_data = filesystem.read_file(local_path) # we have to read here in case there was an offset
 
         file_model = FileModel(file_path, 
                                is_directory,
@@ -252,47 +759,53 @@ class LocalPeer(Peer):
                                new_size,
                                latest_version=1,
                                data=None)
+        version = f.latest_version if f is not None else 1
         self.db.add_or_update_file(file_model)
-        file_model.data = new_data
+        self._version_stored(file_path, version,
+                             written=(old_stamp, start_offset or 0, len(new_data)))
+        op = journal.Op(journal.WRITE, file_path, version=version, is_new=is_new_file)
             
-        if is_new_file:                                                
-            file_msg = messages.NewFileAvailable(file_model, self.port)
-        else:
-            self.db.add_or_update_file(f)
-            self.db.add_local_file(f.path)
+        if not is_new_file:
+            base_checksum = f.checksum
             f.checksum = new_checksum
             f.size = new_size
-            file_msg = messages.FileChanged(file_model, self.port, start_offset)
-        
-        communication.send_message(file_msg, self.tracker) # let the tracker know about the file
+            self.db.add_or_update_file(f)
+            self.db.add_local_file(f.path)
 
-        # I believe that the following should be done by the tracker
-        # Only do this if the tracker is offline
+        if not announce:
+            return op, None
+        elif is_new_file:                                                
+            # replicas stream the file from us, so the data isn't sent along
+            file_msg = messages.NewFileAvailable(file_model, self.port)
+        else:
+            # just the written range goes out. The replicas write it at
+            # start_offset and truncate their copy to file_model.size
+            file_model.data = new_data
+            file_msg = messages.FileChanged(file_model, self.port, start_offset or 0,
+                                            base_checksum=base_checksum
+                                            if start_offset is not None else None)
+            if base_signature is not None:
+                file_delta = delta.compute(base_signature, file_model.data)
+                if file_delta is not None:
+                    logging.info("Sending a %d byte delta for %s instead of %d bytes",
+                                 len(file_delta), file_path, new_size)
+                    file_model.data = None
+                    file_msg = messages.FileChanged(file_model, self.port, delta=file_delta,
+                                                    base_checksum=base_checksum)
+        
+        return op, file_msg
 
-        # get peer list
-        #peer_list = self._get_peer_list(file_path)
-        
-        #for peer in peer_list:
-        #    communication.send_message(file_msg, peer)
-        
-    def write_tracker_offline(self):
-        
-        #record the write in a backlog
-        
-        # send out newfile/filechanged messages to all peers
-        
-        pass
-    
+    @check_tracker_online
     def delete(self, file_path):
         delete_request = messages.DeleteRequest(file_path)
-        communication.send_message(delete_request, self.tracker)
-        delete_response = communication.recv_message(self.tracker)
+        delete_response = communication.request(delete_request, self.tracker)
         
         if not delete_response.can_delete:
             return False
         
         if (os.path.exists(file_path)):
             os.remove(file_path)
+        self._invalidate_caches(file_path)
         
         peer_list = delete_response.peer_list
         
@@ -303,35 +816,50 @@ class LocalPeer(Peer):
             
         return True
     
+    def delete_tracker_offline(self, file_path):
+        if self.db.get_file(file_path) is None:
+            return False
+        self._delete_local(file_path)
+        self.journal.append(journal.Op(journal.DELETE, file_path))
+        return True
+    
+    @check_tracker_online
     def move(self, src_path, dest_path):
         move_request = messages.MoveRequest(src_path, dest_path)
-        communication.send_message(move_request, self.tracker) 
-        move_response = communication.recv_message(self.tracker)
+        move_response = communication.request(move_request, self.tracker)
         
         if not move_response.valid:
             return False
         
         filesystem.move(src_path, dest_path)
+        self._invalidate_caches(src_path)
+        self._invalidate_caches(dest_path)
         
         peer_list = self._get_peer_list(src_path)
         move_msg = messages.Move(src_path, dest_path)
         for peer in peer_list:
-            communication.send_message(move_msg, peer, socket)
+            communication.send_message(move_msg, peer)
         
         return True
     
+    def move_tracker_offline(self, src_path, dest_path):
+        filesystem.move(src_path, dest_path)
+        self._invalidate_caches(src_path)
+        self._invalidate_caches(dest_path)
+        self.journal.append(journal.Op(journal.MOVE, src_path, dest_path))
+        return True
+    
     def ls(self,dir_path=None):
         list_request = messages.ListRequest(dir_path)
-        communication.send_message(list_request, self.tracker)
-        list_response = communication.recv_message(self.tracker)
+        list_response = communication.request(list_request, self.tracker)
         
         return list_response.file_list
         
     
+    @check_tracker_online
     def archive(self,file_path):
         archive_request = messages.ArchiveRequest(file_path)
-        communication.send_message(archive_request, self.tracker)
-        archive_response = communication.recv_message(self.tracker)
+        archive_response = communication.request(archive_request, self.tracker)
         
         archived = archive_response.archived
         
@@ -342,16 +870,66 @@ class LocalPeer(Peer):
         if not f:
             return False
         
-        local_file_path = filesystem.get_local_path(self, file_path, f.latest_version)
-        file_data = filesystem.read_file(local_file_path)
-        
         f.latest_version += 1
         self.db.add_or_update_file(f)
+        self._archive_local_version(file_path, f.latest_version - 1, f.latest_version)
         
-        local_file_path = filesystem.get_local_path(self, file_path, f.latest_version)
-        filesystem.write_file(local_file_path, file_data)
+        return True
+
+    def archive_tracker_offline(self, file_path):
+        f = self.db.get_file(file_path)
+        if not f:
+            return False
         
+        f.latest_version += 1
+        self.db.add_or_update_file(f)
+        self._archive_local_version(file_path, f.latest_version - 1, f.latest_version)
+        self.journal.append(journal.Op(journal.ARCHIVE, file_path, version=f.latest_version - 1))
         return True
+
+    def _archive_local_version(self, file_path, old_version, new_version):
+        '''makes the local copy of old_version the start of new_version'''
+        local_file_path = filesystem.get_local_path(self, file_path, old_version)
+        new_file_path = filesystem.get_local_path(self, file_path, new_version)
+        with filesystem.map_range(local_file_path) as file_data:
+            filesystem.write_file(new_file_path, file_data)
+
+        if self.chunks is not None:
+            self._version_stored(file_path, new_version)
+            self.chunks.archive_version(file_path, old_version)
+
+    def _invalidate_caches(self, file_path):
+        self.read_cache.invalidate(file_path)
+        self.range_cache.invalidate(file_path)
+
+    def _file_lock(self, file_path):
+        with self._file_locks_lock:
+            return self._file_locks.setdefault(file_path, threading.Lock())
+
+    def _leaves(self, f, local_path):
+        '''the leaves of the Merkle tree of the local copy of the version described by f'''
+        leaves = self.db.get_block_hashes(f.path, f.latest_version, checksum.BLOCK_SIZE)
+        if leaves is None or merkle.root(leaves) != f.checksum:
+            leaves = self.block_hashes.get(f.path, local_path)
+        return leaves
+
+    def _version_stored(self, file_path, version, leaves=None, written=None):
+        '''
+        called after a version file is written or replaced. leaves are its
+        block hashes, if the writer already has them. written is
+        (file_stamp() from before, offset, length) for a positional write
+        '''
+        self._invalidate_caches(file_path)
+        local_path = filesystem.get_local_path(self, file_path, version)
+        if leaves is None and os.path.exists(local_path):
+            leaves = self.block_hashes.get(file_path, local_path)
+        if leaves is not None:
+            self.db.set_block_hashes(file_path, version, checksum.BLOCK_SIZE, leaves)
+        if self.chunks is not None:
+            if written is not None:
+                self.chunks.add_version(file_path, version, local_path, *written)
+            else:
+                self.chunks.add_version(file_path, version, local_path)
         
     
     def start_accepting_connections(self):
@@ -368,8 +946,20 @@ class LocalPeer(Peer):
         if self._acceptorThread.isAlive():
             print "Timed out. Try again later."
         else:
-            self._acceptorThread = AcceptorThread(self)
+            self._acceptorThread = self._make_server()
+        self.heartbeat.stop()
+        communication.pool.close_all()
+        communication.multiplexer.close_all()
+        if self._hasher_acquired:
+            # the other peers in the process may still use the pool
+            self._hasher_acquired = False
+            self.hasher.release()
     
+    def _make_server(self):
+        if self.SERVER_ENGINE == "eventloop":
+            return eventloop.EventLoopServer(self)
+        return AcceptorThread(self)
+
     def get_server_socket(self):
         return self._server_socket
 
@@ -385,20 +975,25 @@ class LocalPeer(Peer):
     
     def add_file(self, src_file_path, dest_file_path):
         logging.info("Adding file to system")
-        file = open(src_file_path, "r")
-        data = file.read() 
-        file.close()
-        
-        self.write(dest_file_path, data)
+        files = [(src_file_path, dest_file_path, os.path.getsize(src_file_path))]
+        # a new file is streamed in, an existing one goes through write()
+        return self.import_files(files, parallel=False).failed == 0
+
+    def import_tree(self, src_root, dest_root="", parallel=True, progress=None):
+        '''imports every file under the local directory src_root. returns the BulkImport'''
+        logging.info("Importing %s into %s" % (src_root, dest_root or "/"))
+        return self.import_files(bulkimport.walk(src_root, dest_root), parallel, progress)
+
+    def import_files(self, files, parallel=True, progress=None):
+        '''files is a list of (source path, DFS path, size). returns the BulkImport'''
+        return bulkimport.BulkImport(self, parallel, progress=progress).run(files)
 
     #TODO: Probably makes more sense to make all these functions part of the peer class
     
     def _get_peer_list(self, file_path):
         logging.info("Requesting a peers list")
         peer_list_request = messages.PeerListRequest(file_path)
-        communication.send_message(peer_list_request, self.tracker)
-        
-        peer_list_response = communication.recv_message(self.tracker)
+        peer_list_response = communication.request(peer_list_request, self.tracker)
         peer_list = peer_list_response.peer_list
         logging.info("Received a peers list:\n%s" % [str(p) for p in peer_list])
         return peer_list
@@ -410,6 +1005,11 @@ class LocalPeer(Peer):
         
         file_model = FileModel(f, isDir, size, cs, 0)
 
+    def handle_message(self, client_socket, received_msg):
+        logging.debug("Handling " + str(received_msg))
+        handler_method = self.get_handler_method_index()[received_msg.msg_type]
+        handler_method(client_socket, received_msg)
+
     def get_handler_method_index(self):
         return {MessageType.ARCHIVE_REQUEST : self.handle_ARCHIVE_REQUEST,
                 MessageType.PEER_LIST_REQUEST : self.handle_PEER_LIST_REQUEST,
@@ -417,6 +1017,13 @@ class LocalPeer(Peer):
                 MessageType.FILE_DOWNLOAD_REQUEST : self.handle_FILE_DOWNLOAD_REQUEST,
                 MessageType.FILE_DOWNLOAD_DECLINE : self.handle_FILE_DOWNLOAD_DECLINE,
                 MessageType.FILE_DATA : self.handle_FILE_DATA,
+                MessageType.FILE_BLOCK_REQUEST : self.handle_FILE_BLOCK_REQUEST,
+                MessageType.FILE_BLOCK : self.handle_FILE_BLOCK,
+                MessageType.READ_RANGE_REQUEST : self.handle_READ_RANGE_REQUEST,
+                MessageType.BLOCK_HASHES_REQUEST : self.handle_BLOCK_HASHES_REQUEST,
+                MessageType.BLOCK_HASHES : self.handle_BLOCK_HASHES,
+                MessageType.CHUNK_MANIFEST_REQUEST : self.handle_CHUNK_MANIFEST_REQUEST,
+                MessageType.CHUNK_MANIFEST : self.handle_CHUNK_MANIFEST,
                 
                 MessageType.CONNECT_REQUEST : self.handle_CONNECT_REQUEST,
                 MessageType.CONNECT_RESPONSE : self.handle_CONNECT_RESPONSE,
@@ -426,6 +1033,10 @@ class LocalPeer(Peer):
                 
                 MessageType.FILE_CHANGED : self.handle_FILE_CHANGED,
                 MessageType.NEW_FILE_AVAILABLE : self.handle_NEW_FILE_AVAILABLE,
+                MessageType.NOTIFICATION_BATCH : self.handle_NOTIFICATION_BATCH,
+
+                MessageType.HEARTBEAT : self.handle_HEARTBEAT,
+                MessageType.HEARTBEAT_RESPONSE : self.handle_HEARTBEAT_RESPONSE,
                 
                 MessageType.VALIDATE_CHECKSUM_REQUEST : self.handle_VALIDATE_CHECKSUM_REQUEST,
                 MessageType.VALIDATE_CHECKSUM_RESPONSE : self.handle_VALIDATE_CHECKSUM_RESPONSE,
@@ -450,6 +1061,9 @@ class LocalPeer(Peer):
         source_ip = client_socket.getpeername()[0]
         source_port = msg.port
         self.db.add_or_update_peer(source_ip, source_port, PeerState.ONLINE)
+        communication.set_wire_version(source_ip, source_port, getattr(msg, "wire_version", 0))
+        communication.set_compression(source_ip, source_port,
+                                      compression.choose_method(getattr(msg, "compression", None)))
             
         
     # not used - tracker
@@ -480,23 +1094,102 @@ class LocalPeer(Peer):
         logging.info("Handling the file download request for file " + msg.file_path)
         # TODO Need to be aware of versioning here.
         local_path = filesystem.get_local_path(self, msg.file_path)
-        file_data = filesystem.read_file(local_path)
-        if file_data is None:
-            response = messages.FileDownloadDecline(msg.file_path)
-        else:
+        if getattr(msg, "stream", False) and os.path.exists(local_path):
             fm = self.db.get_file(msg.file_path)
-            fm.data = file_data
-            response = messages.FileData(fm)
-        communication.send_message(response, socket=client_socket)
+            header = messages.FileStreamHeader(fm, self._leaves(fm, local_path))
+            communication.send_message(header, socket=client_socket)
+            communication.send_file_stream(local_path, client_socket)
+            return
+
+        with filesystem.map_range(local_path) as file_data:
+            if file_data is None:
+                response = messages.FileDownloadDecline(msg.file_path)
+            else:
+                fm = self.db.get_file(msg.file_path)
+                fm.data = file_data
+                response = messages.FileData(fm)
+            communication.send_message(response, socket=client_socket)
     
 
     def handle_FILE_DOWNLOAD_DECLINE(self, client_socket, msg):
         pass
+
+    def handle_FILE_BLOCK_REQUEST(self, client_socket, msg):
+        local_path = filesystem.get_local_path(self, msg.file_path, msg.version)
+        # sent straight from the file's mapping
+        with filesystem.map_range(local_path, msg.offset, msg.length) as data:
+            if data is None and self.chunks is not None:
+                # archived versions are only kept as chunks
+                data = self.chunks.read_range(msg.file_path, msg.version, msg.offset, msg.length)
+            fm = self.db.get_file(msg.file_path)
+            if data is None or fm is None:
+                response = messages.FileDownloadDecline(msg.file_path)
+            else:
+                fm.data = data
+                response = messages.FileBlock(fm, msg.offset)
+            communication.send_message(response, socket=client_socket)
+
+    # not used - only received as responses to requests
+    def handle_FILE_BLOCK(self, client_socket, msg):
+        pass
+
+    def handle_READ_RANGE_REQUEST(self, client_socket, msg):
+        fm = self.db.get_file(msg.file_path)
+        if fm is None:
+            communication.send_message(messages.FileDownloadDecline(msg.file_path),
+                                       socket=client_socket)
+            return
+        local_path = filesystem.get_local_path(self, msg.file_path, fm.latest_version)
+        with filesystem.map_range(local_path, msg.offset, msg.length) as data:
+            if data is None:
+                response = messages.FileDownloadDecline(msg.file_path)
+            else:
+                fm.data = data
+                response = messages.FileBlock(fm, msg.offset)
+            communication.send_message(response, socket=client_socket)
+
+    def handle_BLOCK_HASHES_REQUEST(self, client_socket, msg):
+        local_path = filesystem.get_local_path(self, msg.file_path)
+        fm = self.db.get_file(msg.file_path)
+        if fm is None or not os.path.exists(local_path):
+            response = messages.FileDownloadDecline(msg.file_path)
+        else:
+            if msg.block_size == checksum.BLOCK_SIZE:
+                hashes = self._leaves(fm, local_path)
+            else:
+                hashes = swarm.block_hashes(local_path, msg.block_size)
+            response = messages.BlockHashes(fm, msg.block_size, hashes)
+        communication.send_message(response, socket=client_socket)
+
+    # not used - only received as responses to requests
+    def handle_BLOCK_HASHES(self, client_socket, msg):
+        pass
+
+    def handle_CHUNK_MANIFEST_REQUEST(self, client_socket, msg):
+        fm = self.db.get_file(msg.file_path)
+        local_path = filesystem.get_local_path(self, msg.file_path)
+        manifest = None
+        if fm is not None and os.path.exists(local_path):
+            if self.chunks is not None:
+                manifest = self.chunks.manifest(msg.file_path, fm.latest_version)
+            if manifest is None:
+                manifest = chunkstore.manifest_of(local_path)
+
+        if manifest is None:
+            response = messages.FileDownloadDecline(msg.file_path)
+        else:
+            response = messages.ChunkManifest(fm, [chunk_hash for chunk_hash, size in manifest],
+                                              [size for chunk_hash, size in manifest])
+        communication.send_message(response, socket=client_socket)
+
+    # not used - only received as responses to requests
+    def handle_CHUNK_MANIFEST(self, client_socket, msg):
+        pass
     
     
     def handle_FILE_DATA(self, client_socket, file_data_msg):
         logging.info("Received file data for file " + file_data_msg.file_model.path)
-        logging.info("File data: " + file_data_msg.file_model.data)
+        logging.info("File size: %d" % len(file_data_msg.file_model.data))
         # save file
         f = file_data_msg.file_model
         start_offset = file_data_msg.start_offset
@@ -506,6 +1199,7 @@ class LocalPeer(Peer):
         
         # add file to db
         self.db.add_or_update_file(f)
+        self._version_stored(f.path, f.latest_version)
         
         file_model = FileModel(f.path, f.is_dir, f.checksum, f.size, f.latest_version, f.data)
         new_file_available_msg = messages.NewFileAvailable(file_model)
@@ -513,10 +1207,17 @@ class LocalPeer(Peer):
         if self.is_tracker_online():
             communication.send_message(new_file_available_msg, self.tracker)
         else:
-            self._backlog.append((new_file_available_msg, self.tracker))
+            self.journal.append(journal.Op(journal.WRITE, f.path, version=f.latest_version,
+                                           is_new=True))
 
     
     def handle_FILE_CHANGED(self, client_socket, file_changed_msg):        
+        # changes to one file are applied one at a time, ranges and deltas
+        # only make sense on top of the version they were made against
+        with self._file_lock(file_changed_msg.file_model.path):
+            self._apply_file_change(client_socket, file_changed_msg)
+
+    def _apply_file_change(self, client_socket, file_changed_msg):
         remote_file = file_changed_msg.file_model
         start_offset = file_changed_msg.start_offset
 
@@ -535,24 +1236,65 @@ class LocalPeer(Peer):
             logging.warning("Recieved a file change message, but there is no such file locally")
             return
         
-        filesystem.write_file(local_path, remote_file.data, start_offset)
-        
-        new_checksum = checksum.calc_file_checksum(local_path)
+        if (file_changed_msg.base_checksum is not None and
+            db_file.checksum != file_changed_msg.base_checksum):
+            logging.info("Received a change to a version of %s we don't have. Downloading it",
+                         remote_file.path)
+            self.downloader.request(remote_file.path)
+            return
+
+        written = None
+        if file_changed_msg.delta is not None:
+            try:
+                filesystem.write_blocks(local_path, delta.apply(local_path, file_changed_msg.delta))
+            except delta.DeltaError, e:
+                logging.warning("Couldn't apply the delta for %s: %s" % (remote_file.path, e))
+                self.downloader.request(remote_file.path)
+                return
+            self._invalidate_caches(remote_file.path)
+            new_checksum = checksum.combine(self.block_hashes.get(remote_file.path, local_path))
+        elif remote_file.data is None:
+            logging.warning("Received a change to %s without its data. Downloading it",
+                            remote_file.path)
+            self.downloader.request(remote_file.path)
+            return
+        else:
+            # the written range, or all of the file from offset 0
+            old_stamp = checksum.file_stamp(local_path)
+            filesystem.write_file(local_path, remote_file.data, start_offset or 0)
+            if remote_file.size is not None and os.path.getsize(local_path) > remote_file.size:
+                filesystem.truncate(local_path, remote_file.size)
+            self._invalidate_caches(remote_file.path)
+            new_checksum = checksum.combine(self.block_hashes.update(
+                remote_file.path, local_path, old_stamp, start_offset or 0, len(remote_file.data)))
+            written = (old_stamp, start_offset or 0, len(remote_file.data))
         
         if new_checksum == remote_file.checksum:
             logging.debug("File was updated. Notifying the tracker.")
-            # notify tracker that peer now has updated file
+            # notify tracker that peer now has updated file. It doesn't need the data back
             file_changed_msg.port = self.port
-            communication.send_message(file_changed_msg, self.tracker)
+            file_changed_msg.delta = file_changed_msg.base_checksum = None
+            remote_file.data = None
+            self.notifications.send(file_changed_msg)
             self.db.add_or_update_file(remote_file)
+            self._version_stored(remote_file.path, remote_file.latest_version, written=written)
         else:
             logging.warning("Updated local file as per file changed message, but checksums don't " +
                             "match. Re-reqesting the file")
-            communication.send_message(messages.FileDownloadRequest(remote_file.path), socket=client_socket)
+            self.downloader.request(remote_file.path)
     
     def handle_NEW_FILE_AVAILABLE(self, client_socket, msg):
-        #self.db.add_or_update_file(msg.file_model)
-        self._download_file(msg.file_model.path)
+        self.downloader.request(msg.file_model.path)
+
+    # not used - tracker
+    def handle_NOTIFICATION_BATCH(self, client_socket, msg):
+        pass
+
+    def handle_HEARTBEAT(self, client_socket, msg):
+        communication.send_message(messages.HeartbeatResponse(), socket=client_socket)
+
+    def handle_HEARTBEAT_RESPONSE(self, client_socket, msg):
+        pass
 
     def handle_VALIDATE_CHECKSUM_REQUEST(self, client_socket, msg):
         pass
@@ -570,6 +1312,9 @@ class LocalPeer(Peer):
     def handle_DELETE(self, client_socket, delete_msg):
         file_path = delete_msg.file_path
         
+        self._delete_local(file_path)
+
+    def _delete_local(self, file_path):
         f = self.db.get_file(file_path)
         if not f:
             return
@@ -578,9 +1323,11 @@ class LocalPeer(Peer):
         for versionIdx in range(f.latest_version): 
             local_file_path = filesystem.get_local_path(self, file_path, versionIdx + 1)
             filesystem.delete_file(local_file_path)
-        
+        if self.chunks is not None:
+            self.chunks.remove_file(file_path)
         
         self.db.delete_file(file_path)
+        self._invalidate_caches(file_path)
     
     def handle_MOVE_REQUEST(self, client_socket, msg):
         pass
@@ -592,12 +1339,13 @@ class LocalPeer(Peer):
         dest_path = msg.dest_path
         
         filesystem.move(src_path, dest_path)
+        self._invalidate_caches(src_path)
+        self._invalidate_caches(dest_path)
     
     def handle_LIST_REQUEST(self, client_socket, msg):
         logging.debug("Handling list request")        
         file_list = self.db.list_files(msg.dir_path)
-        response = messages.Message(messages.MessageType.LIST)
-        response.file_list = file_list
+        response = messages.List(file_list)
         communication.send_message(response, socket=client_socket)
         
     def handle_LIST(self, client_socket, msg):
@@ -613,19 +1361,19 @@ class LocalPeer(Peer):
         file_path = file_archived_msg.file_path
         new_version = file_archived_msg.new_version
         
+        self._invalidate_caches(file_path)
         f = self.db.get_file(file_path)
         if not f:
             return
-        if f.latest_version == new_version:
+        if f.latest_version >= new_version:
+            # already archived here, while the tracker was offline
             return
-        local_file_path = filesystem.get_local_path(self, file_path, f.latest_version)
-        file_data = filesystem.read_file(local_file_path)
+        old_version = f.latest_version
         
         f.latest_version = new_version
         self.db.add_or_update_file(f)
         
-        local_file_path = filesystem.get_local_path(self, file_path, f.latest_version)
-        filesystem.write_file(local_file_path, file_data)
+        self._archive_local_version(file_path, old_version, new_version)
     
 class AcceptorThread(threading.Thread):
     def __init__(self, peer):
@@ -646,8 +1394,8 @@ class AcceptorThread(threading.Thread):
             readable, writable, errored = select.select([server_socket], [], [], 0.5)
             if len(readable) != 0:                
                 client_socket, addr = server_socket.accept()
-                handler = HandlerThread(self._peer, client_socket)
-                handler.start()
+                connection = ConnectionThread(self._peer, client_socket)
+                connection.start()
             if self.stop:                
                 break
     
@@ -656,28 +1404,52 @@ class AcceptorThread(threading.Thread):
         self.alive.clear()        
         threading.Thread.join(self, timeout)
 
-class HandlerThread(threading.Thread):
-    def __init__(self, peer, client_socket):            
-        super(HandlerThread, self).__init__()
-        self.daemon = False
-        self.name = type(peer).__name__ + "_Handler"
+class ConnectionThread(threading.Thread):
+    """Reads messages off one accepted connection until the peer closes it.
+
+    Connections are pooled or multiplexed on the other end, so a connection
+    carries many messages. They're handled on the peer's worker pool so a
+    slow handler doesn't hold up the next message on the connection. If the
+    message's lane is full it's held (workers.HeldMessages) and reading goes
+    on, so control messages get past bulk ones. Reading only stops while
+    the connection has MAX_HELD messages held. Handlers reply through a
+    ReplySocket, which tags the reply with the request's id.
+    """
+    # how often held messages are retried
+    RETRY_INTERVAL = 0.01
+
+    def __init__(self, peer, client_socket):
+        super(ConnectionThread, self).__init__()
+        self.daemon = True
+        self.name = type(peer).__name__ + "_Connection"
         self._peer = peer
-        self._client_socket = client_socket    
-    
-        
-    def run(self):
-        logging.debug("Spawned a HandlerThread")
-        received_msg = communication.recv_message(socket=self._client_socket)
+        self._client_socket = client_socket
+        self._send_lock = threading.Lock()
 
-        msg_type = received_msg.msg_type
-        logging.debug("Received " + str(received_msg))
-        
-        handler_method_index = self._peer.get_handler_method_index()
-        
-        handler_method = handler_method_index[msg_type]
-        handler_method(self._client_socket, received_msg)
-    
-    def join(self, timeout=None):
-        logging.debug("Ending thread")
-        threading.Thread.join(self, timeout)
+    def run(self):
+        logging.debug("Spawned a ConnectionThread")
+        held = workers.HeldMessages(self._peer.worker_pool)
+        try:
+            while True:
+                if held.retry():
+                    # wait for the next message only as long as the retry interval
+                    if held.full():
+                        time.sleep(self.RETRY_INTERVAL)
+                        continue
+                    readable = select.select([self._client_socket], [], [], self.RETRY_INTERVAL)[0]
+                    if not readable:
+                        continue
+                try:
+                    received_msg = communication.recv_message(socket=self._client_socket)
+                except communication.ConnectionClosed:
+                    break
 
+                reply_socket = communication.ReplySocket(self._client_socket,
+                                                         getattr(received_msg, "request_id", 0),
+                                                         self._send_lock)
+                held.submit(workers.lane_of(received_msg.msg_type),
+                            self._peer.handle_message, reply_socket, received_msg)
+        except (socket.error, RuntimeError), e:
+            logging.debug("Connection dropped: " + str(e))
+        finally:
+            self._client_socket.close()
@@ -0,0 +1,145 @@
+'''
+rangecache.py - Sparse local copies of the parts of remote files that were read
+
+A peer without a copy of a file reads ranges of it from a replica (see
+LocalPeer._read_remote_range) instead of downloading all of it. The ranges
+it gets back are written at their offsets into a sparse file under
+<root_path>/.ranges, so reading them again doesn't go over the network.
+
+A peer without a copy doesn't hear about changes to the file, so the cached
+ranges are only used for TTL seconds after a replica last answered for the
+file. A range that comes back for a different version or checksum
+throws away everything cached for the file. Whole files are evicted, least
+recently used first, once the cache holds more than max_bytes.
+'''
+
+import bisect
+import collections
+import hashlib
+import os
+import threading
+import time
+
+import filesystem
+
+MAX_BYTES = 256 * 2 ** 20
+TTL = 5.0
+
+
+class _SparseFile(object):
+    def __init__(self, local_path, file_model, peer):
+        self.local_path = local_path
+        self.file_model = file_model
+        self.peer = peer
+        self.validated = time.time()
+        self.starts = [] # sorted starts of the cached, non-overlapping ranges
+        self.ends = []
+        self.bytes = 0
+
+    def covers(self, start, end):
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def add(self, start, end):
+        # merge with every range it overlaps or touches
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        removed = sum(self.ends[k] - self.starts[k] for k in range(i, j))
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+        self.bytes += end - start - removed
+
+
+class RangeCache(object):
+    def __init__(self, peer, max_bytes=MAX_BYTES, ttl=TTL):
+        self._peer = peer
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._files = collections.OrderedDict() # file path -> _SparseFile, least recently used first
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _local_path(self, file_path):
+        name = hashlib.md5(file_path.encode("utf-8")).hexdigest()
+        return os.path.join(self._peer.root_path, ".ranges", name)
+
+    def _size(self, sparse, start, length):
+        size = sparse.file_model.size
+        return length if size is None else max(0, min(length, size - start))
+
+    def get(self, file_path, start, length):
+        '''returns the cached range, or None if it isn't all cached or may be stale'''
+        with self._lock:
+            sparse = self._files.get(file_path)
+            if sparse is None or time.time() - sparse.validated > self.ttl:
+                self.misses += 1
+                return None
+            length = self._size(sparse, start, length)
+            if not sparse.covers(start, start + length):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._files[file_path] = self._files.pop(file_path)
+            return filesystem.read_range(sparse.local_path, start, length)
+
+    def peer(self, file_path):
+        '''returns the replica that last served a range of file_path, or None'''
+        with self._lock:
+            sparse = self._files.get(file_path)
+            return sparse.peer if sparse is not None else None
+
+    def put(self, file_path, file_model, peer, start, data):
+        '''records data, a range of the version described by file_model, served by peer'''
+        if not data or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            sparse = self._files.pop(file_path, None)
+            if sparse is not None and (sparse.file_model.latest_version != file_model.latest_version or
+                                       sparse.file_model.checksum != file_model.checksum):
+                self._drop(sparse)
+                sparse = None
+            if sparse is None:
+                sparse = _SparseFile(self._local_path(file_path), file_model, peer)
+                filesystem.write_file(sparse.local_path, "")
+            self._files[file_path] = sparse
+            sparse.peer = peer
+            sparse.validated = time.time()
+
+            f = open(sparse.local_path, "r+b")
+            try:
+                f.seek(start)
+                f.write(data)
+            finally:
+                f.close()
+            before = sparse.bytes
+            sparse.add(start, start + len(data))
+            self._bytes += sparse.bytes - before
+
+            while self._bytes > self.max_bytes:
+                evicted_path, evicted = self._files.popitem(last=False)
+                self._drop(evicted)
+                self.evictions += 1
+
+    def invalidate(self, file_path):
+        with self._lock:
+            sparse = self._files.pop(file_path, None)
+            if sparse is not None:
+                self._drop(sparse)
+
+    def _drop(self, sparse):
+        # must be called with _lock held, after sparse is taken out of _files
+        self._bytes -= sparse.bytes
+        filesystem.delete_file(sparse.local_path)
+
+    def report(self):
+        with self._lock:
+            return ("range cache: %d files, %d/%d bytes, %d hits, %d misses, %d evictions" %
+                    (len(self._files), self._bytes, self.max_bytes, self.hits, self.misses,
+                     self.evictions))
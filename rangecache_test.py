@@ -0,0 +1,63 @@
+"""
+rangecache_test.py - Test file for rangecache.py
+"""
+
+import shutil
+import tempfile
+
+import rangecache
+from messages import FileModel
+
+class FakePeer(object):
+    def __init__(self, root_path):
+        self.root_path = root_path
+
+def test_ranges():
+    print "Testing ranges"
+    sparse = rangecache._SparseFile("unused", None, None)
+    sparse.add(100, 200)
+    sparse.add(300, 400)
+    assert sparse.covers(120, 180) and not sparse.covers(150, 350)
+    sparse.add(200, 300) # fills the gap
+    assert (sparse.starts, sparse.ends, sparse.bytes) == ([100], [400], 300)
+    sparse.add(0, 50)
+    sparse.add(40, 120)
+    assert (sparse.starts, sparse.ends, sparse.bytes) == ([0], [400], 400)
+
+def test_cache():
+    print "Testing cache"
+    root = tempfile.mkdtemp()
+    try:
+        cache = rangecache.RangeCache(FakePeer(root), max_bytes=1000)
+        v1 = FileModel(u"f", False, "c1", 10000, 1)
+        cache.put(u"f", v1, "peer", 5000, "x" * 100)
+        assert cache.get(u"f", 5010, 50) == "x" * 50
+        assert cache.get(u"f", 4990, 50) is None
+        assert cache.peer(u"f") == "peer"
+
+        # reading past the end of the file only needs what's there
+        cache.put(u"f", v1, "peer", 9950, "e" * 50)
+        assert cache.get(u"f", 9960, 100) == "e" * 40
+
+        # a new version throws away the old ranges
+        v2 = FileModel(u"f", False, "c2", 10000, 1)
+        cache.put(u"f", v2, "peer", 0, "y" * 10)
+        assert cache.get(u"f", 5010, 50) is None
+
+        cache.ttl = -1
+        assert cache.get(u"f", 0, 10) is None
+
+        cache.put(u"g", v1, "peer", 0, "z" * 995)
+        assert cache.evictions == 1
+        cache.invalidate(u"g")
+        assert "0 files, 0/1000 bytes" in cache.report()
+    finally:
+        shutil.rmtree(root)
+
+def run():
+    test_ranges()
+    test_cache()
+    print "rangecache tests passed"
+
+if __name__ == "__main__":
+    run()
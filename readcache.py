@@ -0,0 +1,106 @@
+'''
+readcache.py - LRU cache of file contents for LocalPeer.read()
+
+Whole files up to MAX_ENTRY_FRACTION of the cache are kept, keyed by
+(path, version, checksum). The key of each path's current version is kept
+too, so a hit is served without looking the file up in the DB or touching
+the filesystem. Anything that changes a file's version file, or moves or
+deletes it, calls invalidate().
+
+A reader that misses looks the file up and reads it, then put()s it. If
+the path was invalidated in between, the data it read may be stale, so
+put() takes the generation returned by begin_miss() and drops the data if
+it has changed.
+'''
+
+import collections
+import threading
+
+MAX_BYTES = 64 * 2 ** 20
+MAX_ENTRY_FRACTION = 8
+
+
+class ReadCache(object):
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // MAX_ENTRY_FRACTION
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # (path, version, checksum) -> data, oldest first
+        self._current = {} # path -> key of its current version
+        self._generations = {} # path -> times it's been invalidated
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, path, start_offset=None, length=-1):
+        '''returns the requested range of path's current version, or None'''
+        with self._lock:
+            key = self._current.get(path)
+            data = self._entries.pop(key, None) if key is not None else None
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries[key] = data
+            self.hits += 1
+
+        return byte_range(data, start_offset, length)
+
+    def begin_miss(self, path):
+        '''returns the generation to pass to put() for data read after this call'''
+        with self._lock:
+            return self._generations.get(path, 0)
+
+    def put(self, path, version, checksum, data, generation):
+        if len(data) > self.max_entry_bytes:
+            return
+        key = (path, version, checksum)
+        with self._lock:
+            if self._generations.get(path, 0) != generation:
+                return
+            old_key = self._current.get(path)
+            if old_key is not None:
+                self._remove(old_key)
+            self._current[path] = key
+            self._entries[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                if self._current.get(evicted_key[0]) == evicted_key:
+                    del self._current[evicted_key[0]]
+                self.evictions += 1
+
+    def invalidate(self, path):
+        with self._lock:
+            self._generations[path] = self._generations.get(path, 0) + 1
+            key = self._current.pop(path, None)
+            if key is not None:
+                self._remove(key)
+                self.invalidations += 1
+
+    def _remove(self, key):
+        # must be called with _lock held
+        data = self._entries.pop(key, None)
+        if data is not None:
+            self._bytes -= len(data)
+
+    def report(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return ("read cache: %d files, %d/%d bytes, %d hits, %d misses (%.1f%% hits), "
+                    "%d evictions, %d invalidations" %
+                    (len(self._entries), self._bytes, self.max_bytes, self.hits, self.misses,
+                     100.0 * self.hits / lookups if lookups else 0.0,
+                     self.evictions, self.invalidations))
+
+
+def byte_range(data, start_offset=None, length=-1):
+    '''the slice of data LocalPeer.read() returns for start_offset and length'''
+    start = start_offset or 0
+    if length is None or length < 0:
+        return data[start:]
+    return data[start:start + length]
@@ -0,0 +1,52 @@
+"""
+readcache_test.py - Test file for readcache.py
+"""
+
+from readcache import ReadCache
+
+def test_hits_and_eviction():
+    print "Testing hits and eviction"
+    cache = ReadCache(max_bytes=800)
+    assert cache.get("a") is None
+    cache.put("a", 1, "c1", "a" * 100, cache.begin_miss("a"))
+    assert cache.get("a", 10, 5) == "aaaaa"
+    assert cache.get("a", 90) == "a" * 10
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # too big to cache
+    cache.put("big", 1, "c", "x" * 101, cache.begin_miss("big"))
+    assert cache.get("big") is None
+
+    for name in "bcdefgh":
+        cache.put(name, 1, "c", name * 100, cache.begin_miss(name))
+    # "a" was used least recently
+    cache.get("b")
+    cache.put("i", 1, "c", "i" * 100, cache.begin_miss("i"))
+    assert cache.get("a") is None
+    assert cache.get("b") == "b" * 100
+    assert cache.evictions == 1
+
+def test_invalidation():
+    print "Testing invalidation"
+    cache = ReadCache(max_bytes=800)
+    cache.put("a", 1, "c1", "old", cache.begin_miss("a"))
+    cache.invalidate("a")
+    assert cache.get("a") is None
+
+    # data read before an invalidation isn't cached after it
+    generation = cache.begin_miss("a")
+    cache.invalidate("a")
+    cache.put("a", 1, "c1", "stale", generation)
+    assert cache.get("a") is None
+
+    cache.put("a", 2, "c2", "new", cache.begin_miss("a"))
+    assert cache.get("a") == "new"
+    assert "1 invalidations" in cache.report()
+
+def run():
+    test_hits_and_eviction()
+    test_invalidation()
+    print "readcache tests passed"
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,173 @@
+'''
+replicas.py - Picking the replicas to download from
+
+Every transfer from a peer (a streamed file, a block, a range) is timed.
+A ReplicaSelector keeps exponentially weighted moving averages of each
+peer's round trip time, throughput and error rate, and from them expects
+how long a transfer of a given size would take. That is scaled up by the
+transfers already in flight from the peer, so a busy replica looks slower.
+
+Candidates are ordered with randomized power of two choices: two of the
+remaining peers are picked at random and the one expected to be quicker
+goes next. The fastest peers get most of the work, but not all of it, so
+downloads don't all pile onto one replica (usually the tracker, which
+came first in the tracker's peer lists). Peers without samples, or whose
+samples are older than STALE_AFTER, are expected to be as good as the
+average known peer, so a peer that was slow or failing gets tried again.
+
+The last DECISIONS_KEPT orderings are kept with the costs they were based
+on, see decisions() and report().
+'''
+
+import collections
+import logging
+import random
+import threading
+import time
+
+ALPHA = 0.3 # weight of a new sample
+# used until some peer has been measured
+DEFAULT_RTT = 0.005
+DEFAULT_THROUGHPUT = 50 * 2 ** 20
+# smaller transfers are timed as round trips, they say little about throughput
+SMALL_TRANSFER = 64 * 1024
+MAX_ERROR_RATE = 0.95
+STALE_AFTER = 30.0
+DECISIONS_KEPT = 50
+
+
+def _ewma(average, sample):
+    if average is None:
+        return sample
+    return average + ALPHA * (sample - average)
+
+
+class _Estimate(object):
+    def __init__(self):
+        self.rtt = None
+        self.throughput = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.transfers = 0
+        self.failures = 0
+        self.updated = 0.0 # time of the last sample
+
+
+# one call to rank(): candidates is a list of (peer, expected seconds)
+Decision = collections.namedtuple("Decision", "time purpose nbytes candidates order")
+
+
+class ReplicaSelector(object):
+    def __init__(self, rng=None):
+        self._lock = threading.Lock()
+        self._estimates = {} # (hostname, port) -> _Estimate
+        self._decisions = collections.deque(maxlen=DECISIONS_KEPT)
+        self._random = rng or random.Random()
+
+    def _estimate(self, peer):
+        # must be called with _lock held
+        key = (peer.hostname, peer.port)
+        estimate = self._estimates.get(key)
+        if estimate is None:
+            estimate = self._estimates[key] = _Estimate()
+        return estimate
+
+    def started(self, peer):
+        '''call before a transfer from peer. returns the token to pass to finished() or failed()'''
+        with self._lock:
+            self._estimate(peer).in_flight += 1
+        return time.time()
+
+    def finished(self, peer, started, nbytes):
+        elapsed = max(time.time() - started, 1e-6)
+        with self._lock:
+            estimate = self._estimate(peer)
+            estimate.in_flight = max(estimate.in_flight - 1, 0)
+            estimate.transfers += 1
+            estimate.updated = time.time()
+            estimate.error_rate = _ewma(estimate.error_rate, 0.0)
+            if nbytes < SMALL_TRANSFER or estimate.rtt is None:
+                estimate.rtt = _ewma(estimate.rtt, elapsed)
+            if nbytes >= SMALL_TRANSFER:
+                # the part of the transfer that wasn't latency
+                transfer_time = max(elapsed - estimate.rtt, elapsed / 10)
+                estimate.throughput = _ewma(estimate.throughput, nbytes / transfer_time)
+
+    def failed(self, peer, started):
+        with self._lock:
+            estimate = self._estimate(peer)
+            estimate.in_flight = max(estimate.in_flight - 1, 0)
+            estimate.failures += 1
+            estimate.updated = time.time()
+            estimate.error_rate = _ewma(estimate.error_rate, 1.0)
+
+    def _defaults(self):
+        # must be called with _lock held
+        rtts = [e.rtt for e in self._estimates.values() if e.rtt is not None]
+        throughputs = [e.throughput for e in self._estimates.values() if e.throughput is not None]
+        return (sum(rtts) / len(rtts) if rtts else DEFAULT_RTT,
+                sum(throughputs) / len(throughputs) if throughputs else DEFAULT_THROUGHPUT)
+
+    def _cost(self, peer, nbytes, defaults):
+        # must be called with _lock held
+        estimate = self._estimates.get((peer.hostname, peer.port)) or _Estimate()
+        rtt, throughput = defaults
+        error_rate = 0.0
+        if estimate.updated >= time.time() - STALE_AFTER:
+            if estimate.rtt is not None:
+                rtt = estimate.rtt
+            throughput = estimate.throughput or throughput
+            error_rate = min(estimate.error_rate, MAX_ERROR_RATE)
+        seconds = (rtt + float(nbytes) / throughput) * (1 + estimate.in_flight)
+        return seconds / (1 - error_rate)
+
+    def expected_time(self, peer, nbytes):
+        '''seconds a transfer of nbytes from peer is expected to take'''
+        with self._lock:
+            return self._cost(peer, nbytes, self._defaults())
+
+    def rank(self, peers, nbytes=0, purpose=""):
+        '''returns peers in the order they should be tried for a transfer of nbytes'''
+        peers = list(peers)
+        with self._lock:
+            defaults = self._defaults()
+            costs = [self._cost(peer, nbytes, defaults) for peer in peers]
+            remaining = range(len(peers))
+            order = []
+            while remaining:
+                if len(remaining) == 1:
+                    pick = remaining[0]
+                else:
+                    a, b = self._random.sample(remaining, 2)
+                    pick = a if costs[a] <= costs[b] else b
+                order.append(pick)
+                remaining.remove(pick)
+            decision = Decision(time.time(), purpose, nbytes, zip(peers, costs),
+                                [peers[i] for i in order])
+            self._decisions.append(decision)
+        logging.debug("Replicas for %s (%d bytes): %s" %
+                      (purpose, nbytes, ", ".join("%s:%d %.1fms" % (peers[i].hostname, peers[i].port,
+                                                                     costs[i] * 1000)
+                                                  for i in order)))
+        return decision.order
+
+    def decisions(self):
+        '''the most recent rank() decisions, oldest first'''
+        with self._lock:
+            return list(self._decisions)
+
+    def report(self):
+        with self._lock:
+            lines = ["replicas: %d peers measured" % len(self._estimates)]
+            for (hostname, port), e in sorted(self._estimates.items()):
+                lines.append("  %s:%d rtt %s, %s, %.0f%% errors, %d in flight, %d transfers, %d failed" %
+                             (hostname, port,
+                              "%.1fms" % (e.rtt * 1000) if e.rtt is not None else "?",
+                              "%.1fMB/s" % (e.throughput / 2 ** 20) if e.throughput else "?MB/s",
+                              e.error_rate * 100, e.in_flight, e.transfers, e.failures))
+            if self._decisions:
+                d = self._decisions[-1]
+                lines.append("  last: %s (%d bytes) -> %s" %
+                             (d.purpose, d.nbytes,
+                              ", ".join("%s:%d" % (p.hostname, p.port) for p in d.order)))
+            return "\n".join(lines)
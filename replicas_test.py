@@ -0,0 +1,81 @@
+"""
+replicas_test.py - Test file for replicas.py
+"""
+
+import random
+
+import replicas
+
+class FakePeer(object):
+    def __init__(self, port):
+        self.hostname = "127.0.0.1"
+        self.port = port
+
+def transfer(selector, peer, seconds, nbytes):
+    started = selector.started(peer) - seconds
+    selector.finished(peer, started, nbytes)
+
+def test_estimates():
+    print "Testing estimates"
+    selector = replicas.ReplicaSelector()
+    fast, slow = FakePeer(1), FakePeer(2)
+    for i in range(5):
+        transfer(selector, fast, 0.001, 100)
+        transfer(selector, slow, 0.05, 100)
+        transfer(selector, fast, 0.01, 2 ** 20)
+        transfer(selector, slow, 1.0, 2 ** 20)
+    assert selector.expected_time(fast, 2 ** 20) < selector.expected_time(slow, 2 ** 20)
+    assert selector.expected_time(fast, 0) < selector.expected_time(slow, 0)
+
+    # failures and transfers in flight make a peer look slower
+    before = selector.expected_time(fast, 2 ** 20)
+    started = selector.started(fast)
+    assert selector.expected_time(fast, 2 ** 20) > before
+    selector.failed(fast, started)
+    assert selector.expected_time(fast, 2 ** 20) > before
+
+def test_power_of_two_choices():
+    print "Testing power of two choices"
+    selector = replicas.ReplicaSelector(rng=random.Random(1))
+    peers = [FakePeer(port) for port in range(4)]
+    for i, peer in enumerate(peers):
+        transfer(selector, peer, 0.001 * (i + 1), 100)
+
+    firsts = [0] * len(peers)
+    for i in range(1000):
+        order = selector.rank(peers, 100, "f")
+        assert sorted(p.port for p in order) == range(len(peers))
+        firsts[order[0].port] += 1
+    # the fastest peer goes first most often, but not always. The slowest never does
+    assert firsts[0] == max(firsts) and firsts[0] < 1000
+    assert firsts[1] > 0 and firsts[3] == 0
+
+    decisions = selector.decisions()
+    assert len(decisions) == replicas.DECISIONS_KEPT
+    assert decisions[-1].purpose == "f" and len(decisions[-1].candidates) == len(peers)
+    assert "4 peers measured" in selector.report()
+
+def test_unmeasured_peers():
+    print "Testing unmeasured peers"
+    selector = replicas.ReplicaSelector()
+    known, new = FakePeer(1), FakePeer(2)
+    transfer(selector, known, 0.01, 100)
+    # expected to be as good as the average known peer
+    assert abs(selector.expected_time(new, 100) - selector.expected_time(known, 100)) < 1e-9
+    assert selector.rank([], 0) == []
+
+    # old samples are forgotten
+    slow = FakePeer(3)
+    transfer(selector, slow, 1.0, 100)
+    assert selector.expected_time(slow, 100) > selector.expected_time(new, 100)
+    selector._estimates[("127.0.0.1", 3)].updated -= replicas.STALE_AFTER + 1
+    assert selector.expected_time(slow, 100) == selector.expected_time(new, 100)
+
+def run():
+    test_estimates()
+    test_power_of_two_choices()
+    test_unmeasured_peers()
+    print "replicas tests passed"
+
+if __name__ == "__main__":
+    run()
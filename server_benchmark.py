@@ -0,0 +1,69 @@
+"""
+server_benchmark.py - Request throughput of the tracker's server engines
+
+Starts a tracker with each engine and has many clients, each on its own
+connection, send it list requests.
+
+Usage: python server_benchmark.py [clients] [requests per client]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import communication
+import messages
+# peer and tracker import each other, tracker has to go first
+from tracker import Tracker
+from peer import LocalPeer, Peer
+
+PORT = 23456
+
+def client(tracker_peer, count, errors):
+    try:
+        sock = communication.connect_to_peer(tracker_peer)
+        try:
+            for i in xrange(count):
+                communication.send_message(messages.ListRequest(), socket=sock)
+                communication.recv_message(sock)
+        finally:
+            sock.close()
+    except (IOError, RuntimeError), e:
+        errors.append(e)
+
+def measure(engine, clients, count, port):
+    LocalPeer.SERVER_ENGINE = engine
+    temp_dir = tempfile.mkdtemp()
+    tracker = Tracker(port=port, hostname="127.0.0.1",
+                      db_name=os.path.join(temp_dir, "tracker.db"))
+    try:
+        tracker_peer = Peer("127.0.0.1", tracker.port)
+        errors = []
+        threads = [threading.Thread(target=client, args=(tracker_peer, count, errors))
+                   for i in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+
+        peak_threads = 0
+        while any(thread.is_alive() for thread in threads):
+            peak_threads = max(peak_threads, threading.active_count() - clients)
+            time.sleep(0.01)
+        elapsed = time.time() - start
+    finally:
+        tracker.stop()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return clients * count / elapsed, peak_threads, len(errors)
+
+def run(clients=50, count=40):
+    print "%-10s %12s %14s %8s" % ("engine", "requests/s", "server threads", "errors")
+    for i, engine in enumerate(("threads", "eventloop")):
+        results = measure(engine, clients, count, PORT + i)
+        print "%-10s %12.0f %14d %8d" % ((engine,) + results)
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:3]])
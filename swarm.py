@@ -0,0 +1,201 @@
+'''
+swarm.py - Downloading one file from several replicas at once
+
+The file is split into BLOCK_SIZE blocks. Every replica gets
+REQUESTS_PER_PEER workers, which pull the next block to fetch from a shared
+BlockScheduler. Fast peers come back for more blocks sooner, so they end
+up sending more of the file. Each block is checked against the block
+hashes (see BlockHashes) before it's written, and a peer that keeps
+failing is dropped. Given a replicas.ReplicaSelector, every block fetched
+is timed for it.
+'''
+
+import collections
+import logging
+import socket
+import threading
+import time
+
+import checksum
+import communication
+import filesystem
+import messages
+
+BLOCK_SIZE = 2 ** 20
+# blocks requested from one peer at a time, pipelined on its connection
+REQUESTS_PER_PEER = 2
+BLOCK_TIMEOUT = 30.0
+MAX_PEER_FAILURES = 3
+
+
+class BlockScheduler(object):
+    '''
+    Hands out the blocks still to be fetched. Once they've all been handed
+    out, an idle peer is given the block that has been in flight the longest
+    elsewhere, so one slow peer can't hold up the end of the download. The
+    first copy of a block to arrive wins
+    '''
+    def __init__(self, block_count):
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = collections.deque(range(block_count))
+        self._in_flight = {} # block index -> (time handed out, set of peers fetching it)
+        self._done = set()
+        self._block_count = block_count
+
+    def next_block(self, peer):
+        '''
+        returns the index of a block for peer to fetch, waiting if there's
+        nothing it can help with right now. returns None once every block is done
+        '''
+        with self._cond:
+            while len(self._done) < self._block_count:
+                if self._pending:
+                    index = self._pending.popleft()
+                    self._in_flight[index] = (time.time(), set([peer]))
+                    return index
+
+                candidates = [(started, index) for index, (started, peers)
+                              in self._in_flight.items() if peer not in peers]
+                if candidates:
+                    index = min(candidates)[1]
+                    self._in_flight[index][1].add(peer)
+                    return index
+                self._cond.wait()
+            return None
+
+    def completed(self, index):
+        with self._cond:
+            self._done.add(index)
+            self._in_flight.pop(index, None)
+            self._cond.notify_all()
+
+    def failed(self, index, peer):
+        '''gives the block back if no other peer is fetching it'''
+        with self._cond:
+            if index in self._done or index not in self._in_flight:
+                return
+            peers = self._in_flight[index][1]
+            peers.discard(peer)
+            if not peers:
+                del self._in_flight[index]
+                self._pending.appendleft(index)
+            self._cond.notify_all()
+
+    def abort(self):
+        '''wakes up the workers waiting in next_block() after the last peer gave up'''
+        with self._cond:
+            self._block_count = len(self._done)
+            self._cond.notify_all()
+
+    def is_complete(self, block_count):
+        with self._cond:
+            return len(self._done) == block_count
+
+
+class _PeerStats(object):
+    def __init__(self):
+        self.blocks = 0
+        self.bytes = 0
+        self.failures = 0
+        self.workers = REQUESTS_PER_PEER
+
+
+def download(file_model, block_size, hashes, peers, local_path, replicas=None):
+    '''
+    Fetches the version of the file described by file_model from peers
+    into local_path. returns True if every block arrived and matched hashes
+    '''
+    scheduler = BlockScheduler(len(hashes))
+    part_file = filesystem.create_part_file(local_path, file_model.size)
+    write_lock = threading.Lock()
+    stats = dict((peer, _PeerStats()) for peer in peers)
+    stats_lock = threading.Lock()
+
+    def fetch_blocks(peer):
+        peer_stats = stats[peer]
+        try:
+            while True:
+                index = scheduler.next_block(peer)
+                if index is None:
+                    return
+                offset = index * block_size
+                length = min(block_size, file_model.size - offset)
+
+                data = fetch_block(peer, file_model, offset, length, hashes[index], replicas)
+                if data is None:
+                    scheduler.failed(index, peer)
+                    with stats_lock:
+                        peer_stats.failures += 1
+                        if peer_stats.failures >= MAX_PEER_FAILURES:
+                            logging.warning("Giving up on %s for %s" % (peer, file_model.path))
+                            return
+                    continue
+
+                with write_lock:
+                    part_file.seek(offset)
+                    part_file.write(data)
+                scheduler.completed(index)
+                with stats_lock:
+                    peer_stats.blocks += 1
+                    peer_stats.bytes += length
+        finally:
+            with stats_lock:
+                peer_stats.workers -= 1
+                all_gone = all(s.workers == 0 for s in stats.values())
+            if all_gone:
+                scheduler.abort()
+
+    start = time.time()
+    workers = [threading.Thread(target=fetch_blocks, args=(peer,), name="Swarm_%s" % peer.port)
+               for peer in peers for i in range(REQUESTS_PER_PEER)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+    part_file.close()
+
+    elapsed = time.time() - start
+    for peer, peer_stats in stats.items():
+        logging.info("%s sent %d blocks (%d bytes) of %s, %d failures" %
+                     (peer, peer_stats.blocks, peer_stats.bytes, file_model.path,
+                      peer_stats.failures))
+
+    if not scheduler.is_complete(len(hashes)):
+        filesystem.remove_part_file(part_file)
+        return False
+
+    filesystem.replace_with_part_file(local_path, part_file)
+    logging.info("Downloaded %s (%d bytes) from %d peers in %.2fs" %
+                 (file_model.path, file_model.size, len(peers), elapsed))
+    return True
+
+def fetch_block(peer, file_model, offset, length, block_hash, replicas=None):
+    '''returns the block's data, or None if peer couldn't send a block matching block_hash'''
+    started = replicas.started(peer) if replicas is not None else None
+    data = _request_block(peer, file_model, offset, length, block_hash)
+    if replicas is not None:
+        if data is None:
+            replicas.failed(peer, started)
+        else:
+            replicas.finished(peer, started, length)
+    return data
+
+def _request_block(peer, file_model, offset, length, block_hash):
+    request = messages.FileBlockRequest(file_model.path, file_model.latest_version, offset, length)
+    try:
+        response = communication.request(request, peer, timeout=BLOCK_TIMEOUT)
+    except (socket.error, RuntimeError), e:
+        logging.debug("Block %d of %s from %s failed: %s" % (offset, file_model.path, peer, e))
+        return None
+
+    if not isinstance(response, messages.FileBlock) or response.file_model.data is None:
+        return None
+    data = response.file_model.data
+    if len(data) != length or checksum.calc_checksum(data) != block_hash:
+        logging.warning("Bad block at %d of %s from %s" % (offset, file_model.path, peer))
+        return None
+    return data
+
+def block_hashes(file_path, block_size):
+    return [checksum.calc_checksum(block) for block in filesystem.map_blocks(file_path, block_size)]
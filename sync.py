@@ -0,0 +1,221 @@
+'''
+sync.py - Catching up with the tracker after connecting
+
+plan() compares the tracker's file list with the local DB in one pass.
+CatchUpSync records the files that are new to this peer, then downloads
+the files whose local copy is out of date on CONCURRENCY threads of its
+own. The peer's worker pool keeps serving requests while it runs, and
+connect() doesn't wait for it.
+
+Downloader fetches the files other peers announce later on, so the
+message handlers that hear about them don't wait on other peers.
+'''
+
+import logging
+import os
+import Queue
+import threading
+import time
+
+import filesystem
+
+CONCURRENCY = 4
+PROGRESS_INTERVAL = 2.0
+
+
+def plan(remote_files, local_files, has_copy):
+    '''
+    returns (changed, stale): the files whose DB entry needs updating,
+    and those whose local copy is out of date and has to be downloaded.
+    has_copy(file_model) says whether the version in file_model is stored here
+    '''
+    local = dict((f.path, f) for f in local_files)
+    changed = []
+    stale = []
+    for remote in remote_files:
+        f = local.get(remote.path)
+        if (f is not None and f.latest_version == remote.latest_version and
+            f.checksum == remote.checksum):
+            continue
+        if f is not None and not remote.is_dir and has_copy(f):
+            stale.append(remote)
+        else:
+            # nothing here to bring up to date, it's downloaded when it's read
+            changed.append(remote)
+    return changed, stale
+
+
+class CatchUpSync(object):
+    def __init__(self, peer, concurrency=CONCURRENCY):
+        self._peer = peer
+        self.concurrency = concurrency
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.started = None
+        self.finished = None
+        self.recorded = 0
+        self.to_download = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def start(self):
+        self.done.clear()
+        self._thread = threading.Thread(target=self._run, name="CatchUpSync")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        '''returns True once the sync has finished'''
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+    def _has_copy(self, f):
+        return os.path.exists(filesystem.get_local_path(self._peer, f.path, f.latest_version))
+
+    def _run(self):
+        self.started = time.time()
+        try:
+            remote_files = self._peer.ls()
+            changed, stale = plan(remote_files, self._peer.db.list_files(None), self._has_copy)
+            with self._lock:
+                self.to_download = len(stale)
+
+            with self._peer.db.transaction():
+                for f in changed:
+                    self._peer.db.add_or_update_file(f)
+            self.recorded = len(changed)
+            logging.info("Catching up: %d files known, %d recorded, %d to download" %
+                         (len(remote_files), len(changed), len(stale)))
+
+            self._download_all(stale)
+        except Exception, e:
+            logging.error("Catching up with the tracker failed: %s" % e)
+        finally:
+            self.finished = time.time()
+            logging.info(self.report())
+            self.done.set()
+
+    def _download_all(self, files):
+        pending = Queue.Queue()
+        for f in files:
+            pending.put(f)
+
+        def download():
+            while True:
+                try:
+                    f = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                ok = False
+                try:
+                    # not while a change to the file is being applied
+                    with self._peer._file_lock(f.path):
+                        ok = self._peer._download_file(f.path)
+                except Exception, e:
+                    logging.error("Catching up on %s failed: %s" % (f.path, e))
+                with self._lock:
+                    if ok:
+                        self.downloaded += 1
+                        self.bytes += f.size or 0
+                    else:
+                        self.failed += 1
+
+        workers = [threading.Thread(target=download, name="CatchUpSync_%d" % i)
+                   for i in range(min(self.concurrency, len(files)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(PROGRESS_INTERVAL)
+                if worker.is_alive():
+                    logging.info(self.report())
+
+    def report(self):
+        with self._lock:
+            if self.started is None:
+                return "catch-up sync: not started"
+            elapsed = (self.finished or time.time()) - self.started
+            state = "done" if self.done.is_set() else "running"
+            return ("catch-up sync %s: %d recorded, %d/%d downloaded, %d failed, "
+                    "%d bytes in %.1fs" %
+                    (state, self.recorded, self.downloaded, self.to_download, self.failed,
+                     self.bytes, elapsed))
+
+
+class Downloader(object):
+    '''
+    Downloads files on CONCURRENCY threads of its own. A handler queues
+    a file here instead of downloading it on its worker, where requests
+    to peers that are busy with this peer's requests in turn could wait
+    on each other until every worker is taken. A file queued again before
+    its download starts is only downloaded once
+    '''
+    def __init__(self, peer, concurrency=CONCURRENCY):
+        self._peer = peer
+        self._pending = Queue.Queue()
+        self._lock = threading.Lock()
+        self._queued = {} # file path -> peers to download it from, None to ask the tracker
+        self.downloaded = 0
+        self.failed = 0
+        self._stopped = False
+        self._threads = []
+        for i in range(concurrency):
+            thread = threading.Thread(target=self._work, name="Downloader_%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def request(self, file_path, peer_list=None):
+        with self._lock:
+            if self._stopped or file_path in self._queued:
+                return
+            self._queued[file_path] = peer_list
+        self._pending.put(file_path)
+
+    def wait(self):
+        '''returns once every queued download has finished'''
+        self._pending.join()
+
+    def stop(self, timeout=None):
+        '''
+        stops the threads once the downloads queued so far are done. Later
+        requests are ignored
+        '''
+        with self._lock:
+            self._stopped = True
+        for thread in self._threads:
+            self._pending.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self):
+        while True:
+            file_path = self._pending.get()
+            if file_path is None:
+                self._pending.task_done()
+                return
+            with self._lock:
+                # a change announced from here on needs another download
+                peer_list = self._queued.pop(file_path)
+            ok = False
+            try:
+                # not while a change to the file is being applied
+                with self._peer._file_lock(file_path):
+                    ok = self._peer._download_file(file_path, peer_list)
+            except Exception, e:
+                logging.error("Downloading %s failed: %s" % (file_path, e))
+            with self._lock:
+                if ok:
+                    self.downloaded += 1
+                else:
+                    self.failed += 1
+            self._pending.task_done()
+
+    def report(self):
+        with self._lock:
+            return ("downloader: %d queued, %d downloaded, %d failed" %
+                    (len(self._queued), self.downloaded, self.failed))
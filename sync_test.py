@@ -0,0 +1,73 @@
+"""
+sync_test.py - Test file for sync.py
+"""
+
+import threading
+
+import sync
+from messages import FileModel
+
+def test_plan():
+    print "Testing plan"
+    remote = [FileModel(u"same", False, "c", 10, 1),
+              FileModel(u"new", False, "c", 10, 1),
+              FileModel(u"newer", False, "c2", 10, 2),
+              FileModel(u"rewritten", False, "c2", 10, 1),
+              FileModel(u"not_here", False, "c2", 10, 2),
+              FileModel(u"dir", True, None, 0, 2)]
+    local = [FileModel(u"same", False, "c", 10, 1),
+             FileModel(u"newer", False, "c1", 10, 1),
+             FileModel(u"rewritten", False, "c1", 10, 1),
+             FileModel(u"not_here", False, "c1", 10, 1),
+             FileModel(u"dir", True, None, 0, 1),
+             FileModel(u"gone", False, "c", 10, 1)]
+    has_copy = lambda f: f.path != u"not_here"
+    changed, stale = sync.plan(remote, local, has_copy)
+    assert sorted(f.path for f in changed) == [u"dir", u"new", u"not_here"]
+    assert sorted(f.path for f in stale) == [u"newer", u"rewritten"]
+    # the tracker's model is the one that's fetched
+    assert [f.latest_version for f in stale if f.path == u"newer"] == [2]
+
+class FakePeer(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.started = threading.Semaphore(0)
+        self.downloads = []
+
+    def _file_lock(self, file_path):
+        return self.lock
+
+    def _download_file(self, file_path, peer_list=None):
+        self.started.release()
+        self.release.wait()
+        self.downloads.append(file_path)
+        return file_path != u"bad"
+
+def test_downloader():
+    print "Testing downloader"
+    peer = FakePeer()
+    downloader = sync.Downloader(peer, concurrency=1)
+    downloader.request(u"a")
+    peer.started.acquire()
+    # queued again before it's started, it's downloaded once. One that's
+    # already being downloaded is downloaded again
+    for path in [u"a", u"b", u"a", u"bad", u"b"]:
+        downloader.request(path)
+    peer.release.set()
+    downloader.wait()
+    assert peer.downloads == [u"a", u"a", u"b", u"bad"]
+    assert (downloader.downloaded, downloader.failed) == (3, 1)
+
+    downloader.stop()
+    downloader.request(u"c")
+    assert peer.downloads[-1] == u"bad"
+    assert not any(t.name.startswith("Downloader_") for t in threading.enumerate())
+
+def run():
+    test_plan()
+    test_downloader()
+    print "sync tests passed"
+
+if __name__ == "__main__":
+    run()
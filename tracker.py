@@ -2,11 +2,13 @@
 tracker.py - global system tracker class
 '''
 import communication
+import compression
 import db
 
 from peer import LocalPeer, PeerState
 import logging
 import messages
+from messages import MessageType
 import peer
 import filesystem
 
@@ -45,14 +47,19 @@ class Tracker(LocalPeer):
         super(Tracker, self).__init__(hostname, port)
         #self.tracker = peer.Peer(self.hostname, self.port)
         self.db = db.TrackerDb(db_name)
+        self._migrate_checksums()
         # add itself to the peers database
         self.db.add_or_update_peer(self.hostname, self.port, PeerState.ONLINE, 
                                    LocalPeer.MAX_FILE_SIZE, LocalPeer.MAX_FILE_SYS_SIZE, 
                                    0, block=True)
         self.start_accepting_connections()
 
+    def is_tracker_online(self):
+        return True
+
     def handle_CONNECT_REQUEST(self, client_socket, msg):        
-        response = messages.ConnectResponse(successful=False)
+        response = messages.ConnectResponse(successful=False, 
+                                            wire_version=communication.WIRE_VERSION)
         
         if msg.pwd == LocalPeer.PASSWORD:
             logging.debug("Connection request - password OK")
@@ -62,6 +69,10 @@ class Tracker(LocalPeer):
             logging.debug("Peer address: %s %d", str(peer_endpoint[0]), msg.port) 
             self.db.add_or_update_peer(peer_endpoint[0], msg.port, peer.PeerState.ONLINE, 
                                         msg.maxFileSize, msg.maxFileSysSize, msg.currFileSysSize)
+            communication.set_wire_version(peer_endpoint[0], msg.port, 
+                                           getattr(msg, "wire_version", 0))
+            response.compression = compression.choose_method(getattr(msg, "compression", None))
+            communication.set_compression(peer_endpoint[0], msg.port, response.compression)
             
         else:
             logging.debug("Connection Request - wrong password")        
@@ -130,13 +141,18 @@ class Tracker(LocalPeer):
     @check_connected
     def handle_NEW_FILE_AVAILABLE(self, client_socket, new_file_available_msg):
         logging.debug("Handling new file available message")
-        f = new_file_available_msg.file_model
         source_ip = client_socket.getpeername()[0]
-        source_port = new_file_available_msg.port
-                
+        self._add_new_file(new_file_available_msg, source_ip)
+        self._replicate_new_file(new_file_available_msg, source_ip)
+
+    def _add_new_file(self, new_file_available_msg, source_ip):
+        f = new_file_available_msg.file_model
         self.db.add_or_update_file(f)
-        self.db.add_file_peer_entry(f, source_ip, source_port)
+        self.db.add_file_peer_entry(f, source_ip, new_file_available_msg.port)
 
+    def _replicate_new_file(self, new_file_available_msg, source_ip):
+        f = new_file_available_msg.file_model
+        source_port = new_file_available_msg.port
         if source_ip == self.hostname and source_port == self.port:
             return        
         
@@ -152,7 +168,8 @@ class Tracker(LocalPeer):
         for p in peers_list:
             print p.port
             if p.hostname == self.hostname and p.port == self.port:
-                self._download_file(f.path, peer_list=peers_list)
+                # off the worker this handler runs on, like a peer's downloads
+                self.downloader.request(f.path, peers_list)
                 continue
             logging.debug("Broadcasting to peer %s %d", p.hostname, p.port)
             communication.send_message(new_file_available_msg, p)
@@ -161,24 +178,58 @@ class Tracker(LocalPeer):
     # or the file has actually been changed
     def handle_FILE_CHANGED(self, client_socket, file_changed_msg):
         logging.debug("Handling file change")
-        remote_file = file_changed_msg.file_model
-
         source_ip = client_socket.getpeername()[0]
-        source_port = file_changed_msg.port
+        if not self._record_replica(file_changed_msg, source_ip):
+            self._propagate_file_change(client_socket, file_changed_msg, source_ip)
 
+    def _record_replica(self, file_changed_msg, source_ip):
+        '''
+        returns True if file_changed_msg only says that the peer now has the
+        current version of the file, or is about a file that isn't known
+        '''
+        remote_file = file_changed_msg.file_model
         db_file = self.db.get_file(remote_file.path)
+        if db_file is None:
+            # deleted since. There's nothing to record or to pass on
+            logging.warning("Ignoring a change to %s, it isn't in the DB" % remote_file.path)
+            return True
+        if (remote_file.data is None and file_changed_msg.delta is None and
+            db_file.latest_version == remote_file.latest_version and
+            db_file.checksum != remote_file.checksum and
+            self.db.has_legacy_checksum(remote_file.path)):
+            # a download checked against the old style checksum, the
+            # peer's is the Merkle root of the same data
+            logging.info("Replacing the old style checksum of %s" % remote_file.path)
+            self.db.add_or_update_file(remote_file)
+            self.db.clear_legacy_checksum(remote_file.path)
+            db_file = remote_file
         # if checksums match, that means the file wasn't actually updated
         # but the peer just downloaded it.
         if (db_file.checksum == remote_file.checksum and
             db_file.latest_version == remote_file.latest_version):
             
             logging.debug("A peer now has file " + remote_file.path)
-            self.db.add_file_peer_entry(remote_file, source_ip, source_port)
-        elif source_ip != self.hostname or source_port != self.port:
+            self.db.add_file_peer_entry(remote_file, source_ip, file_changed_msg.port)
+            return True
+        return False
+
+    def _propagate_file_change(self, client_socket, file_changed_msg, source_ip):
+        remote_file = file_changed_msg.file_model
+        source_port = file_changed_msg.port
+        if remote_file.data is None and file_changed_msg.delta is None:
+            # an ack for a version that has been changed again since
+            logging.debug("Ignoring a stale replica ack for %s", remote_file.path)
+            return
+        if source_ip != self.hostname or source_port != self.port:
             # this is a file change. notify all peers that have the file
             logging.debug("Peer's file (%s) was changed. Going to notify peers", 
                           remote_file.path)
             peers_list = self.db.get_peers(remote_file.path)
+            if not any(p.hostname == self.hostname and p.port == self.port for p in peers_list):
+                # without a copy here the change has to be recorded anyway, for
+                # the peers that catch up with ls() when they reconnect
+                self.db.add_or_update_file(remote_file)
+                self.db.add_file_peer_entry(remote_file, source_ip, source_port)
             # broadcast
             logging.debug("Broadcasting message ")
             print str(peers_list)
@@ -195,6 +246,30 @@ class Tracker(LocalPeer):
                 logging.debug("Broadcasting to peer %s %s", p.hostname, p.port)
                 communication.send_message(file_changed_msg, p)
 
+    @check_connected
+    def handle_NOTIFICATION_BATCH(self, client_socket, batch):
+        logging.debug("Handling a batch of %d notifications", len(batch.notifications))
+        source_ip = client_socket.getpeername()[0]
+
+        # all of the DB updates are committed at once. Replication and
+        # broadcasts happen afterwards, outside of the transaction
+        follow_ups = []
+        with self.db.transaction():
+            for msg in batch.notifications:
+                if msg.msg_type == MessageType.NEW_FILE_AVAILABLE:
+                    self._add_new_file(msg, source_ip)
+                    follow_ups.append(msg)
+                elif msg.msg_type == MessageType.FILE_CHANGED:
+                    if not self._record_replica(msg, source_ip):
+                        follow_ups.append(msg)
+                else:
+                    logging.warning("Ignoring %s in a notification batch", msg)
+
+        for msg in follow_ups:
+            if msg.msg_type == MessageType.NEW_FILE_AVAILABLE:
+                self._replicate_new_file(msg, source_ip)
+            else:
+                self._propagate_file_change(client_socket, msg, source_ip)
     
     @check_connected
     def handle_LIST_REQUEST(self, client_socket, list_request):
@@ -252,11 +327,7 @@ class Tracker(LocalPeer):
         # notify all peers that have the file about the new version
         for peer in peers_list:
             if peer.hostname == self.hostname and peer.port == self.port:
-                local_file_path = filesystem.get_local_path(self, file_path, f.latest_version-1)
-                file_data = filesystem.read_file(local_file_path)
-        
-                local_file_path = filesystem.get_local_path(self, file_path, f.latest_version)
-                filesystem.write_file(local_file_path, file_data)
+                self._archive_local_version(file_path, f.latest_version - 1, f.latest_version)
         
             if peer.state == PeerState.OFFLINE:
                 continue
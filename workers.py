@@ -0,0 +1,185 @@
+'''
+workers.py - Bounded worker pool for message handlers
+
+Handlers run on a fixed number of threads per lane. Each lane has its own
+bounded queue and its own workers, so control messages are never stuck
+behind bulk data transfers. When a lane's queue is full, try_submit()
+fails and the server holds the message back (HeldMessages) while it keeps
+reading the connection, so control messages on it still get through. It
+only stops reading once MAX_HELD messages are held, which pushes back on
+the sender.
+'''
+
+import logging
+import threading
+import time
+import Queue
+
+from messages import MessageType
+
+
+class Lane(object):
+    CONTROL = "control"
+    BULK = "bulk"
+
+# messages that carry or move file data. Everything else is control traffic
+BULK_MESSAGES = frozenset([
+    MessageType.FILE_DOWNLOAD_REQUEST,
+    MessageType.FILE_DATA,
+    MessageType.FILE_CHANGED,
+    MessageType.NEW_FILE_AVAILABLE,
+    MessageType.NOTIFICATION_BATCH,
+    MessageType.FILE_BLOCK_REQUEST,
+    MessageType.BLOCK_HASHES_REQUEST,
+    MessageType.CHUNK_MANIFEST_REQUEST,
+    MessageType.READ_RANGE_REQUEST,
+])
+
+# messages a connection can have waiting for room in their lanes before
+# it stops being read
+MAX_HELD = 64
+
+def lane_of(msg_type):
+    return Lane.BULK if msg_type in BULK_MESSAGES else Lane.CONTROL
+
+
+class _LaneStats(object):
+    def __init__(self):
+        self.submitted = 0
+        self.started = 0
+        self.blocked = 0 # submits that found the queue full
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class WorkerPool(object):
+    '''
+    A fixed set of worker threads per lane, fed by one bounded queue per lane
+    '''
+    # lane -> (workers, queue size)
+    LANES = {
+        Lane.CONTROL: (4, 256),
+        Lane.BULK: (4, 64),
+    }
+
+    def __init__(self, name="Worker", lanes=None):
+        self._queues = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        for lane, (workers, queue_size) in (lanes or self.LANES).items():
+            self._queues[lane] = Queue.Queue(queue_size)
+            self._stats[lane] = _LaneStats()
+            for i in range(workers):
+                thread = threading.Thread(target=self._work, args=(lane,),
+                                          name="%s_%s_%d" % (name, lane, i))
+                thread.daemon = True
+                thread.start()
+
+    def submit(self, lane, function, *args):
+        '''queues function(*args) on lane, waiting for room if the lane is full'''
+        task = (time.time(), function, args)
+        try:
+            self._queues[lane].put_nowait(task)
+        except Queue.Full:
+            with self._lock:
+                self._stats[lane].blocked += 1
+            self._queues[lane].put(task)
+        self._submitted(lane)
+
+    def try_submit(self, lane, function, *args):
+        '''returns False without queueing anything if the lane is full'''
+        try:
+            self._queues[lane].put_nowait((time.time(), function, args))
+        except Queue.Full:
+            with self._lock:
+                self._stats[lane].blocked += 1
+            return False
+        self._submitted(lane)
+        return True
+
+    def stats(self):
+        '''returns {lane: {"depth": ..., "max_depth": ..., ...}}'''
+        result = {}
+        with self._lock:
+            for lane, stats in self._stats.items():
+                result[lane] = {
+                    "depth": self._queues[lane].qsize(),
+                    "max_depth": stats.max_depth,
+                    "submitted": stats.submitted,
+                    "started": stats.started,
+                    "blocked": stats.blocked,
+                    "avg_wait": stats.total_wait / stats.started if stats.started else 0.0,
+                    "max_wait": stats.max_wait,
+                }
+        return result
+
+    def report(self):
+        lines = ["%-8s %6s %9s %10s %10s %8s %9s %9s" % ("lane", "depth", "max depth",
+                                                        "submitted", "started", "blocked",
+                                                        "avg wait", "max wait")]
+        for lane, s in sorted(self.stats().items()):
+            lines.append("%-8s %6d %9d %10d %10d %8d %8.3fs %8.3fs" %
+                         (lane, s["depth"], s["max_depth"], s["submitted"], s["started"],
+                          s["blocked"], s["avg_wait"], s["max_wait"]))
+        return "\n".join(lines)
+
+    def _submitted(self, lane):
+        depth = self._queues[lane].qsize()
+        with self._lock:
+            stats = self._stats[lane]
+            stats.submitted += 1
+            stats.max_depth = max(stats.max_depth, depth)
+
+    def _work(self, lane):
+        tasks = self._queues[lane]
+        while True:
+            queued_at, function, args = tasks.get()
+            wait = time.time() - queued_at
+            with self._lock:
+                stats = self._stats[lane]
+                stats.started += 1
+                stats.total_wait += wait
+                stats.max_wait = max(stats.max_wait, wait)
+            try:
+                function(*args)
+            except Exception:
+                logging.exception("Unhandled error in " + threading.current_thread().name)
+
+
+class HeldMessages(object):
+    '''
+    The tasks of one connection that are waiting for room in their lane.
+    A task only waits behind earlier ones of its own lane, so a full bulk
+    lane doesn't hold up the control messages read after it. Used by the
+    connection's reader thread only
+    '''
+    def __init__(self, pool, max_held=MAX_HELD):
+        self._pool = pool
+        self.max_held = max_held
+        self._held = [] # (lane, function, args), oldest first
+
+    def __len__(self):
+        return len(self._held)
+
+    def full(self):
+        '''True if the connection shouldn't be read until some are submitted'''
+        return len(self._held) >= self.max_held
+
+    def submit(self, lane, function, *args):
+        '''submits function(*args) to lane, or holds it if the lane is full'''
+        if (not any(held_lane == lane for held_lane, f, a in self._held) and
+            self._pool.try_submit(lane, function, *args)):
+            return
+        self._held.append((lane, function, args))
+
+    def retry(self):
+        '''submits the held tasks there's room for. returns True if any are left'''
+        full = set()
+        held = []
+        for lane, function, args in self._held:
+            if lane in full or not self._pool.try_submit(lane, function, *args):
+                full.add(lane)
+                held.append((lane, function, args))
+        self._held = held
+        return bool(held)
@@ -0,0 +1,85 @@
+"""
+workers_test.py - Test file for workers.py
+"""
+
+import threading
+
+import workers
+from workers import Lane
+from messages import MessageType
+
+def test_lanes():
+    print "Testing lanes"
+    assert workers.lane_of(MessageType.FILE_DATA) == Lane.BULK
+    assert workers.lane_of(MessageType.FILE_CHANGED) == Lane.BULK
+    assert workers.lane_of(MessageType.LIST_REQUEST) == Lane.CONTROL
+    assert workers.lane_of(MessageType.CONNECT_REQUEST) == Lane.CONTROL
+
+def test_backpressure_and_isolation():
+    print "Testing backpressure"
+    pool = workers.WorkerPool("Test", {Lane.CONTROL: (1, 2), Lane.BULK: (1, 2)})
+    release = threading.Event()
+    done = threading.Event()
+
+    # the bulk worker is stuck, so its queue fills up
+    assert pool.try_submit(Lane.BULK, release.wait)
+    while pool.stats()[Lane.BULK]["started"] == 0:
+        pass
+    assert pool.try_submit(Lane.BULK, release.wait)
+    assert pool.try_submit(Lane.BULK, release.wait)
+    assert not pool.try_submit(Lane.BULK, release.wait)
+    assert pool.stats()[Lane.BULK]["blocked"] == 1
+    assert pool.stats()[Lane.BULK]["depth"] == 2
+
+    # control traffic still gets through
+    pool.submit(Lane.CONTROL, done.set)
+    assert done.wait(5)
+
+    release.set()
+    pool.submit(Lane.BULK, done.clear)
+    while done.is_set():
+        pass
+    assert pool.stats()[Lane.BULK]["started"] == 4
+
+def test_held_messages():
+    print "Testing held messages"
+    pool = workers.WorkerPool("Held", {Lane.CONTROL: (1, 2), Lane.BULK: (1, 1)})
+    release = threading.Event()
+    order = []
+    lock = threading.Lock()
+    def record(name):
+        with lock:
+            order.append(name)
+
+    held = workers.HeldMessages(pool, max_held=3)
+    held.submit(Lane.BULK, release.wait)
+    while pool.stats()[Lane.BULK]["started"] == 0:
+        pass
+    held.submit(Lane.BULK, record, "bulk1")
+    held.submit(Lane.BULK, record, "bulk2")
+    held.submit(Lane.BULK, record, "bulk3")
+    assert len(held) == 2 and not held.full()
+
+    # a control message read after them isn't held up
+    done = threading.Event()
+    held.submit(Lane.CONTROL, done.set)
+    assert done.wait(5)
+    assert len(held) == 2
+    held.submit(Lane.BULK, record, "bulk4")
+    assert held.full()
+
+    release.set()
+    while held.retry():
+        pass
+    while len(order) < 4:
+        pass
+    assert order == ["bulk1", "bulk2", "bulk3", "bulk4"]
+
+def run():
+    test_lanes()
+    test_backpressure_and_isolation()
+    test_held_messages()
+    print "workers tests passed"
+
+if __name__ == "__main__":
+    run()